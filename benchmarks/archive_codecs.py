@@ -0,0 +1,49 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+"""
+Compare the build time and size of testsuite archives for all available
+codecs.
+
+Usage: PYTHONPATH=. python benchmarks/archive_codecs.py [<suitespath>]
+"""
+
+from igor import archive
+from igor.daemon.backends import files
+import sys
+import timeit
+
+
+def main(path, runs=5):
+    suites = files.Factory.testsuites_from_path(path)
+    print("%-20s %-6s %12s %10s" % ("suite", "codec", "build [ms]",
+                                    "size [B]"))
+    for name, suite in sorted(suites.items()):
+        for codec in archive.available_codecs():
+            build = lambda: suite.get_archive(codec=codec)
+            runtime = min(timeit.repeat(build, number=1, repeat=runs))
+            size = len(build().getvalue())
+            print("%-20s %-6s %12.2f %10d" % (name, codec, runtime * 1000,
+                                              size))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "examples/testcases/suites/")
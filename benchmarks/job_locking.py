@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+
+"""
+A stress test of the job locking: Many simulated hosts report their steps
+while other jobs are being prepared, which takes a while. The latency of
+reporting a step should not depend on the time it takes to prepare a host.
+
+Usage: PYTHONPATH=. python benchmarks/job_locking.py [<hosts> [<steps>]]
+"""
+
+from igor.daemon import job
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+
+PREPARE_TIME = 0.2
+
+
+class Host(object):
+    session = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def get_name(self):
+        return self.name
+
+    def prepare(self):
+        # Like creating and uploading the disk images of a VM
+        time.sleep(PREPARE_TIME)
+
+    def start(self):
+        pass
+
+    def purge(self):
+        time.sleep(PREPARE_TIME / 2)
+
+
+class Profile(object):
+    def get_name(self):
+        return "profile"
+
+    def assign_to(self, host, additional_kargs):
+        pass
+
+    def revoke_from(self, host):
+        pass
+
+
+class Testcase(object):
+    timeout = 600
+    expect_failure = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def __to_dict__(self):
+        return {"name": self.name}
+
+
+class Testsuite(object):
+    name = "suite"
+
+    def __init__(self, steps):
+        self._testcases = [Testcase("case-%d" % n) for n in range(steps)]
+
+    def testcases(self):
+        return self._testcases
+
+    def timeout(self):
+        return 600 * len(self._testcases)
+
+    def __to_dict__(self):
+        return {"name": self.name}
+
+
+class JobSpec(object):
+    def __init__(self, host, steps):
+        self.testsuite = Testsuite(steps)
+        self.profile = Profile()
+        self.host = host
+        self.additional_kargs = ""
+
+
+def report_steps(jc, j, steps, latencies):
+    """Act like the testrunner on the host, report all steps
+    """
+    while j.state() != job.s_running:
+        time.sleep(0.01)
+    for n in range(steps):
+        started_at = time.time()
+        jc.finish_test_step(j.cookie, n, True)
+        latencies.append(time.time() - started_at)
+        time.sleep(0.01)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main(hosts=20, steps=20):
+    session_path = tempfile.mkdtemp()
+    jc = job.JobCenter(session_path)
+    jobs = []
+    latencies = []
+    reporters = []
+
+    started_at = time.time()
+    for n in range(hosts):
+        resp = jc.submit(JobSpec(Host("host-%d" % n), steps))
+        jobs.append(resp["job"])
+        jc.start_job(resp["cookie"])
+        reporter = threading.Thread(target=report_steps,
+                                    args=(jc, resp["job"], steps,
+                                          latencies))
+        reporter.start()
+        reporters.append(reporter)
+    for reporter in reporters:
+        reporter.join()
+    jc.wait_for_endstates(lambda: all(j._ended for j in jobs), timeout=1)
+    runtime = time.time() - started_at
+
+    passed = len([j for j in jobs if j.state() == job.s_passed])
+    print("%d hosts, %d steps each, preparing a host takes %.1fs" %
+          (hosts, steps, PREPARE_TIME))
+    print("Passed jobs: %d of %d, total time %.2fs" % (passed, hosts,
+                                                      runtime))
+    print("Step latency [ms]: median %.2f, 99%% %.2f, max %.2f" %
+          tuple(1000 * v for v in [percentile(latencies, 0.5),
+                                   percentile(latencies, 0.99),
+                                   max(latencies)]))
+    shutil.rmtree(session_path)
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:3]])
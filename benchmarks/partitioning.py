@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+
+"""
+Compare creating disk images with one parted call per command (the
+previous way) and with one scripted parted call, for a growing number of
+partitions. Needs parted.
+
+Usage: PYTHONPATH=. python benchmarks/partitioning.py [<runs>]
+"""
+
+from igor.daemon.partition import Layout, Partition
+from igor.utils import run
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def layout(count):
+    return Layout("%dM" % (count + 2), [Partition("pri", "%dM" % (n + 1),
+                                                  "%dM" % (n + 2))
+                                        for n in range(count)])
+
+
+def per_command(image):
+    """What Layout.create did before
+    """
+    run("truncate --size=%s '%s'" % (image.size, image.filename))
+    cmds = ["mklabel %s" % image.parted_labels[image.label]]
+    cmds += [p.__to_parted__() for p in image.partitions]
+    cmds += ["quit"]
+    for cmd in cmds:
+        run("parted '%s' '%s'" % (image.filename, cmd))
+
+
+def batched(image):
+    image.create(os.path.dirname(image.filename))
+
+
+def timed(func, count, workdir, runs):
+    times = []
+    for n in range(runs):
+        image = layout(count)
+        image.filename = os.path.join(workdir, "image-%d.img" % n)
+        start = time.time()
+        func(image)
+        times.append(time.time() - start)
+        image.remove()
+    return min(times)
+
+
+def main(runs=3):
+    if not run("which parted"):
+        print("parted is needed for this benchmark")
+        return 1
+
+    workdir = tempfile.mkdtemp()
+    try:
+        print("%10s %18s %18s" % ("partitions", "per command [ms]",
+                                  "batched [ms]"))
+        for count in [1, 4, 16, 64]:
+            times = [timed(f, count, workdir, runs)
+                     for f in [per_command, batched]]
+            print("%10d %18.1f %18.1f" % (count, times[0] * 1000,
+                                          times[1] * 1000))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 3))
@@ -0,0 +1,153 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+
+"""
+Compare the latency of a job report when the stylesheet is compiled for
+each report (the previous way) and when the compiled stylesheet is reused.
+The reports are also requested over HTTP, from a server using a thread per
+request and from igord's pooled server, as the compiled stylesheets are
+kept per thread.
+
+Usage: PYTHONPATH=. python benchmarks/reports.py [<suitespath>]
+"""
+
+from igor import reports, utils
+from igor.daemon import hacks
+from igor.daemon.backends import files
+from lxml import etree
+from wsgiref import simple_server
+import SocketServer
+import bottle
+import sys
+import threading
+import timeit
+import urllib2
+
+
+def job_like(suite, steps):
+    """Roughly what Job.__to_dict__ returns for a job with steps results
+    """
+    testcases = suite.testcases()
+    results = [{"created_at": 1370000000.0 + n,
+                "testcase": testcases[n % len(testcases)].__to_dict__(),
+                "is_success": True,
+                "is_passed": True,
+                "is_abort": False,
+                "is_skipped": False,
+                "note": None,
+                "runtime": 12.5,
+                "log": "Some log output of a testcase\n" * 50,
+                "annotations": ""} for n in range(steps)]
+    return {"id": "i2Xyz", "profile": "profile", "host": "host",
+            "testsuite": suite.__to_dict__(), "state": "running",
+            "is_endstate": False, "current_step": steps,
+            "results": results, "timeout": 600, "runtime": 123.4,
+            "created_at": 1370000000.0,
+            "artifacts": ["%d-log" % n for n in range(steps)],
+            "additional_kargs": ""}
+
+
+def uncached(stylefile, xml):
+    return etree.XSLT(etree.parse(stylefile))(xml)
+
+
+def cached(stylefile, xml):
+    return reports.transform_xml(stylefile, xml)
+
+
+class ThreadPerRequestServer(SocketServer.ThreadingMixIn,
+                             simple_server.WSGIServer):
+    """How igord served requests before, a new thread for each request
+    """
+    daemon_threads = True
+
+
+class PooledServer(hacks.PooledWSGIServer):
+    workers = 4
+
+
+def serve(server_class, obj):
+    """Starts a server with a route rendering the report of obj, like
+    igord's job report route
+    """
+    app = bottle.Bottle()
+
+    @app.route("/report")
+    def report():
+        return str(reports.job_status_to_report(obj))
+
+    server = simple_server.make_server("127.0.0.1", 0, app, server_class,
+                                       hacks.QuietWSGIRequestHandler)
+    worker = threading.Thread(target=server.serve_forever)
+    worker.daemon = True
+    worker.start()
+    return server
+
+
+def request(url):
+    urllib2.urlopen(url).read()
+
+
+def main_http(path, runs=5, number=20):
+    suites = files.Factory.testsuites_from_path(path)
+    name, suite = sorted(suites.items())[0]
+    print("%-20s %6s %-12s %16s %16s" % ("suite", "steps", "report",
+                                         "thread/req [ms]", "pooled [ms]"))
+    for steps in [1, 10, 50]:
+        obj = job_like(suite, steps)
+        times = []
+        for server_class in [ThreadPerRequestServer, PooledServer]:
+            server = serve(server_class, obj)
+            url = "http://127.0.0.1:%d/report" % server.server_port
+            times.append(min(timeit.repeat(lambda: request(url),
+                                           number=number,
+                                           repeat=runs)) / number)
+            server.shutdown()
+        print("%-20s %6d %-12s %16.2f %16.2f" %
+              (name, steps, "job-rst", times[0] * 1000, times[1] * 1000))
+
+
+def main(path, runs=5, number=20):
+    suites = files.Factory.testsuites_from_path(path)
+    print("%-20s %6s %-12s %16s %16s" % ("suite", "steps", "report",
+                                         "uncached [ms]", "cached [ms]"))
+    for name, suite in sorted(suites.items()):
+        for steps in [1, 10, 50]:
+            obj = job_like(suite, steps)
+            for report, rootname in [("job-rst", "status"),
+                                     ("job-junit", "job")]:
+                stylefile = reports.TRANSFORM_MAP[report]
+                xml = utils.obj2xml(rootname, obj)
+                times = [min(timeit.repeat(lambda: f(stylefile, xml),
+                                           number=number,
+                                           repeat=runs)) / number
+                         for f in [uncached, cached]]
+                print("%-20s %6d %-12s %16.2f %16.2f" %
+                      (name, steps, report, times[0] * 1000,
+                       times[1] * 1000))
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "examples/testcases/suites/"
+    main(path)
+    print("")
+    main_http(path)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+
+"""
+Compare the XML and YAML serialization of a job-like structure using a
+JSON round-trip (the previous way) and the direct way.
+
+Usage: PYTHONPATH=. python benchmarks/serialization.py [<suitespath>]
+"""
+
+from igor import utils
+from igor.daemon.backends import files
+from igor.daemon.hacks import IgordJSONEncoder, simplify, to_yaml
+import io
+import json
+import sys
+import timeit
+import yaml
+
+
+def job_like(suite, steps):
+    """Roughly what Job.__to_dict__ returns for a job with steps results
+    """
+    testcases = suite.testcases()
+    results = [{"created_at": 1370000000.0 + n,
+                "testcase": testcases[n % len(testcases)].__to_dict__(),
+                "is_success": False,
+                "is_passed": False,
+                "is_abort": False,
+                "is_skipped": False,
+                "note": None,
+                "runtime": 12.5,
+                "log": "Some log output of a failed testcase\n" * 50,
+                "annotations": ""} for n in range(steps)]
+    return {"id": "i2Xyz", "profile": "profile", "host": "host",
+            "testsuite": suite, "state": "running", "is_endstate": False,
+            "current_step": steps, "results": results, "timeout": 600,
+            "runtime": 123.4, "created_at": 1370000000.0,
+            "artifacts": ["%d-log" % n for n in range(steps)],
+            "additional_kargs": ""}
+
+
+def roundtrip_xml(obj):
+    j = json.loads(json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True,
+                              indent=2))
+    return utils.obj2xml("job", j, as_string=True)
+
+
+def direct_xml(obj):
+    buf = io.BytesIO()
+    utils.write_xml(buf, "job", simplify(obj))
+    return buf.getvalue()
+
+
+def roundtrip_yaml(obj):
+    j = json.loads(json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True,
+                              indent=2))
+    return yaml.dump_all([j])
+
+
+def direct_yaml(obj):
+    return to_yaml(obj)
+
+
+def main(path, runs=5, number=20):
+    suites = files.Factory.testsuites_from_path(path)
+    print("%-20s %6s %-6s %16s %16s" % ("suite", "steps", "format",
+                                        "roundtrip [ms]", "direct [ms]"))
+    for name, suite in sorted(suites.items()):
+        for steps in [1, 10, 50]:
+            obj = job_like(suite, steps)
+            for fmt, old, new in [("xml", roundtrip_xml, direct_xml),
+                                  ("yaml", roundtrip_yaml, direct_yaml)]:
+                times = [min(timeit.repeat(lambda: f(obj), number=number,
+                                           repeat=runs)) / number
+                         for f in [old, new]]
+                print("%-20s %6d %-6s %16.2f %16.2f" %
+                      (name, steps, fmt, times[0] * 1000, times[1] * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "examples/testcases/suites/")
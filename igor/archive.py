@@ -0,0 +1,292 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Compression codecs for the tarballs created by igor.
+"""
+
+import bz2
+import contextlib
+import os
+import tarfile
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+BUFSIZE = 64 * 1024
+
+
+class IdentityCompressor(object):
+    """A compressor which doesn't compress at all
+    """
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return ""
+
+
+class Codec(object):
+    """A compression codec for tarballs
+
+    >>> CODECS["gz"].compressor(1).flush()[:2] == "\\x1f\\x8b"
+    True
+    """
+    name = None
+    mimetype = None
+    suffix = None
+    default_level = None
+    _factory = None
+
+    def __init__(self, name, mimetype, suffix, default_level, factory):
+        self.name = name
+        self.mimetype = mimetype
+        self.suffix = suffix
+        self.default_level = default_level
+        self._factory = factory
+
+    def is_available(self):
+        return self._factory is not None
+
+    def compressor(self, level=None):
+        """Returns a new object with the compress() and flush() functions
+        """
+        if not self.is_available():
+            raise RuntimeError("Codec '%s' is not available" % self.name)
+        level = self.default_level if level is None else int(level)
+        return self._factory(level)
+
+    def __str__(self):
+        return self.name
+
+
+CODECS = {
+    "none": Codec("none", "application/x-tar", ".tar", None,
+                  lambda level: IdentityCompressor()),
+    "gz": Codec("gz", "application/x-gzip", ".tar.gz", 6,
+                lambda level: zlib.compressobj(level, zlib.DEFLATED,
+                                               16 + zlib.MAX_WBITS)),
+    "bz2": Codec("bz2", "application/x-bzip2", ".tar.bz2", 9,
+                 lambda level: bz2.BZ2Compressor(level)),
+    "xz": Codec("xz", "application/x-xz", ".tar.xz", 6,
+                (lambda level: lzma.LZMACompressor(preset=level))
+                if lzma else None),
+    "zst": Codec("zst", "application/zstd", ".tar.zst", 3,
+                 (lambda level: zstandard.ZstdCompressor(level=level)
+                  .compressobj())
+                 if zstandard else None)
+}
+
+
+def available_codecs():
+    """Returns the names of all codecs which can be used
+
+    >>> set(["none", "gz", "bz2"]) <= set(available_codecs())
+    True
+    """
+    return sorted(n for n, c in CODECS.items() if c.is_available())
+
+
+def get_codec(name):
+    """Lookup an available codec by name
+
+    >>> get_codec("bz2").mimetype
+    'application/x-bzip2'
+    >>> get_codec("rar")  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown archive codec 'rar', available: bz2, gz, ...
+    """
+    if name not in available_codecs():
+        raise ValueError("Unknown archive codec '%s', available: %s" %
+                         (name, ", ".join(available_codecs())))
+    return CODECS[name]
+
+
+class CompressedFile(object):
+    """A write-only file object which compresses all data written to it
+    """
+    _fileobj = None
+    _compressor = None
+
+    def __init__(self, fileobj, compressor):
+        self._fileobj = fileobj
+        self._compressor = compressor
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self._fileobj.write(data)
+
+    def close(self):
+        self._fileobj.write(self._compressor.flush())
+
+
+@contextlib.contextmanager
+def open_for_writing(fileobj, codec, level=None):
+    """Returns a TarFile writing to fileobj using codec
+
+    >>> import io
+    >>> dst = io.BytesIO()
+    >>> with open_for_writing(dst, get_codec("gz")) as archive:
+    ...     info = tarfile.TarInfo("foo")
+    ...     info.size = 3
+    ...     archive.addfile(info, io.BytesIO("bar"))
+    >>> _ = dst.seek(0)
+    >>> tarfile.open(fileobj=dst).extractfile("foo").read()
+    'bar'
+    """
+    compressed = CompressedFile(fileobj, codec.compressor(level))
+    with tarfile.open(fileobj=compressed, mode="w|") as archive:
+        yield archive
+    compressed.close()
+
+
+def iter_tarball(members, codec, level=None, bufsize=BUFSIZE):
+    """Yields the chunks of a compressed tarball containing the given files.
+    The files are read in chunks of bufsize, so the memory usage is bounded
+    independent of the size of the files.
+
+    Args:
+        members: A list of (arcname, filename) tuples of regular files
+        codec: The Codec to use
+        level: The compression level to use
+
+    >>> import io, tempfile
+    >>> src = tempfile.NamedTemporaryFile()
+    >>> src.write("bar" * 100000)
+    >>> src.flush()
+    >>> chunks = iter_tarball([("foo", src.name)], get_codec("gz"), \
+                              bufsize=1024)
+    >>> dst = io.BytesIO("".join(chunks))
+    >>> tarfile.open(fileobj=dst).extractfile("foo").read() == "bar" * 100000
+    True
+    """
+    compressor = codec.compressor(level)
+    for data in _iter_tar_blocks(members, bufsize):
+        data = compressor.compress(data)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _iter_tar_blocks(members, bufsize):
+    """Yields the uncompressed data of a tarball
+    A file which shrinks while it's read gets padded with zeros, a file
+    which grows is truncated to the size it had when it was opened.
+    """
+    written = 0
+    for arcname, filename in members:
+        with open(filename, "rb") as src:
+            info = _tarinfo(arcname, os.fstat(src.fileno()))
+            header = info.tobuf(tarfile.GNU_FORMAT)
+            yield header
+
+            remaining = info.size
+            while remaining > 0:
+                data = src.read(min(bufsize, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+            padding = -info.size % tarfile.BLOCKSIZE
+            yield tarfile.NUL * (remaining + padding)
+            written += len(header) + info.size + padding
+
+    yield tarfile.NUL * _end_of_tarball(written)
+
+
+def _tarinfo(arcname, st):
+    info = tarfile.TarInfo(arcname)
+    info.size = st.st_size
+    info.mtime = st.st_mtime
+    info.mode = st.st_mode & 0o7777
+    return info
+
+
+def _end_of_tarball(written):
+    # Two empty blocks mark the end of the archive, then fill the record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(written + end) % tarfile.RECORDSIZE
+    return end
+
+
+def tarball_size(members):
+    """The size of the uncompressed tarball iter_tarball yields for the
+    given files, as long as they don't change. Allows to announce the
+    length of a streamed tarball up front.
+
+    >>> import tempfile
+    >>> src = tempfile.NamedTemporaryFile()
+    >>> src.write("bar" * 1000)
+    >>> src.flush()
+    >>> members = [("foo", src.name), ("a" * 200, src.name)]
+    >>> chunks = iter_tarball(members, get_codec("none"))
+    >>> tarball_size(members) == len("".join(chunks))
+    True
+    """
+    written = 0
+    for arcname, filename in members:
+        info = _tarinfo(arcname, os.stat(filename))
+        written += len(info.tobuf(tarfile.GNU_FORMAT))
+        written += info.size + -info.size % tarfile.BLOCKSIZE
+    return written + _end_of_tarball(written)
+
+
+class IteratorReader(object):
+    """A read-only file object returning the chunks an iterator yields,
+    e.g. to send a tarball from iter_tarball as a request body
+
+    >>> reader = IteratorReader(iter(["foo", "", "bar"]))
+    >>> reader.read(2), reader.read(), reader.read()
+    ('fo', 'obar', '')
+    """
+    _iterator = None
+    _buffer = ""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while size is None or size < 0 or available < size:
+            chunk = next(self._iterator, None)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        data = "".join(chunks)
+        if size is None or size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
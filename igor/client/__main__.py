@@ -83,7 +83,6 @@ class Context(object):
     def __init__(self):
         self.remote = "127.0.0.1"
         self.port = "8080"
-        self.event_port = "6379"
         self.session = ""
         self.notify = False
 
@@ -265,15 +264,8 @@ class IgorClient(cmd.Cmd):
         pargs = [("sessionid", {"nargs": "?", "default": self.ctx.session})]
         _args = self._parse_do_args("watch_job", line, pargs)
 
-        job = self.__igorapi().job(_args.sessionid)
-
-        def job_reportxml_cb(updated_sessiondid):
-            if updated_sessiondid == _args.sessionid:
-                # Only update screen if "our" job changed
-                return job.report_junit()
-            return None
-
-        return self.watch_events(job_reportxml_cb)
+        watcher = event.JobWatcher(self.__igorapi(), _args.sessionid)
+        return self.watch_events(watcher)
 
     def do_watch_testplan(self, line):
         """watch_testplan <testplanname>
@@ -282,19 +274,18 @@ class IgorClient(cmd.Cmd):
         pargs = [("testplanname", {"nargs": "?", "default": self.ctx.session})]
         _args = self._parse_do_args("watch_testplan", line, pargs)
 
-        testplan = self.__igorapi().testplan(_args.testplanname)
-
-        def job_reportxml_cb(updated_sessiondid):
-            return testplan.report_junit()
+        watcher = event.TestplanWatcher(self.__igorapi(),
+                                        _args.testplanname)
+        return self.watch_events(watcher)
 
-        return self.watch_events(job_reportxml_cb)
+    def watch_events(self, watcher):
+        """Render the junit report of a job or plan whenever it changes
 
-    def watch_events(self, reportxml_cb):
+        Args:
+            watcher: An event.JobWatcher or event.TestplanWatcher
+        """
         is_passed = False
 
-        remote = self.ctx.remote
-        event_port = self.ctx.event_port
-
         builder = junitless.LogBuilder()
 
         def parse_state(reportxml):
@@ -305,27 +296,27 @@ class IgorClient(cmd.Cmd):
             return states, is_endstate
 
         try:
-            reportxml = reportxml_cb(None)
+            watcher.sync()
+            reportxml = watcher.report_junit()
             junitless.clearscreen()
             builder.from_xml(reportxml)
 
             builder.log.writeln("Waiting for event ...")
-            for ev in event.follow_events(remote, event_port):
-                reportxml = reportxml_cb(ev["session"])
-
-                if reportxml is not None:
-                    states, is_endstate = parse_state(reportxml)
+            for ev in watcher.events():
+                self.logger.debug("Event: %s" % ev)
+                reportxml = watcher.report_junit()
+                states, is_endstate = parse_state(reportxml)
 
-                    junitless.clearscreen()
-                    builder.from_xml(reportxml)
+                junitless.clearscreen()
+                builder.from_xml(reportxml)
 
-                    if is_endstate:
-                        self.logger.debug("State: %s" % states)
-                        self.logger.debug("Found endstate, stop watching")
-                        break
+                if is_endstate:
+                    self.logger.debug("State: %s" % states)
+                    self.logger.debug("Found endstate, stop watching")
+                    break
 
-                    builder.log.writeln("Waiting ...")
-                    builder.log.writeln("(Press Ctrl+C to stop watching)")
+                builder.log.writeln("Waiting ...")
+                builder.log.writeln("(Press Ctrl+C to stop watching)")
 
             is_passed = all(state == "passed" for state in states)
 
@@ -338,7 +329,7 @@ class IgorClient(cmd.Cmd):
         """firewall_check
         Check that all relevant ports are open
         """
-        for port in [self.ctx.port, self.ctx.event_port]:
+        for port in [self.ctx.port]:
             if not Firewall().is_port_open(port):
                 msg = ("Please open port %s or jobs can fail, because " +
                        "the testrunner might not be able to reach the " +
@@ -351,7 +342,7 @@ class IgorClient(cmd.Cmd):
         """firewall_open
         Open relevant ports
         """
-        ports = [self.ctx.port, self.ctx.event_port]
+        ports = [self.ctx.port]
         self.logger.debug("About to open the relevant TCP ports: %s" % ports)
         firewall = Firewall()
         for port in ports:
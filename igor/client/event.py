@@ -18,57 +18,151 @@
 # Author: Fabian Deutsch <fabiand@fedoraproject.org>
 #
 
-#
-# DESCRTIPTION
-#
+"""
+Follow the progress of jobs and testplans using the events of igord.
+Only the initial status is fetched, afterwards it's kept up to date using
+the (small) events.
+"""
 
 from igor import reports, common
-from lxml import etree
 import logging
-import sys
-import redis
-
-REPORTBASE = "http://{host}:{port}/jobs/{sessionid}/status?format=xml"
-
-
-def follow_events(server, port):
-    r = redis.Redis(host=server, port=int(port))
-    p = r.pubsub()
-    p.subscribe(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME)
-    for obj in p.listen():
-        event = None
-        xmlstr = str(obj["data"]).strip()
-        if not xmlstr.startswith("<"):
-            # Sometimes just an int is sent ...
-            continue
-        try:
-            event = etree.XML(xmlstr)
-        except:
-            logging.exception("Failed to parse: %s -> %s" % (obj, xmlstr))
-        if event is not None and event.attrib:
-            yield event.attrib
-    p.unsubscribe(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME)
-    p.close()
-
-
-def __FIXME_retrieve_report(remote, port, sessionid):
-    url = REPORTBASE.format(host=remote, port=port, sessionid=sessionid)
-    print("Fetching %s" % url)
-    #statusdata = urllib2.urlopen(url).read()
-    _statusfile = "/home/fdeutsch/dev/ovirt/igor/daemon/igor/data/st.xml"
-    #_junitfile = "/home/fdeutsch/dev/ovirt/igor/daemon/igor/data/st.junit.xml"
-    statusdata = open(_statusfile).read()
-
-    xsltfile = reports.TRANSFORM_MAP["job-junit"]
-    statusxml = etree.XML(statusdata)
-    junitxml = reports.transform_xml(xsltfile, statusxml)
-    junitdata = reports.to_xml_str(junitxml)
-
-    return junitdata
-
-
-if __name__ == "__main__":
-    remote = sys.argv[1]
-    port = 8090
-    for evnt in follow_events(remote, port):
-        __FIXME_retrieve_report(remote, port, evnt["session"])
+
+logger = logging.getLogger(__name__)
+
+
+def follow_events(api, since=None, timeout=30, **filters):
+    """Yields the events of igord, forever.
+    A reset event is yielded if events were missed, then the full status
+    needs to be fetched again.
+
+    Args:
+        api: An IgordAPI
+        since: The id of the last seen event, None to start now
+        filters: Only events of the job=<cookie> or plan=<name>
+    """
+    while True:
+        reply = api.events(since, timeout, **filters)
+        since = reply["last_id"]
+        if reply["missed"]:
+            yield {"type": "reset", "id": since}
+        for event in reply["events"]:
+            yield event
+
+
+def apply_job_event(status, event):
+    """Update the status dict of a job with a job event
+
+    >>> status = {"state": "running", "results": [], "current_step": 0}
+    >>> apply_job_event(status, {"type": "job.step", "step": 0,
+    ...                          "result": {"is_passed": True}})
+    >>> status["current_step"], status["results"]
+    (1, [{'is_passed': True}])
+    >>> apply_job_event(status, {"type": "job.state", "state": "passed",
+    ...                          "is_endstate": True, "runtime": 3,
+    ...                          "current_step": 1})
+    >>> status["state"], status["is_endstate"]
+    ('passed', True)
+    """
+    if event["type"] == "job.state":
+        for key in ["state", "is_endstate", "runtime", "current_step"]:
+            status[key] = event[key]
+    elif event["type"] == "job.step":
+        n = event["step"]
+        results = status["results"]
+        results[n:n + 1] = [event["result"]]
+        status["current_step"] = n + 1
+
+
+class JobWatcher(object):
+    """Keeps the status of a job up to date
+    """
+    api = None
+    cookie = None
+    status = None
+    last_id = None
+
+    def __init__(self, api, cookie):
+        self.api = api
+        self.cookie = cookie
+
+    @property
+    def filters(self):
+        return {"job": self.cookie}
+
+    def sync(self):
+        """Fetch the full status
+        """
+        # The id is taken before, so no event in between gets lost
+        self.last_id = self.api.events(timeout=0)["last_id"]
+        self.status = self.api.json_request(common.routes.job_status,
+                                            cookie=self.cookie)
+
+    def apply(self, event):
+        """Update the status with an event
+
+        Returns:
+            True if the status changed
+        """
+        self.last_id = event["id"]
+        if event["type"] == "reset":
+            self.sync()
+            return True
+        if event.get("job") == self.cookie:
+            apply_job_event(self.status, event)
+            return True
+        return False
+
+    def report_junit(self):
+        return reports.job_status_to_junit(self.status)
+
+    def events(self):
+        """Yields the events relevant for this job, forever
+        """
+        if self.status is None:
+            self.sync()
+        for event in follow_events(self.api, self.last_id, **self.filters):
+            if self.apply(event):
+                yield event
+
+
+class TestplanWatcher(JobWatcher):
+    """Keeps the status of a testplan up to date
+    The status of a job is fetched once, when the plan started it.
+    """
+    name = None
+
+    def __init__(self, api, name):
+        self.api = api
+        self.name = name
+
+    @property
+    def filters(self):
+        return {"plan": self.name}
+
+    def sync(self):
+        self.last_id = self.api.events(timeout=0)["last_id"]
+        self.status = self.api.json_request(common.routes.testplan_status,
+                                            name=self.name)
+        if self.status is None:
+            raise RuntimeError("Testplan '%s' was not run" % self.name)
+
+    def apply(self, event):
+        self.last_id = event["id"]
+        jobs = dict((j["id"], j) for j in self.status["jobs"])
+        if event["type"] == "reset":
+            self.sync()
+        elif event["type"] == "plan.state":
+            self.status["status"] = event["status"]
+            self.status["passed"] = event["passed"]
+        elif event["type"] == "plan.job":
+            if event["job"] not in jobs:
+                self.status["jobs"].append(self.api.json_request(
+                    common.routes.job_status, cookie=event["job"]))
+        elif event.get("job") in jobs:
+            apply_job_event(jobs[event["job"]], event)
+        else:
+            return False
+        return True
+
+    def report_junit(self):
+        return reports.testplan_status_to_junit_report(self.status)
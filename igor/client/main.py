@@ -17,16 +17,17 @@
 #
 # Author: Fabian Deutsch <fabiand@fedoraproject.org>
 #
+from igor import archive
 from igor.common import routes
 from lxml import etree
+import hashlib
 import io
+import json
 import logging
 import os
 import re
 import subprocess
-import tarfile
 import tempfile
-import time
 import urllib
 import urllib2
 
@@ -63,12 +64,21 @@ class HTTPHelper(object):
         return reply
 
     def put(self, url, data, headers={}):
-        self.request(url, "PUT", data, headers)
+        return self.request(url, "PUT", data, headers)
 
     def put_binary(self, url, data, headers={}):
         return self.put(url, data,
                         {'Content-Type': 'application/octet-stream'})
 
+    def put_stream(self, url, fileobj, size, headers={}):
+        """PUT size bytes read from fileobj, without reading them into
+        memory first
+        """
+        headers = dict(headers)
+        headers.update({"Content-Type": "application/octet-stream",
+                        "Content-Length": str(size)})
+        return self.put(url, fileobj, headers)
+
     def delete(self, url):
         self.request(url, "DELETE")
 
@@ -119,6 +129,21 @@ class IgordAPI(object):
         tree = etree.XML(pagedata) if pagedata else None
         return tree
 
+    def json_request(self, route, query={}, **route_args):
+        """Request a route and return the decoded JSON
+        """
+        url = self.url(route, dict(query, format="json"), **route_args)
+        return json.loads(self._http.request(url))
+
+    def events(self, since=None, timeout=30, **filters):
+        """Wait for events following the event since, see
+        igor.client.event.follow_events
+        """
+        query = dict(filters, timeout=timeout)
+        if since is not None:
+            query["since"] = since
+        return self.json_request(routes.events, query)
+
     def jobs(self):
         return self.route_request(routes.jobs)
 
@@ -232,41 +257,49 @@ class ProfileAPI(IgordAPI):
         self.name = name
 
     def new(self, vmlinuz_file, initrd_file, kargs):
-        filemap = {"kernel": vmlinuz_file,
-                   "initrd": initrd_file,
-                   "kargs": io.BytesIO(kargs)}
+        """Upload kernel, initrd and kargs as a new profile.
+        The files are streamed as a tarball, so they are not read into
+        memory and only once from disk. The checksum of the tarball is
+        calculated while it is sent, and compared to the one the server
+        replies with, the profile is removed again if they differ.
+        """
         headers = {"x-kernel-filename": "kernel",
                    "x-initrd-filename": "initrd",
                    "x-kargs-filename": "kargs"}
 
-        # Create a temporary file which is used to create a tarball
-        # Now add kernel+initrd+kargs file into this archive
-        # And upload it via PUT
-        with tempfile.NamedTemporaryFile() as tmpfile:
-            self.logger.debug("Temporary archive for profile upload: %s" %
-                              tmpfile.name)
-            with tarfile.open(fileobj=tmpfile, mode="w") as archive:
-                self.logger.debug("Adding files: %s" % filemap)
-                for arcname, filename in filemap.items():
-                    self.logger.debug("Adding %s" % filename)
-                    if type(filename) is io.BytesIO:
-                        srcobj = filename
-                    else:
-                        with open(filename) as fssrc:
-                            srcobj = io.BytesIO(fssrc.read())
-                    info = tarfile.TarInfo(name=arcname)
-                    info.size = len(srcobj.getvalue())
-                    info.mtime = time.time()
-                    archive.addfile(tarinfo=info, fileobj=srcobj)
-            tmpfile.flush()
-            self.logger.debug("Archive contents: \n%s" %
-                              subprocess.check_output(["tar", "tvf",
-                                                       tmpfile.name]))
-
-            tmpfile.seek(0)
-            data = io.BytesIO(tmpfile.read())
+        with tempfile.NamedTemporaryFile() as kargsfile:
+            kargsfile.write(kargs)
+            kargsfile.flush()
+            members = [("kernel", vmlinuz_file),
+                       ("initrd", initrd_file),
+                       ("kargs", kargsfile.name)]
+            codec = archive.get_codec("none")
+            self.logger.debug("Uploading files: %s" % members)
+
+            size = archive.tarball_size(members)
+            digest = hashlib.sha256()
+
+            def hashed(chunks):
+                for data in chunks:
+                    digest.update(data)
+                    yield data
+
             url = self.url(routes.profile, pname=self.name)
-            self._http.put_binary(url, data.getvalue(), headers)
+            tarball = archive.IteratorReader(
+                hashed(archive.iter_tarball(members, codec)))
+            reply = self._http.put_stream(url, tarball, size, headers)
+            self.logger.debug("Archive of %d bytes, sha256 %s" %
+                              (size, digest.hexdigest()))
+
+            received = reply.info().getheader("X-Checksum-Sha256")
+            if received is None:
+                self.logger.warning("The server did not reply with a " +
+                                    "checksum, the upload is not verified")
+            elif received != digest.hexdigest():
+                self.delete()
+                raise RuntimeError("Upload of profile %s corrupted, " %
+                                   self.name + "sha256 %s, sent %s" %
+                                   (received, digest.hexdigest()))
 
     def delete(self):
         return self.route_request(routes.profile_delete, pname=self.name)
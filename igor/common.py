@@ -74,7 +74,10 @@ class routes(object):
 
     testcase_source = '/testcases/<suitename>/<setname>/<casename>/source'
 
+    events = '/events'
+
     server_log = '/server/log'
+    server_stats = '/server/stats'
 
     datastore = '/store'
     datastore_file = '/store/<filename>'
@@ -1,19 +1,26 @@
 #!/bin/env python
 # -*- coding: utf-8 -*-
 
-from igor import common, log, reports, utils
-from igor.daemon import config, job, main
-from igor.daemon.hacks import IgordJSONEncoder
+from igor import archive, common, log, reports, utils
+from igor.daemon import blobstore, config, job, main, pipeline, store
+from igor.daemon.hacks import IgordJSONEncoder, simplify, to_yaml, \
+    PooledWSGIRefServer
 from string import Template
 import StringIO
 import argparse
 import bottle
+import hashlib
 import importlib
+import io
 import json
 import os
+import shutil
 import subprocess
 import tarfile
-import yaml
+import tempfile
+import threading
+import time
+import weakref
 
 log.configure("/tmp/igord.log")
 
@@ -22,6 +29,8 @@ logger = log.getLogger(__name__)
 logger.info("Starting igor daemon")
 
 BOTTLE_MAX_READ_SIZE = 1024 * 1024 * 512
+PROFILE_MAX_READ_SIZE = 1024 * 1024 * 1024 * 4
+ANNOTATION_MAX_SIZE = 1024 * 1024
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-c", "--config", help="Config file to use",
@@ -35,6 +44,10 @@ ctx = parser.parse_args()
 
 CONFIG = config.parse_config(updates=ctx.updates)
 
+ARCHIVES_CONFIG = CONFIG["daemon"].get("archives") or {}
+ARCHIVE_CODEC = ARCHIVES_CONFIG.get("codec", "bz2")
+ARCHIVE_LEVEL = ARCHIVES_CONFIG.get("level", None)
+
 plan_backends = []
 profile_backends = []
 testsuite_backends = []
@@ -83,8 +96,18 @@ load_backends(CONFIG["daemon"]["enable-backends"]["hosts"],
 #
 # Now prepare the essential objects
 #
-jc = job.JobCenter(session_path=CONFIG["daemon"]["session"]["path"],
-                   hooks_path=CONFIG["daemon"]["hooks"]["path"])
+SESSION_CONFIG = CONFIG["daemon"]["session"]
+job_store = store.JobStore(SESSION_CONFIG.get("store") or
+                           os.path.join(SESSION_CONFIG["path"], "jobs.db"))
+
+PIPELINE_CONFIG = CONFIG["daemon"].get("pipeline") or {}
+setup_pipeline = pipeline.Pipeline(PIPELINE_CONFIG.get("workers") or 8,
+                                   PIPELINE_CONFIG.get("limits"))
+
+jc = job.JobCenter(session_path=SESSION_CONFIG["path"],
+                   hooks_path=CONFIG["daemon"]["hooks"]["path"],
+                   store=job_store,
+                   setup_pipeline=setup_pipeline)
 
 inventory = main.Inventory(
     plans=plan_origins,
@@ -93,13 +116,15 @@ inventory = main.Inventory(
     hosts=host_origins)
 inventory.check()
 
+jc.recover(inventory)
 
-def to_json(obj):
+
+def requested_format():
+    """Returns the (format, root tag) requested by the client
+    """
     typ = "json"
     root_tag = "result"
 
-    r = json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True, indent=2)
-
     if "format" in bottle.request.query:
         typ = bottle.request.query["format"]
     if "root" in bottle.request.query:
@@ -108,19 +133,153 @@ def to_json(obj):
     if "x-igor-format-xml" in bottle.request.headers:
         typ = "xml"
 
+    return typ, root_tag
+
+
+def serialize(obj, typ, root_tag):
+    """Serialize obj to json, xml or yaml.
+    XML and YAML are created from the simplified object, without a
+    round-trip through JSON.
+    """
     if typ == "xml":
-        j = json.loads(r)
-        r = "<?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>\n"
-        r += utils.obj2xml(root_tag, j, as_string=True)
+        buf = io.BytesIO()
+        buf.write("<?xml-stylesheet type='text/xsl' href='/ui/index.xsl' ?>\n")
+        utils.write_xml(buf, root_tag, simplify(obj))
+        return buf.getvalue()
 
     if typ == "yaml":
-        j = json.loads(r)
-        r = yaml.dump_all(j)
+        return to_yaml(obj)
+
+    return json.dumps(obj, cls=IgordJSONEncoder, sort_keys=True, indent=2)
 
+
+def to_json(obj):
+    typ, root_tag = requested_format()
+    r = serialize(obj, typ, root_tag)
     bottle.response.content_type = "application/%s" % typ
     return r
 
 
+# The serialized bodies of jobs, kept as long as the job exists
+_job_bodies = weakref.WeakKeyDictionary()
+
+# Running jobs change all the time (runtime), so their bodies are only
+# reused for this many seconds
+JOB_BODY_RUNNING_TTL = 2
+
+
+def job_cache_key(j, *args):
+    """The key under which something derived from job j can be cached
+    """
+    key = (j.version(),) + args
+    if not j.reached_endstate():
+        key += (int(time.time() / JOB_BODY_RUNNING_TTL),)
+    return key
+
+
+def job_to_json(j):
+    """Like to_json, but the serialized job is cached by the version of the
+    job and the format, and the ETag of the body is set, so clients can
+    poll with If-None-Match
+    """
+    typ, root_tag = requested_format()
+    key = job_cache_key(j, typ, root_tag)
+
+    cached = _job_bodies.get(j)
+    if cached is None or cached[0] != key:
+        body = serialize(j, typ, root_tag)
+        etag = '"%s-%s"' % (j.cookie, hashlib.sha1(body).hexdigest())
+        cached = (key, etag, body)
+        _job_bodies[j] = cached
+    key, etag, body = cached
+
+    if etag_matches(etag):
+        r = bottle.HTTPResponse(status=304)
+    else:
+        r = bottle.HTTPResponse(body)
+        r.content_type = "application/%s" % typ
+    r.set_header("ETag", etag)
+    return r
+
+
+def etag_matches(etag):
+    """If the client already has the entity with the (quoted) etag
+    """
+    known_etags = [e.strip() for e in
+                   bottle.request.headers.get("If-None-Match", "").split(",")]
+    return etag in known_etags
+
+
+def send_file(fileobj, etag, mimetype):
+    """Send an open file, a 304 is send if the client already has the file
+    with the given etag. The file is closed once it was sent.
+    """
+    etag = '"%s"' % etag
+    if etag_matches(etag):
+        fileobj.close()
+        r = bottle.HTTPResponse(status=304)
+    else:
+        r = bottle.HTTPResponse(fileobj)
+        r.content_type = mimetype
+        r.set_header("Content-Length", os.fstat(fileobj.fileno()).st_size)
+    r.set_header("ETag", etag)
+    return r
+
+
+def requested_archive_codec():
+    """Returns the (codec, level) requested by the client using the codec
+    and level query params, the configured ones are used as a default
+    """
+    name = bottle.request.query.get("codec") or ARCHIVE_CODEC
+    level = bottle.request.query.get("level") or None
+    if level is None and name == ARCHIVE_CODEC:
+        level = ARCHIVE_LEVEL
+    try:
+        codec = archive.get_codec(name)
+        level = int(level) if level is not None else None
+        # Rejects levels out of the range of the codec
+        codec.compressor(level)
+    except ValueError as e:
+        bottle.abort(412, str(e))
+    return codec, level
+
+
+def send_testsuite_archive(testsuite):
+    codec, level = requested_archive_codec()
+    fileobj, filename = testsuite.open_archive_file(config.ARCHIVE_CACHE_DIR,
+                                                    codec=codec.name,
+                                                    level=level)
+    etag = os.path.basename(filename)
+    return send_file(fileobj, etag, codec.mimetype)
+
+
+def request_body(max_size=BOTTLE_MAX_READ_SIZE):
+    """Returns a file object to stream the request body from.
+    bottle.request.body would buffer the whole body first, so the wsgi
+    input is read directly if the length is known.
+    """
+    length = bottle.request.content_length
+    if length > max_size:
+        bottle.abort(413, "Request body exceeds %d bytes" % max_size)
+    if length < 0:
+        return bottle.request.body  # @UndefinedVariable
+    return utils.LimitedReader(bottle.request.environ["wsgi.input"], length)
+
+
+def receive_request_body(sink, max_size=BOTTLE_MAX_READ_SIZE):
+    """Stream the request body to sink(fileobj, max_size, checksum).
+    An optional X-Checksum-Sha256 header is verified while streaming.
+    """
+    digest = bottle.request.headers.get("X-Checksum-Sha256")
+    checksum = ("sha256", digest) if digest else None
+    try:
+        sink(request_body(max_size), max_size=max_size, checksum=checksum)
+    except utils.SizeLimitExceeded as e:
+        bottle.abort(413, str(e))
+    except utils.ChecksumMismatch as e:
+        bottle.abort(412, str(e))
+
+
 def check_authentication(user, password):
     return user == password
 
@@ -167,13 +326,10 @@ def dav_file_get(filename):
 
 @app.route(common.routes.datastore_file, method='PUT')
 def dav_file_put(filename):
-    length = bottle.request.headers["Content-Length"]
-    length = int(length) if length else None
     path = _datastore_filename(filename)
-    with open(path, "w") as dst:
-        data = bottle.request.body.read(length)  # @UndefinedVariable
-        logger.debug("Wrote '%s'" % path)
-        dst.write(data)
+    receive_request_body(lambda src, **kwargs:
+                         utils.copy_to_file(src, path, **kwargs))
+    logger.debug("Wrote '%s'" % path)
 
 
 @app.route(common.routes.datastore_file, method='DELETE')
@@ -221,16 +377,43 @@ def submit_testsuite(tname, pname, hname, cookiereq=None):
     return to_json(resp)
 
 
+JOB_HISTORY_FILTERS = ["state", "host", "testsuite", "since", "limit",
+                       "cursor"]
+JOB_HISTORY_MAX_LIMIT = 1000
+
+
 @app.route(common.routes.jobs)
 def get_jobs():
-    return to_json(jc.get_jobs())
+    """Without any filter all jobs are returned (as used by the UI),
+    otherwise a page of job summaries from the history
+    """
+    query = bottle.request.query
+    if not any(k in query for k in JOB_HISTORY_FILTERS):
+        return to_json(jc.get_jobs())
+
+    try:
+        since = float(query["since"]) if query.get("since") else None
+        limit = int(query.get("limit") or 50)
+        cursor = int(query["cursor"]) if query.get("cursor") else None
+    except ValueError as e:
+        bottle.abort(412, "Invalid filter: %s" % e)
+    limit = max(1, min(limit, JOB_HISTORY_MAX_LIMIT))
+    jobs, cursor = jc.history(state=query.get("state") or None,
+                              host=query.get("host") or None,
+                              testsuite=query.get("testsuite") or None,
+                              since=since, limit=limit, cursor=cursor)
+    return to_json({"jobs": jobs, "next_cursor": cursor})
 
 
 @app.route(common.routes.job_start)
 def start_job(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
-    m = jc.start_job(cookie)
+    try:
+        priority = int(bottle.request.query.get("priority") or 0)
+    except ValueError:
+        bottle.abort(412, "Priority must be an integer")
+    m = jc.start_job(cookie, priority)
     return to_json(m)
 
 
@@ -239,7 +422,7 @@ def job_status(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     m = jc.jobs[cookie]
-    return to_json(m)
+    return job_to_json(m)
 
 
 @app.route(common.routes.job_report)
@@ -289,7 +472,10 @@ def annotate_step(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
-    data = bottle.request.body.read(BOTTLE_MAX_READ_SIZE)  # @UndefinedVariable
+    # Annotations are parsed in memory, so keep them small
+    data = request_body(ANNOTATION_MAX_SIZE).read(ANNOTATION_MAX_SIZE + 1)
+    if len(data) > ANNOTATION_MAX_SIZE:
+        bottle.abort(413, "Annotation exceeds %d bytes" % ANNOTATION_MAX_SIZE)
     j.annotate(data)
 
 
@@ -310,11 +496,9 @@ def get_job_testsuite_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     t = jc.jobs[cookie].testsuite
-    r = t.get_archive()
-    if not r:
+    if not t:
         bottle.abort(404, 'No testsuite for %s' % (cookie))
-
-    return r.getvalue()
+    return send_testsuite_archive(t)
 
 
 @app.route(common.routes.job_artifacts)
@@ -331,8 +515,9 @@ def get_artifacts_archive(cookie):
     if cookie not in jc.jobs:
         bottle.abort(404, "Unknown job '%s'" % cookie)
     j = jc.jobs[cookie]
-    bottle.response.content_type = "application/x-bzip2"
-    return j.get_artifacts_archive().getvalue()
+    codec, level = requested_archive_codec()
+    bottle.response.content_type = codec.mimetype
+    return j.get_artifacts_archive(codec.name, level)
 
 
 @app.route(common.routes.job_artifact, method='PUT')
@@ -342,8 +527,8 @@ def add_artifact(cookie, name):
     if "/" in name:
         bottle.abort(412, "Name may not contain slashes")
     j = jc.jobs[cookie]
-    data = bottle.request.body.read(BOTTLE_MAX_READ_SIZE)  # @UndefinedVariable
-    j.add_artifact_to_current_step(name, data)
+    receive_request_body(lambda src, **kwargs:
+                         j.add_artifact_to_current_step(name, src, **kwargs))
 
 
 @app.route(common.routes.job_artifact)
@@ -391,7 +576,8 @@ def get_bootstrap_script(cookie):
     r = Template(script).safe_substitute(
         igor_cookie=cookie,
         igor_current_step=jc.jobs[cookie].current_step,
-        igor_testsuite=jc.jobs[cookie].testsuite.name
+        igor_testsuite=jc.jobs[cookie].testsuite.name,
+        igor_archive_codec=ARCHIVE_CODEC
     )
 
     if not r:
@@ -430,11 +616,7 @@ def get_testsuite_archive(name, tarball="testsuite.tar"):
     if name not in testsuites:
         bottle.abort(404, "Unknown testsuite '%s'" % name)
     t = testsuites[name]
-    r = t.get_archive()
-    if not r:
-        bottle.abort(404, 'No testsuite for %s' % (name))
-    bottle.response.content_type = "application/x-tar; charset=binary"
-    return r.getvalue()
+    return send_testsuite_archive(t)
 
 
 @app.route(common.routes.testplans)
@@ -477,11 +659,39 @@ def status_plans(name):
     return to_json(r)
 
 
+# The junit report fragments of jobs, reused for the reports of running
+# plans, so only the fragments of changed jobs need to be rendered
+_job_junit_fragments = weakref.WeakKeyDictionary()
+
+
+def job_junit_fragment(j):
+    key = job_cache_key(j)
+    cached = _job_junit_fragments.get(j)
+    if cached is None or cached[0] != key:
+        fragment = reports.job_status_to_junit_fragment(j.__to_dict__())
+        cached = (key, fragment)
+        _job_junit_fragments[j] = cached
+    return cached[1]
+
+
+def job_report_summary(j):
+    """The fields of a job used in the plain testplan report
+    """
+    return {"id": j.cookie,
+            "state": j.state(),
+            "runtime": j.runtime(),
+            "timeout": j.timeout()}
+
+
 @app.route(common.routes.testplan_report)
 def testplan_report(name):
     if name not in inventory.plans():
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.status_plan(name)
+    worker = jc.plan_worker(name)
+    if worker:
+        r = worker.__to_dict__(job_report_summary)
+    else:
+        r = jc.status_plan(name)
     bottle.response.content_type = "text/plain; charset=utf8"
     return str(reports.testplan_status_to_report(r))
 
@@ -490,9 +700,14 @@ def testplan_report(name):
 def testplan_junit_report(name):
     if name not in inventory.plans():
         bottle.abort(404, "Unknown plan: %s" % name)
-    r = jc.status_plan(name)
+    worker = jc.plan_worker(name)
+    if worker:
+        fragments = [job_junit_fragment(j) for j in list(worker.jobs)]
+        xml = reports.testplan_fragments_to_junit_report(name, fragments)
+    else:
+        r = jc.status_plan(name)
+        xml = reports.testplan_status_to_junit_report(r)
     bottle.response.content_type = "application/xml; charset=utf8"
-    xml = reports.testplan_status_to_junit_report(r)
     return reports.to_xml_str(xml)
 
 
@@ -542,26 +757,44 @@ def testcase_source(suitename, setname, casename):
 
 @app.route(common.routes.profile, method='PUT')
 def profile_from_vmlinuz_put(pname):
+    """Create a profile from a tarball with the kernel, initrd and kargs.
+    The tarball is streamed, each file is written once into the blob store
+    and linked from there. An optional X-Checksum-Sha256 header is
+    verified against the tarball, the sha256 of the received tarball is
+    sent back in the X-Checksum-Sha256 header of the reply.
+    """
     reqfiles = set(["kernel", "initrd", "kargs"])
-    _tmpdir = utils.TemporaryDirectory()
-    with _tmpdir as tmpdir:
+    arcnames = dict((os.path.basename(bottle.request.headers.get(
+        "x-%s-filename" % rf, rf)), rf) for rf in reqfiles)
+    digest = bottle.request.headers.get("X-Checksum-Sha256")
+    src = utils.HashingReader(request_body(PROFILE_MAX_READ_SIZE), "sha256")
+
+    blobs = blobstore.BlobStore(config.BLOB_STORE_DIR)
+    added = []
+    tmpdir = tempfile.mkdtemp(prefix="igor-profile-", dir=config.TMP_DIR)
+    try:
         logger.debug("Using PUT tmpdir %s" % tmpdir)
-        with tarfile.open(fileobj=bottle.request.body) as tarball:
-            arcfiles = tarball.getnames()
-            logger.debug("PUT %s" % arcfiles)
-            for arcfile in arcfiles:
-                assert os.path.basename(arcfile) == arcfile, \
-                    "not paths allowed"
-            tarball.extractall(path=tmpdir)
         written_files = {}
-        for rf in reqfiles:
-            fn = rf
-            header = "x-%s-filename" % rf
-            if header in bottle.request.headers:
-                fn = bottle.request.headers[header]
-            _tmpdir.cleanfile(fn)
-            written_files[rf] = os.path.join(tmpdir, os.path.basename(fn))
-        print written_files
+        with tarfile.open(fileobj=src, mode="r|*") as tarball:
+            for member in tarball:
+                logger.debug("PUT %s" % member.name)
+                if os.path.basename(member.name) != member.name:
+                    bottle.abort(412, "No paths allowed: %s" % member.name)
+                if member.name not in arcnames or not member.isfile():
+                    continue
+                rf = arcnames[member.name]
+                written_files[rf] = os.path.join(tmpdir, rf)
+                added.append(blobs.add_stream(tarball.extractfile(member),
+                                              written_files[rf]))
+        # The end of the tarball
+        while src.read(archive.BUFSIZE):
+            pass
+
+        if digest and src.hexdigest() != digest.lower():
+            bottle.abort(412, "sha256 mismatch, expected %s, got %s" %
+                              (digest, src.hexdigest()))
+        # Lets the client verify the upload without a second pass
+        bottle.response.set_header("X-Checksum-Sha256", src.hexdigest())
         if not all([r in written_files.keys() for r in reqfiles]):
             bottle.abort(412, "Expecting %s files" % str(reqfiles))
 
@@ -569,7 +802,13 @@ def profile_from_vmlinuz_put(pname):
         inventory.create_profile(oname=origin_to_use,
                                  pname=pname,
                                  **written_files)
-    _tmpdir.clean()
+    except tarfile.TarError as e:
+        bottle.abort(412, "Invalid tarball: %s" % e)
+    finally:
+        shutil.rmtree(tmpdir)
+        # Blobs which the profile didn't link are removed again
+        for blob in added:
+            blobs.release(blob)
 
 
 @app.route(common.routes.profile_set_kernelargs, method='GET')
@@ -609,9 +848,95 @@ def get_log():
     bottle.response.content_type = "text/plain; charset=utf8"
     return log.backlog()
 
+
+@app.route(common.routes.server_stats)
+def get_stats():
+    stats = {}
+    backends = set(host_backends + profile_backends + testsuite_backends +
+                   plan_backends)
+    for backend in backends:
+        if hasattr(backend, "stats"):
+            stats[backend.__name__] = backend.stats()
+    stats["jobcenter"] = jc.stats()
+    return to_json(stats)
+
+
+SERVER_CONFIG = CONFIG["daemon"].get("server") or {}
+SERVER_WORKERS = SERVER_CONFIG.get("workers") or 16
+
+EVENTS_MAX_TIMEOUT = 60
+# Each event stream occupies one of the server's threads, so only some of
+# them may be used for streams. Streams are ended after a while, clients
+# reconnect using Last-Event-ID.
+EVENTS_MAX_STREAMS = max(1, SERVER_WORKERS // 4)
+EVENTS_STREAM_DURATION = 300
+event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+
+@app.route(common.routes.events)
+def get_events():
+    """The state changes of jobs and plans.
+    By default this is a long-poll, it returns as soon as there are events
+    following the event ?since=<id>, or after ?timeout=<seconds>.
+    Clients accepting text/event-stream get a stream of server-sent events,
+    which can be resumed using the Last-Event-ID header.
+    The events can be limited to a ?job=<cookie> or ?plan=<name>.
+    """
+    query = bottle.request.query
+    since = query.get("since") or \
+        bottle.request.headers.get("Last-Event-ID") or None
+    try:
+        since = int(since) if since is not None else None
+        timeout = float(query.get("timeout") or 30)
+    except ValueError as e:
+        bottle.abort(412, "Invalid parameter: %s" % e)
+    timeout = max(0, min(timeout, EVENTS_MAX_TIMEOUT))
+
+    filters = dict((k, query[k]) for k in ["job", "plan"] if query.get(k))
+
+    def predicate(event):
+        return all(event.get(k) == v for k, v in filters.items())
+
+    if "text/event-stream" in bottle.request.headers.get("Accept", ""):
+        if not event_streams.acquire(False):
+            bottle.response.set_header("Retry-After", "10")
+            bottle.abort(503, "Too many event streams, use long-polling")
+        bottle.response.content_type = "text/event-stream"
+        bottle.response.set_header("Cache-Control", "no-cache")
+        return event_stream(since, predicate)
+
+    events, last_id, missed = jc.events.since(since, timeout, predicate)
+    return to_json({"events": events, "last_id": last_id, "missed": missed})
+
+
+def event_stream(last_id, predicate, keepalive=15,
+                 duration=EVENTS_STREAM_DURATION):
+    """Yields the events as server-sent events, a reset event is sent if
+    events were missed. The stream ends after duration seconds, and
+    releases its slot in event_streams.
+    """
+    end = time.time() + duration
+    try:
+        while time.time() < end:
+            events, last_id, missed = jc.events.since(last_id, keepalive,
+                                                      predicate)
+            if missed:
+                yield "id: %d\nevent: reset\ndata: {}\n\n" % last_id
+            for event in events:
+                yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+                    event["id"], event["type"],
+                    json.dumps(event, cls=IgordJSONEncoder))
+            if not events and not missed:
+                # A comment, to notice when the client is gone
+                yield ": keepalive\n\n"
+    finally:
+        event_streams.release()
+
 if __name__ == "__main__":
     try:
     #    logger.info("Starting igord")
-        bottle.run(app, host='0.0.0.0', port=8080, reloader=False)
+        bottle.run(app, host='0.0.0.0', port=8080, reloader=False,
+                   server=PooledWSGIRefServer, workers=SERVER_WORKERS)
     except KeyboardInterrupt:
         logger.debug("Ending igor")
+    job_store.close()
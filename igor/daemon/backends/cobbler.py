@@ -121,9 +121,13 @@ class HostsOrigin(main.Origin):
                 host.name = sysname
                 host.origin = self
                 try:
-                    host.mac = remote.system(sysname)["mac_address_eth0"]
+                    system = remote.system(sysname)
+                    host.mac = system["mac_address_eth0"]
                 except:
+                    system = {}
                     host.mac = ""
+                # The management classes are used as host labels
+                host.labels = system.get("mgmt_classes") or []
                 items[sysname] = host
 #        logger.debug("Number of cobbler hosts: %s" % len(items))
 #        logger.debug("Hosts: %s" % items)
@@ -20,6 +20,7 @@
 
 from igor import log, utils
 from igor.daemon import main
+import copy
 import glob
 import os
 import tarfile
@@ -54,6 +55,12 @@ def initialize_origins(category, CONFIG):
     return origins
 
 
+def stats():
+    """Returns statistics about the parsed objects cache
+    """
+    return {"cache": Factory.cache.stats()}
+
+
 class Host(main.Host):
     """Represents a real server.
     Wich is currently just specified by a name and it's MAC address.
@@ -194,8 +201,24 @@ class Factory(utils.Factory):
     """A factory to build testing objects from different structures.
     The current default structure is a file/-system based approach.
     Files provide enough informations to build testsuites.
+
+    Parsed testsuites and testsets are kept in a cache, an entry is reparsed
+    once one of the files it was built from changes.
     """
 
+    cache = utils.StatCache()
+
+    @staticmethod
+    def _glob(path, pattern):
+        """A glob which is only redone if the directory changed
+        """
+        key = ("glob", path, pattern)
+        filenames = Factory.cache.lookup(key)
+        if filenames is None:
+            filenames = glob.glob(os.path.join(path, pattern))
+            Factory.cache.store(key, filenames, [path])
+        return list(filenames)
+
     @staticmethod
     def testplan_from_file(filename, suffix=".plan"):
         """Builds a Testplan from a testplan file.
@@ -205,6 +228,7 @@ class Factory(utils.Factory):
         A sample tesplan could look like:
             --- # Testplan properties
             description: A simple plan
+            parallel: 2
 
             # Now the jobs
             ---
@@ -213,6 +237,10 @@ class Factory(utils.Factory):
             host: 'default-libvirt'
             additional_kargs: 'foo'
             ---
+            depends_on_previous: True
+            testsuite: 'basic_tui_installation'
+            profile: '{profile_pri}'
+            host: 'default-libvirt'
         """
         documents = Factory.__read_yaml(filename)
         layout_fields = ["testsuite", "profile", "host"]  # kargs
@@ -278,8 +306,7 @@ class Factory(utils.Factory):
         if not os.path.exists(path):
             raise RuntimeError("Testsuites path does not exist: %s" % path)
         suites = {}
-        pat = os.path.join(path, "*%s" % suffix)
-        for f in glob.glob(pat):
+        for f in Factory._glob(path, "*%s" % suffix):
             suite = Factory.testsuite_from_file(f)
             suites[suite.name] = suite
         return suites
@@ -319,8 +346,26 @@ class Factory(utils.Factory):
             sets:
               - 'example.set'
               - 'selinux.set'
+
+        >>> fn = "testcases/suites/examplesuite.suite"
+        >>> a = Factory.testsuite_from_file(fn)
+        >>> b = Factory.testsuite_from_file(fn)
+        >>> a is not b and a.testsets is b.testsets
+        True
         """
+        key = ("testsuite", filename, suffix)
+        suite = Factory.cache.lookup(key)
+        if suite is None:
+            suite, filenames = Factory.__testsuite_from_file(filename, suffix)
+            Factory.cache.store(key, suite, filenames)
+        # Plans can update the properties of a suite, so hand out a copy
+        return copy.copy(suite)
 
+    @staticmethod
+    def __testsuite_from_file(filename, suffix):
+        """Parses a testsuite file and returns the suite and all files
+        involved
+        """
         documents = Factory.__read_yaml(filename)
 #        set_fields = ["sets"]  # searchpath
 
@@ -328,6 +373,7 @@ class Factory(utils.Factory):
                               [d for d in documents[1:] if d is not None])
 
         sets = []
+        filenames = [filename]
         testsuitedir = os.path.dirname(filename)
         for block in blocks:
             searchpath = "."
@@ -338,12 +384,13 @@ class Factory(utils.Factory):
                 tsetfn = os.path.relpath(os.path.realpath(tsetfn))
                 testset = Factory.testset_from_file(tsetfn)
                 sets.append(testset)
+                filenames.append(tsetfn)
 
         name = os.path.basename(filename).replace(suffix, "")
         suite = main.Testsuite(name=name, testsets=sets)
         suite.__dict__.update(properties)
 
-        return suite
+        return suite, filenames
 
     @staticmethod
     def testset_from_file(filename, suffix=".set"):
@@ -364,6 +411,15 @@ class Factory(utils.Factory):
             ---
 
         """
+        key = ("testset", filename, suffix)
+        testset = Factory.cache.lookup(key)
+        if testset is None:
+            testset = Factory.__testset_from_file(filename, suffix)
+            Factory.cache.store(key, testset, [filename])
+        return testset
+
+    @staticmethod
+    def __testset_from_file(filename, suffix):
         testsetdir = os.path.dirname(filename)
         documents = Factory.__read_yaml(filename)
 
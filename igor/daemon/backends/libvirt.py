@@ -18,20 +18,45 @@
 #
 # -*- coding: utf-8 -*-
 
-from igor import log
-from igor.daemon import main, partition
+from __future__ import absolute_import
+from igor import log, utils
+from igor.daemon import blobstore, config, main, partition
 from igor.daemon.partition import DiskImage, Partition
 from igor.utils import run, dict_to_args
 from lxml import etree
+import collections
+import hashlib
 import os
 import re
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+
+try:
+    import libvirt as bindings
+except ImportError:
+    bindings = None
+if bindings is not None and bindings.__name__ == __name__:
+    # This module itself, when it is imported by its path (e.g. doctest)
+    bindings = None
 
 
 logger = log.getLogger(__name__)
 
+_libvirt_errors = (bindings.libvirtError,) if bindings else ()
+
+
+def stats():
+    return {"connections": connections.stats(),
+            "base_images": base_images.stats(),
+            "boot_isos": LibvirtProfile.boot_iso_stats(),
+            "profile_blobs": LibvirtProfile.blobs().stats(),
+            "volume_lists": volume_lists.stats(),
+            "domain_xmls": domain_xmls.stats()}
+
 
 def initialize_origins(category, CONFIG):
     origins = []
@@ -39,10 +64,14 @@ def initialize_origins(category, CONFIG):
     __con_args = (CONFIG["connection_uri"],
                   CONFIG["virt-install"]["storage_pool"],
                   CONFIG["virt-install"]["network_configuration"])
+    host_labels = (CONFIG.get("hosts") or {}).get("labels", ["libvirt"])
+
+    cleanup_volumes(LibvirtConnection(CONFIG["connection_uri"]))
 
     if category == "host":
         origins += [("libvirt-create",
-                     CreateDomainHostOrigin(*__con_args)),
+                     CreateDomainHostOrigin(*__con_args,
+                                            labels=host_labels)),
                     ("libvirt-existing",
                      ExistingDomainHostOrigin(*__con_args))]
 
@@ -68,23 +97,325 @@ class VMImage(partition.Layout):
         self.format = dst_fmt
 
 
+_cleaned_up = set()
+
+
+def cleanup_volumes(connection):
+    """Deletes the volumes igor left behind when it was stopped, like the
+    temporary volumes of interrupted uploads and the boot ISOs which are
+    not attached to a domain anymore. This is done once per connection,
+    when igord starts.
+    Another igord using the same storage pool must not be uploading at the
+    same time.
+    """
+    key = (connection.connection_uri, connection.poolname)
+    if key in _cleaned_up:
+        return
+    _cleaned_up.add(key)
+    try:
+        volnames = connection.volume_list()
+        attached = connection.attached_volumes()
+    except Exception as e:
+        logger.warning("Can not clean up volumes of %s: %s" %
+                       (connection.connection_uri, e))
+        return
+    for volname in volnames:
+        if connection.is_partial_volume(volname):
+            logger.info("Removing partial volume %s" % volname)
+            connection.delete_volume(volname)
+        elif volname.startswith(LibvirtProfile.volume_prefix) and \
+                volname not in attached:
+            logger.info("Removing unused boot volume %s" % volname)
+            connection.delete_volume(volname)
+
+
+class VolumeCache(object):
+    """Keeps volumes which are expensive to create in the storage pool.
+    The volumes are named after the digest of their contents, so they are
+    also reused after a restart. A volume is only published once it was
+    uploaded completely, see LibvirtConnection.publish_volume.
+    """
+    hits = 0
+    misses = 0
+
+    _lock = None
+    _volume_locks = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._volume_locks = {}
+
+    def volume(self, connection, volname, build):
+        """Returns volname, the volume is created if it doesn't exist yet
+
+        Args:
+            connection: The LibvirtConnection of the pool to use
+            volname: The name of the volume
+            build: A function returning a local DiskImage with the contents
+                   of the volume, the file is removed after the upload
+        """
+        key = (connection.connection_uri, connection.poolname, volname)
+        with self._lock:
+            volume_lock = self._volume_locks.setdefault(key,
+                                                        threading.Lock())
+
+        # Other callers of the same volume wait until it exists
+        with volume_lock:
+            if volname in connection.volume_list():
+                self.hits += 1
+                return volname
+
+            self.misses += 1
+            logger.info("Creating volume %s" % volname)
+            image = build()
+            try:
+                connection.publish_volume(image, volname)
+            finally:
+                if os.path.exists(image.filename):
+                    os.remove(image.filename)
+        return volname
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses}
+
+
+class BaseImageCache(VolumeCache):
+    """Keeps prepared base images as volumes in the storage pool.
+    A base image is created (partitioned, compressed and uploaded) once per
+    layout, hosts get a copy-on-write overlay of it.
+    Base volumes of layouts which are not used anymore need to be deleted
+    manually.
+    """
+    volume_prefix = "igor-base-"
+
+    def volname(self, image):
+        """The name of the base volume for a layout
+
+        >>> c = BaseImageCache()
+        >>> a = VMImage("8G", [Partition("pri", "1M", "1G")])
+        >>> b = VMImage("8G", [Partition("pri", "1M", "1G")])
+        >>> c.volname(a) == c.volname(b)
+        True
+        >>> c.volname(a).startswith("igor-base-")
+        True
+        """
+        return "%s%s.qcow2" % (self.volume_prefix, image.digest()[:16])
+
+    def base_volume(self, connection, image, workdir):
+        """Returns the name of the base volume for a layout, it is created
+        if it doesn't exist yet
+
+        Args:
+            connection: The LibvirtConnection of the pool to use
+            image: The VMImage describing the layout
+            workdir: Where the image can be created locally
+        """
+        def build():
+            base = VMImage(image.size, image.partitions, image.label)
+            base.create(workdir)
+            try:
+                base.compress()
+            except:
+                base.remove()
+                raise
+            return base
+        return self.volume(connection, self.volname(image), build)
+
+
+base_images = BaseImageCache()
+
+
+class ConnectionPool(object):
+    """Keeps one libvirt connection per URI, shared by all threads (libvirt
+    connections are thread-safe), and the latency of the calls made through
+    LibvirtConnection.
+    A connection is opened again if it died. Without the libvirt bindings
+    there are no connections, virsh is used instead.
+
+    >>> pool = ConnectionPool()
+    >>> pool.record("vol-list", 0.5)
+    >>> pool.record("vol-list", 0.25, failed=True)
+    >>> s = pool.stats()["calls"]["vol-list"]
+    >>> s["calls"], s["failures"], s["mean_latency"], s["max_latency"]
+    (2, 1, 0.375, 0.5)
+    """
+    _connections = None
+    _lock = None
+    _stats = None
+    _stats_lock = None
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def get(self, uri):
+        """Returns an open connection to uri, None if the bindings are not
+        available
+        """
+        if bindings is None:
+            return None
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is not None:
+                try:
+                    if conn.isAlive():
+                        return conn
+                except bindings.libvirtError:
+                    pass
+                logger.info("Connection to %s died, reconnecting" % uri)
+            logger.debug("Opening connection to %s" % uri)
+            conn = bindings.open(uri)
+            self._connections[uri] = conn
+            return conn
+
+    def record(self, operation, latency, failed=False):
+        with self._stats_lock:
+            stats = self._stats.setdefault(operation, {"calls": 0,
+                                                       "failures": 0,
+                                                       "total_latency": 0,
+                                                       "max_latency": 0})
+            stats["calls"] += 1
+            stats["failures"] += 1 if failed else 0
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def stats(self):
+        with self._lock:
+            uris = sorted(self._connections.keys())
+        with self._stats_lock:
+            calls = dict((name, dict(s, mean_latency=s["total_latency"] /
+                                     s["calls"]))
+                         for name, s in self._stats.items())
+        return {"bindings": bindings is not None,
+                "connections": uris,
+                "calls": calls}
+
+
+connections = ConnectionPool()
+
+# Parsed results of vol-list and dumpxml, keyed by (uri, pool or domain),
+# our own changes invalidate them
+volume_lists = utils.ExpiringCache(ttl=10)
+domain_xmls = utils.ExpiringCache(ttl=10)
+
+
 class LibvirtConnection(object):
+    """Runs operations on a libvirt connection.
+    The libvirt bindings and a pooled connection are used if the bindings
+    are available, otherwise a virsh process is spawned for each call.
+    Like with virsh, failing operations are logged but not raised, unless
+    noted otherwise.
+
+    The test:///default URI can be used to try this without a hypervisor,
+    the state of the test driver is kept as long as the pooled connection
+    lives (but not between virsh calls).
+    """
     connection_uri = None
     poolname = "default"
 
+    # Volumes are uploaded under a temporary name with this suffix
+    partial_suffix = ".partial"
+
     def __init__(self, connection_uri):
         self.connection_uri = connection_uri
 
-    def virsh(self, cmd):
-        return LibvirtConnection._virsh(cmd, self.connection_uri)
+    def virsh(self, cmd, with_retval=False):
+        return LibvirtConnection._virsh(cmd, self.connection_uri,
+                                        with_retval)
 
     @staticmethod
-    def _virsh(cmd, connection_uri):
-        return run("LC_ALL=C virsh --connect='%s' %s" % (connection_uri, cmd))
+    def _virsh(cmd, connection_uri, with_retval=False):
+        return run("LC_ALL=C virsh --connect='%s' %s" % (connection_uri, cmd),
+                   with_retval=with_retval)
+
+    def call(self, operation, via_bindings, virsh_cmd, checked=False):
+        """Run an operation
+
+        Args:
+            operation: The name of the operation, for the stats
+            via_bindings: A function taking a libvirt connection
+            virsh_cmd: The virsh command doing the same
+            checked: Return if the operation succeeded instead
+        Returns:
+            What via_bindings or virsh returned, None if it failed
+        """
+        started_at = time.time()
+        failed = False
+        try:
+            conn = connections.get(self.connection_uri)
+            if conn is None:
+                if not checked:
+                    return self.virsh(virsh_cmd)
+                retval, output = self.virsh(virsh_cmd, with_retval=True)
+                failed = retval != 0
+                if failed:
+                    logger.warning("%s on %s failed: %s" %
+                                   (operation, self.connection_uri, output))
+                return not failed
+            result = via_bindings(conn)
+            return True if checked else result
+        except _libvirt_errors as e:
+            failed = True
+            logger.warning("%s on %s failed: %s" % (operation,
+                                                    self.connection_uri, e))
+            if checked:
+                return False
+        finally:
+            connections.record(operation, time.time() - started_at, failed)
+
+    def domain_call(self, operation, name, via_bindings, virsh_cmd):
+        """Like call(), but via_bindings takes the libvirt domain name
+        """
+        try:
+            return self.call(operation,
+                             lambda conn: via_bindings(
+                                 conn.lookupByName(name)),
+                             virsh_cmd)
+        finally:
+            if operation != "dumpxml":
+                self.domain_changed(name)
+
+    def domain_xml(self, name):
+        """Returns the parsed definition of a domain, it is cached for a
+        short time
+        """
+        def query():
+            data = self.domain_call("dumpxml", name,
+                                    lambda d: d.XMLDesc(0),
+                                    "dumpxml '%s'" % name)
+            # Like before, this raises an XMLSyntaxError if the domain is gone
+            return etree.XML(data or "")
+        return domain_xmls.get((self.connection_uri, name), query)
+
+    def domain_changed(self, name):
+        domain_xmls.invalidate((self.connection_uri, name))
+
+    def volumes_changed(self):
+        volume_lists.invalidate((self.connection_uri, self.poolname))
+
+    def _pool(self, conn):
+        return conn.storagePoolLookupByName(self.poolname)
+
+    def _vol(self, conn, volname):
+        return self._pool(conn).storageVolLookupByName(volname)
 
     def volume_list(self):
-        data = self.virsh("vol-list --pool " +
-                          "'{pool}'".format(pool=self.poolname))
+        """Returns the names of the volumes in the pool, the list is cached
+        for a short time
+        """
+        key = (self.connection_uri, self.poolname)
+        return list(volume_lists.get(key, self._volume_list))
+
+    def _volume_list(self):
+        data = self.call("vol-list",
+                         lambda conn: self._pool(conn).listVolumes(),
+                         "vol-list --pool " +
+                         "'{pool}'".format(pool=self.poolname))
+        if isinstance(data, list):
+            return data
         assert data
 
         vols = []
@@ -93,6 +424,21 @@ class LibvirtConnection(object):
             vols.append(vol)
         return vols
 
+    def _create_volume_xml(self, volname, capacity, fmt,
+                           backing_volname=None):
+        vol = etree.Element("volume")
+        etree.SubElement(vol, "name").text = volname
+        etree.SubElement(vol, "capacity", unit="bytes").text = \
+            str(partition.size_to_bytes(capacity))
+        target = etree.SubElement(vol, "target")
+        etree.SubElement(target, "format", type=fmt)
+        if backing_volname:
+            backing = etree.SubElement(vol, "backingStore")
+            etree.SubElement(backing, "path").text = \
+                self.volume_path(backing_volname)
+            etree.SubElement(backing, "format", type=fmt)
+        return etree.tostring(vol)
+
     def create_volume(self, image, volname=None):
         """Create a volume on the server side and populate it
 
@@ -109,26 +455,148 @@ class LibvirtConnection(object):
         volname = volname or os.path.basename(disk)
         poolvol = "%s/%s" % (self.poolname, volname)
         if volname not in self.volume_list():
-            logger.debug("Creating volume")
-            self.virsh(("vol-create-as --name '%s' --capacity '%s' " +
-                        "--format '%s' --pool '%s'") %
-                       (volname, image.size, image.format, self.poolname))
+            self._create_empty_volume(volname, image)
         logger.debug("Uploading disk image '%s' to volume '%s'" %
                      (disk, poolvol))
         self.upload_volume(volname, disk)
         return poolvol
 
-    def upload_volume(self, volname, filename):
+    def _create_empty_volume(self, volname, image):
+        logger.debug("Creating volume")
+        xml = self._create_volume_xml(volname, image.size, image.format)
+        self.call("vol-create-as",
+                  lambda conn: self._pool(conn).createXML(xml, 0),
+                  ("vol-create-as --name '%s' --capacity '%s' " +
+                   "--format '%s' --pool '%s'") %
+                  (volname, image.size, image.format, self.poolname))
+        self.volumes_changed()
+
+    def upload_volume(self, volname, filename, offset=0):
         """Upload a file to a volume
 
         Args:
             volanme: Name of the volume on the server side
             filename: Filename of the local file to be uploaded
+            offset: Where to write the file into the volume
+        Returns:
+            True if the upload succeeded
+        """
+        length = os.path.getsize(filename)
+
+        def via_bindings(conn):
+            vol = self._vol(conn, volname)
+            stream = conn.newStream(0)
+            with open(filename, "rb") as src:
+                vol.upload(stream, offset, length, 0)
+                try:
+                    stream.sendAll(lambda s, nbytes, f: f.read(nbytes), src)
+                except:
+                    stream.abort()
+                    raise
+            stream.finish()
+        return self.call("vol-upload", via_bindings,
+                         ("vol-upload --vol '{vol}' --file '{file}' " +
+                          "--offset {offset} --length {length} " +
+                          "--pool '{pool}'").format(vol=volname,
+                                                    file=filename,
+                                                    offset=offset,
+                                                    length=length,
+                                                    pool=self.poolname),
+                         checked=True)
+
+    def clone_volume(self, volname, newname):
+        """Copy a volume on the server side
+
+        Args:
+            volname: Name of the volume to be copied
+            newname: Name of the copy
+        Returns:
+            True if the copy succeeded
         """
-        self.virsh(("vol-upload --vol '{vol}' --file '{file}' " +
-                    "--pool '{pool}'").format(vol=volname,
-                                              file=filename,
-                                              pool=self.poolname))
+        def via_bindings(conn):
+            vol = self._vol(conn, volname)
+            xml = etree.XML(vol.XMLDesc(0))
+            xml.find("name").text = newname
+            for element in ["key", "target/path"]:
+                node = xml.find(element)
+                if node is not None:
+                    node.getparent().remove(node)
+            self._pool(conn).createXMLFrom(etree.tostring(xml), vol, 0)
+        succeeded = self.call("vol-clone", via_bindings,
+                              ("vol-clone --vol '{vol}' --newname " +
+                               "'{new}' --pool '{pool}'").format(
+                                   vol=volname, new=newname,
+                                   pool=self.poolname),
+                              checked=True)
+        self.volumes_changed()
+        return succeeded
+
+    def publish_volume(self, image, volname):
+        """Create a volume on the server side and populate it, like
+        create_volume. The image is uploaded under a temporary name, which
+        is only copied to volname once the upload succeeded. So a volume
+        named volname is always complete, even if igord was interrupted.
+
+        Args:
+            image: DiskImage to be uploaded
+            volname: Name of the new volume
+        Returns:
+            The pool/volname on the server side
+        Raises:
+            RuntimeError if the volume could not be created
+        """
+        partial = volname + self.partial_suffix
+        if partial in self.volume_list():
+            self.delete_volume(partial)
+        try:
+            self._create_empty_volume(partial, image)
+            if partial not in self.volume_list():
+                raise RuntimeError("Creating volume %s failed" % partial)
+            if not self.upload_volume(partial, image.filename):
+                raise RuntimeError("Uploading '%s' to volume %s failed" %
+                                   (image.filename, partial))
+            if not self.clone_volume(partial, volname):
+                raise RuntimeError("Copying volume %s to %s failed" %
+                                   (partial, volname))
+        finally:
+            self.delete_volume(partial)
+        return "%s/%s" % (self.poolname, volname)
+
+    def is_partial_volume(self, volname):
+        """If volname is the temporary volume of an upload by igor
+
+        >>> c = LibvirtConnection("test:///default")
+        >>> c.is_partial_volume(BaseImageCache().volume_prefix +
+        ...                     "0123.qcow2.partial")
+        True
+        >>> c.is_partial_volume("igor-base-0123.qcow2")
+        False
+        """
+        return volname.startswith("igor-") and \
+            volname.endswith(self.partial_suffix)
+
+    def create_overlay(self, volname, backing_volname, capacity):
+        """Create a qcow2 volume on the server side, which only keeps the
+        changes to a backing volume
+
+        Args:
+            volname: Name of the new volume
+            backing_volname: Name of the qcow2 volume to be backed by
+            capacity: Size of the new volume
+        Returns:
+            The pool/volname on the server side
+        """
+        def via_bindings(conn):
+            xml = self._create_volume_xml(volname, capacity, "qcow2",
+                                          backing_volname)
+            return self._pool(conn).createXML(xml, 0)
+        self.call("vol-create-as", via_bindings,
+                  ("vol-create-as --name '%s' --capacity '%s' " +
+                   "--format qcow2 --backing-vol '%s' " +
+                   "--backing-vol-format qcow2 --pool '%s'") %
+                  (volname, capacity, backing_volname, self.poolname))
+        self.volumes_changed()
+        return "%s/%s" % (self.poolname, volname)
 
     def delete_volume(self, volname):
         """Delete a volume on the server side
@@ -136,9 +604,12 @@ class LibvirtConnection(object):
         Args:
             volname: Volume to be deleted
         """
-        self.virsh("vol-delete --vol " +
-                   "'{vol}' --pool '{pool}'".format(pool=self.poolname,
-                                                    vol=volname))
+        self.call("vol-delete",
+                  lambda conn: self._vol(conn, volname).delete(0),
+                  "vol-delete --vol " +
+                  "'{vol}' --pool '{pool}'".format(pool=self.poolname,
+                                                   vol=volname))
+        self.volumes_changed()
 
     def volume_path(self, volname):
         """Return the FS path 8server side) for the volume
@@ -148,9 +619,46 @@ class LibvirtConnection(object):
         Returns:
             The absolute pathname for the folume on the server
         """
-        return self.virsh(("vol-path --pool '{pool}' " +
-                           "{vol}").format(pool=self.poolname,
-                                           vol=volname))
+        return self.call("vol-path",
+                         lambda conn: self._vol(conn, volname).path(),
+                         ("vol-path --pool '{pool}' " +
+                          "{vol}").format(pool=self.poolname,
+                                          vol=volname))
+
+    def attached_volumes(self):
+        """Returns the names of the volumes used by the domains
+        """
+        volnames = set()
+        for name in self.list_domains():
+            try:
+                dom = self.domain_xml(name)
+            except etree.XMLSyntaxError:
+                # The domain is gone
+                continue
+            volnames.update(os.path.basename(f) for f in
+                            dom.xpath("/domain/devices/disk/source/@file"))
+        return volnames
+
+    def list_domains(self):
+        """Returns the names of all running or shut off domains
+        """
+        def via_bindings(conn):
+            states = [bindings.VIR_DOMAIN_RUNNING, bindings.VIR_DOMAIN_SHUTOFF]
+            return [d.name() for d in conn.listAllDomains(0)
+                    if d.state()[0] in states]
+        txt = self.call("list", via_bindings, "list --all")
+        if isinstance(txt, list):
+            return txt
+
+        domains = []
+        domain_pattern = re.compile("\s*(\d+|-)\s+([\w-]+)\s+(\w+.*$)")
+        for line in str(txt or "").split("\n"):
+            match = domain_pattern.search(line)
+            if match:
+                domid, domname, state = match.groups()
+                if state in ["running", "shut off"]:
+                    domains.append(domname)
+        return domains
 
 
 class VMHost(main.Host):
@@ -178,6 +686,11 @@ class VMHost(main.Host):
         assert self.connection_uri
         return self._connection.virsh(cmd)
 
+    def _domain_call(self, operation, via_bindings, virsh_cmd):
+        assert self.connection_uri
+        return self._connection.domain_call(operation, self.vm_name,
+                                            via_bindings, virsh_cmd)
+
     def start(self):
         self.boot()
 
@@ -185,20 +698,20 @@ class VMHost(main.Host):
         return self.vm_name
 
     def get_mac_address(self):
-        dom = etree.XML(self.dumpxml())
+        dom = self._connection.domain_xml(self.vm_name)
         mac = dom.xpath("/domain/devices/interface[1]/mac")[0]
         return mac.attrib["address"]
 
     def get_disk_images(self):
         path = ("/domain/devices/disk[@type='file' and @device='disk']" +
                 "/source/@file")
-        dom = etree.XML(self.dumpxml())
+        dom = self._connection.domain_xml(self.vm_name)
         files = dom.xpath(path)
         return files
 
     def __get_cdrom_target_name(self):
         path = ("/domain/devices/disk[@device='cdrom']/target/@dev")
-        dom = etree.XML(self.dumpxml())
+        dom = self._connection.domain_xml(self.vm_name)
         targets = dom.xpath(path)
         return sorted(targets)[0]
 
@@ -206,6 +719,7 @@ class VMHost(main.Host):
         """Set the <source file='...' /> of the first device which is a cdrom
         """
         target = self.__get_cdrom_target_name()
+        filename = None
         if volname:
             filename = self._connection.volume_path(volname)
             cmd = "change-media --domain %s --path %s --source %s --force" % \
@@ -214,7 +728,21 @@ class VMHost(main.Host):
             # Eject otherwise
             cmd = "change-media --domain %s --path %s --eject --force" % \
                 (self.vm_name, target)
-        self._virsh(cmd)
+
+        def via_bindings(dom):
+            path = ("/domain/devices/disk[@device='cdrom' and " +
+                    "target/@dev='%s']") % target
+            disk = etree.XML(dom.XMLDesc(0)).xpath(path)[0]
+            for source in disk.findall("source"):
+                disk.remove(source)
+            if filename:
+                disk.set("type", "file")
+                disk.insert(0, etree.Element("source", file=filename))
+            flags = (bindings.VIR_DOMAIN_AFFECT_CURRENT |
+                     bindings.VIR_DOMAIN_DEVICE_MODIFY_FORCE)
+            return dom.updateDeviceFlags(etree.tostring(disk), flags)
+
+        self._domain_call("change-media", via_bindings, cmd)
 
     def prepare(self):
         """There is nothing much to do
@@ -243,29 +771,38 @@ class VMHost(main.Host):
         self.undefine()
 
     def boot(self):
-        self._virsh("start %s" % self.vm_name)
+        self._domain_call("start", lambda d: d.create(),
+                          "start %s" % self.vm_name)
 
     def reboot(self):
-        self._virsh("reboot %s" % self.vm_name)
+        self._domain_call("reboot", lambda d: d.reboot(0),
+                          "reboot %s" % self.vm_name)
 
     def shutdown(self):
-        self._virsh("shutdown %s" % self.vm_name)
+        self._domain_call("shutdown", lambda d: d.shutdown(),
+                          "shutdown %s" % self.vm_name)
 
     def destroy(self):
-        self._virsh("destroy %s" % self.vm_name)
+        self._domain_call("destroy", lambda d: d.destroy(),
+                          "destroy %s" % self.vm_name)
 
     def define(self, definition):
         with tempfile.NamedTemporaryFile() as f:
             logger.debug(f.name)
             f.write(definition)
             f.flush()
-            self._virsh("define '%s'" % f.name)
+            self._connection.call("define",
+                                  lambda conn: conn.defineXML(definition),
+                                  "define '%s'" % f.name)
+        self._connection.domain_changed(self.vm_name)
 
     def undefine(self):
-        self._virsh("undefine %s" % self.vm_name)
+        self._domain_call("undefine", lambda d: d.undefine(),
+                          "undefine %s" % self.vm_name)
 
     def dumpxml(self):
-        return self._virsh("dumpxml '%s'" % self.vm_name)
+        return self._domain_call("dumpxml", lambda d: d.XMLDesc(0),
+                                 "dumpxml '%s'" % self.vm_name)
 
     def __eq__(self, other):
         """Override to allow simple comparisons
@@ -311,6 +848,10 @@ class NewVMHost(VMHost):
     '''
     image_specs = None
 
+    # Use overlays of cached base images instead of a fresh image per host
+    use_base_images = True
+    _base_volumes = None
+
     network_configuration = "network=default"
     disk_bus_type = "virtio"
 
@@ -330,11 +871,30 @@ class NewVMHost(VMHost):
         super(NewVMHost, self).__init__(name, connection_uri)
         self.custom_install_args = {}
         self.image_specs = image_specs
+        self._base_volumes = []
+
+    def get_name(self):
+        """The name of the VM, it is final (and unique) as soon as the host
+        is assigned to a job, so the scheduler can tell it apart from other
+        new VMs right away
+
+        >>> host = NewVMHost("default-{identifier}", [], "test:///default")
+        >>> host.get_name()
+        'default-{identifier}'
+        >>> class Session(object):
+        ...     cookie = "i123"
+        >>> host.session = Session()
+        >>> host.get_name()
+        'default-i-i123'
+        """
+        if self.session is None:
+            return self.vm_name
+        identifier = "%s%s" % (self.vm_prefix, self.session.cookie)
+        return self.vm_name.format(identifier=identifier)
 
     def prepare(self):
         logger.debug("Preparing a new VMHost")
-        identifier = "%s%s" % (self.vm_prefix, self.session.cookie)
-        self.vm_name = self.vm_name.format(identifier=identifier)
+        self.vm_name = self.get_name()
         self.prepare_images()
         self.prepare_vm()
 
@@ -342,6 +902,11 @@ class NewVMHost(VMHost):
         logger.debug("Preparing images")
         if self.image_specs is None or len(self.image_specs) is 0:
             logger.info("No image spec given.")
+        elif self.use_base_images:
+            self._base_volumes = [base_images.base_volume(self._connection,
+                                                          image_spec,
+                                                          self.session.dirname)
+                                  for image_spec in self.image_specs]
         else:
             for image_spec in self.image_specs:
                 image_spec.create(self.session.dirname)
@@ -381,18 +946,30 @@ class NewVMHost(VMHost):
         cmd = "virt-install "
         cmd += dict_to_args(virtinstall_args)
 
-        for image_spec in self.image_specs:
+        for n, image_spec in enumerate(self.image_specs):
             assert type(image_spec) is VMImage
-            image_spec.compress()
-            poolvol = self._connection.create_volume(image_spec)
+            if self.use_base_images:
+                poolvol = self._connection.create_overlay(
+                    "%s-disk%d.qcow2" % (self.vm_name, n),
+                    self._base_volumes[n], image_spec.size)
+                disk_format = "qcow2"
+            else:
+                image_spec.compress()
+                poolvol = self._connection.create_volume(image_spec)
+                disk_format = image_spec.format
             cmd += (" --disk vol=%s,device=disk,bus=%s,format=%s" %
-                    (poolvol, self.disk_bus_type, image_spec.format))
+                    (poolvol, self.disk_bus_type, disk_format))
 
         # FIXME this hack is needed because ivrt-install expects the
         # volume used for disks to exist!
-        self._connection.virsh(("vol-create-as --name '%s' " +
-                                "--capacity '0' --pool '%s'") %
-                               (dummyname, self._connection.poolname))
+        self._connection.call("vol-create-as",
+                              lambda conn: self._connection._pool(conn)
+                              .createXML(self._connection._create_volume_xml(
+                                  dummyname, "0", "raw"), 0),
+                              ("vol-create-as --name '%s' " +
+                               "--capacity '0' --pool '%s'") %
+                              (dummyname, self._connection.poolname))
+        self._connection.volumes_changed()
         # Now that all vols exist, create the domain
         definition = run(cmd)
         self._connection.delete_volume(dummyname)
@@ -403,10 +980,10 @@ class NewVMHost(VMHost):
         # Remove or local images (created initially)
         if self.image_specs is None or len(self.image_specs) is 0:
             logger.info("No image spec given.")
-        else:
+        elif not self.use_base_images:
             for image_spec in self.image_specs:
                 image_spec.remove()
-        # Now also remove the remote volumes
+        # Now also remove the remote volumes, the base volumes are kept
         super(NewVMHost, self).remove_images()
 
 
@@ -414,16 +991,24 @@ class CommonLibvirtOrigin(main.Origin):
     connection_uri = None
     storage_pool = None
     network_configuration = None
+    labels = None
 
-    def __init__(self, connection_uri, storage_pool, network_configuration):
+    def __init__(self, connection_uri, storage_pool, network_configuration,
+                 labels=None):
+        """
+        Args:
+            labels: The labels of the hosts of this origin
+        """
         self.connection_uri = connection_uri
         self.storage_pool = storage_pool
         self.network_configuration = network_configuration
+        self.labels = labels or []
 
     def __set_host_props(self, host):
         host.connection_uri = self.connection_uri
         host.storage_pool = self.storage_pool
         host.network_configuration = self.network_configuration
+        host.labels = list(self.labels)
 
     def _create_default_host(self):
         name = "default-{identifier}"
@@ -449,6 +1034,18 @@ class CommonLibvirtOrigin(main.Origin):
 
 
 class CreateDomainHostOrigin(CommonLibvirtOrigin):
+    """Provides a new VM for each job, so it can be selected by label
+
+    >>> origin = CreateDomainHostOrigin("test:///default", "default",
+    ...                                 "network=default",
+    ...                                 labels=["libvirt", "vm"])
+    >>> origin.items()["default-libvirt"].get_labels()
+    ['libvirt', 'vm']
+    >>> inventory = main.Inventory(hosts={"libvirt-create": origin})
+    >>> selector = inventory.hosts("label:vm")
+    >>> [h.get_name() for h in selector.candidates()]
+    ['default-{identifier}']
+    """
     def name(self):
         return "VMAlwaysCreateHostOrigin(%s)" % str(self.__dict__)
 
@@ -467,17 +1064,7 @@ class ExistingDomainHostOrigin(CommonLibvirtOrigin):
         return "VMExistingHostOrigin(%s)" % str(self.__dict__)
 
     def _list_domains(self):
-        domains = []
-        cmd = "list --all"
-        domain_pattern = re.compile("\s*(\d+|-)\s+([\w-]+)\s+(\w+.*$)")
-        txt = str(LibvirtConnection._virsh(cmd, self.connection_uri))
-        for line in txt.split("\n"):
-            match = domain_pattern.search(line)
-            if match:
-                domid, domname, state = match.groups()
-                if state in ["running", "shut off"]:
-                    domains.append(domname)
-        return domains
+        return LibvirtConnection(self.connection_uri).list_domains()
 
     def items(self):
         domains = self._list_domains()
@@ -488,16 +1075,113 @@ class ExistingDomainHostOrigin(CommonLibvirtOrigin):
         return hosts
 
 
+_file_digests = utils.StatCache()
+
+
+def file_digest(filename):
+    """The sha1 of the contents of a file, cached until the file changes
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write("kernel")
+    >>> f.flush()
+    >>> file_digest(f.name) == hashlib.sha1("kernel").hexdigest()
+    True
+    """
+    digest = _file_digests.lookup(filename)
+    if digest is None:
+        hasher = hashlib.sha1()
+        with open(filename, "rb") as src:
+            for data in iter(lambda: src.read(64 * 1024), ""):
+                hasher.update(data)
+        digest = _file_digests.store(filename, hasher.hexdigest(),
+                                     [filename])
+    return digest
+
+
+ISO_SECTOR_SIZE = 2048
+
+
+def iso_file_extent(filename, path):
+    """Returns the (offset, size) of a file within an ISO9660 image, None if
+    the image doesn't contain it.
+    The plain ISO9660 names are compared (as mkisofs writes them without
+    Rock Ridge or Joliet), case insensitive and without the version.
+
+    >>> import tempfile
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> f.write("no iso")
+    >>> f.flush()
+    >>> iso_file_extent(f.name, "isolinux/isolinux.cfg") is None
+    True
+    """
+    with open(filename, "rb") as iso:
+        def read(extent, size):
+            iso.seek(extent * ISO_SECTOR_SIZE)
+            return iso.read(size)
+
+        # The primary volume descriptor, with the root directory record
+        descriptor = read(16, ISO_SECTOR_SIZE)
+        if descriptor[:6] != "\x01CD001":
+            return None
+        extent, size = struct.unpack("<I4xI", descriptor[158:170])
+        for name in path.strip("/").lower().split("/"):
+            entries = dict((n, (e, s)) for n, e, s in
+                           _iso_directory(read(extent, size)))
+            if name not in entries:
+                return None
+            extent, size = entries[name]
+    return extent * ISO_SECTOR_SIZE, size
+
+
+def _iso_directory(data):
+    """Yields the (name, extent, size) of the records of an ISO9660
+    directory
+    """
+    pos = 0
+    while pos < len(data):
+        length = ord(data[pos])
+        if length == 0:
+            # Records don't cross sectors, the rest of this one is unused
+            pos = (pos // ISO_SECTOR_SIZE + 1) * ISO_SECTOR_SIZE
+            continue
+        record = data[pos:pos + length]
+        extent, size = struct.unpack("<I4xI", record[2:14])
+        name = record[33:33 + ord(record[32])]
+        yield name.split(";")[0].rstrip(".").lower(), extent, size
+        pos += length
+
+
+boot_isos = VolumeCache()
+
+
 class LibvirtProfile(main.Profile):
     """A kernel, initrd + kargs
     A libvirt profile is actually just a dict with kernel,initrd and kargs
     Assigning happens by populating the domain definition with this values
+
+    Building and uploading a boot ISO is expensive, so it's only done once
+    for each kernel, initrd and isolinux. The shared volume is named after
+    their digest, and used by all profiles and jobs with the same files.
+    Each host gets a server side copy of it, with its own isolinux.cfg
+    (kargs and cookie) written over the padded one of the shared ISO.
+    The copy of a host is deleted when the profile is revoked from it, the
+    shared volumes which are not used anymore are deleted besides the most
+    recent max_unused_volumes ones. Boot volumes which are not attached to
+    a domain are deleted when igord starts, see cleanup_volumes.
     """
 
     origin = None
 
     name = None
 
+    # Boot volumes are named <prefix><digest>-<offset>[-<kargs digest>].iso
+    volume_prefix = "igor-boot-"
+
+    # isolinux.cfg is padded to this size in the shared ISOs, the kernel
+    # cmdline is limited to far less
+    isolinux_cfg_size = 4096
+
     # FIXME
     _datadir_prefix = "/var/tmp/igor"
     _datadir = None
@@ -516,6 +1200,22 @@ class LibvirtProfile(main.Profile):
 
     _volname = None
 
+    max_unused_volumes = 4
+
+    # The extents of isolinux.cfg in the shared ISOs, by digest
+    __cfg_extents = {}
+    # (uri, pool, volname): [connection, copies in progress], LRU first
+    __shared_volumes = collections.OrderedDict()
+    __shared_lock = threading.Lock()
+
+    # host name: (connection, volname) of the copies attached to hosts
+    __host_volumes = None
+    __lock = None
+
+    # The files of the ISO root materialized from the blob store, and their
+    # digests
+    __blob_files = None
+
     def __init__(self, name):
         self.name = name
         self._datadir = os.path.join(self._datadir_prefix, self.name)
@@ -528,33 +1228,96 @@ class LibvirtProfile(main.Profile):
         self._boot_iso = os.path.join(self._datadir, "boot.iso")
 
         self.__created_files = []
+        self.__blob_files = {}
+        self.__host_volumes = {}
+        self.__lock = threading.RLock()
         super(LibvirtProfile, self).__init__()
 
+    @classmethod
+    def blobs(cls):
+        """The store for kernels and initrds, they are shared between all
+        profiles. isolinux.bin is copied, mkisofs writes the boot info
+        table into it when the ISO is built:
+
+        >>> tmpdir = tempfile.mkdtemp()
+        >>> defaults = (config.BLOB_STORE_DIR, LibvirtProfile._datadir_prefix,
+        ...             LibvirtProfile._LibvirtProfile__isolinux_bin)
+        >>> config.BLOB_STORE_DIR = os.path.join(tmpdir, "blobs")
+        >>> LibvirtProfile._datadir_prefix = os.path.join(tmpdir, "data")
+        >>> srcs = {}
+        >>> for name in ["isolinux.bin", "kernel", "initrd", "cmdline"]:
+        ...     srcs[name] = os.path.join(tmpdir, name)
+        ...     with open(srcs[name], "w") as src:
+        ...         _ = src.write(name)
+        >>> LibvirtProfile._LibvirtProfile__isolinux_bin = srcs["isolinux.bin"]
+        >>> profile = LibvirtProfile("doctest")
+        >>> profile.populate_with(srcs["kernel"], srcs["initrd"],
+        ...                       srcs["cmdline"])
+        >>> isolinux_bin = os.path.join(profile._isolinux_dir, "isolinux.bin")
+        >>> os.stat(isolinux_bin).st_nlink
+        1
+        >>> with open(isolinux_bin, "r+") as patched:  # Like mkisofs
+        ...     patched.seek(8)
+        ...     _ = patched.write("boot info")
+        >>> store = LibvirtProfile.blobs()
+        >>> [hashlib.sha1(open(store.blob_path(d)).read()).hexdigest() == d
+        ...  for d in store.digests()]
+        [True, True]
+        >>> open(srcs["isolinux.bin"]).read()
+        'isolinux.bin'
+        >>> profile.delete()
+        >>> store.digests()
+        []
+        >>> (config.BLOB_STORE_DIR, LibvirtProfile._datadir_prefix,
+        ...  LibvirtProfile._LibvirtProfile__isolinux_bin) = defaults
+        """
+        return blobstore.BlobStore(config.BLOB_STORE_DIR)
+
+    @classmethod
+    def boot_iso_stats(cls):
+        stats = boot_isos.stats()
+        stats["shared_volumes"] = len(cls.__shared_volumes)
+        return stats
+
     def get_name(self):
         return self.name
 
     def assign_to(self, host, additional_kargs=""):
         assert VMHost in host.__class__.mro()
 
-        self.__host = host
-        self.__additional_kargs = additional_kargs
+        with self.__lock:
+            self.__host = host
+            self.__additional_kargs = additional_kargs
 
-        self._volname = "%s-boot" % self.get_name()
-        self.__mkiso(additional_kargs)
-        self.__host.change_cdrom_source(self._volname)
+            self._volname = self.__host_volume(host, additional_kargs)
+            host.change_cdrom_source(self._volname)
+            self.__attach(host, self._volname)
 
     def revoke_from(self, host):
-        assert self.__host == host
         try:
-            self.__host.change_cdrom_source(None)
+            host.change_cdrom_source(None)
         except etree.XMLSyntaxError:
             logger.debug("Can' revoke profile from %s, might be deleted." %
                          host)
+        with self.__lock:
+            self.__attach(host, None)
+
+    def __attach(self, host, volname):
+        """Note that volname is now attached to host, the copy previously
+        attached to host is deleted
+        """
+        previous = self.__host_volumes.pop(host.get_name(), None)
+        if volname:
+            self.__host_volumes[host.get_name()] = (host._connection, volname)
+        if previous and previous[1] != volname:
+            connection, previous_volname = previous
+            logger.debug("Removing boot volume %s" % previous_volname)
+            connection.delete_volume(previous_volname)
 
     def kargs(self, kargs):
         """get or set kargs
         """
-        self.__mkiso(kargs)
+        self.assign_to(self.__host, kargs)
 
     def enable_pxe(self, host, enable):
         if enable:
@@ -567,7 +1330,14 @@ class LibvirtProfile(main.Profile):
             logger.debug("Removing %s" % filename)
             os.remove(filename)
         self.__created_files = []
-        self.__host._connection.delete_volume(self._volname)
+        for filename, digest in self.__blob_files.items():
+            logger.debug("Releasing %s" % filename)
+            self.blobs().release(digest, filename)
+        self.__blob_files = {}
+        with self.__lock:
+            for connection, volname in self.__host_volumes.values():
+                connection.delete_volume(volname)
+            self.__host_volumes.clear()
 
     def populate_with(self, kernel_file, initrd_file, kargs_file):
         self.__prepare_iso_root(kernel_file, initrd_file, kargs_file)
@@ -581,29 +1351,49 @@ class LibvirtProfile(main.Profile):
         if not os.path.isdir(self._isolinux_dir):
             os.mkdir(self._isolinux_dir)
 
-        # Copy isolinux
-        isolinuxbin_dst = os.path.join(self._isolinux_dir,
-                                       os.path.basename(self.__isolinux_bin))
-        logger.debug("Copying %s -> %s" % (self.__isolinux_bin,
-                                           isolinuxbin_dst))
-        shutil.copyfile(self.__isolinux_bin, isolinuxbin_dst)
+        # Copy isolinux, mkisofs -boot-info-table writes into it, so it
+        # must not be a link to a (shared) blob
+        dstfile = os.path.join(self._isolinux_dir,
+                               os.path.basename(self.__isolinux_bin))
+        logger.debug("Copying %s -> %s" % (self.__isolinux_bin, dstfile))
+        if os.path.lexists(dstfile):
+            # Don't write through a link
+            os.remove(dstfile)
+        shutil.copyfile(self.__isolinux_bin, dstfile)
+        if dstfile not in self.__created_files:
+            self.__created_files += [dstfile]
 
-        # Copy kernel+initrd
-        files = {"kernel": kernel_file, "initrd": initrd_file,
-                 "cmdline": cmdline_file}
+        # Link kernel+initrd from the blob store
+        files = {"kernel": kernel_file, "initrd": initrd_file}
         for component in files.keys():
             srcfilename = files[component]
             dstfile = os.path.join(self._isolinux_dir, component)
-            logger.debug("Copying %s -> %s" % (srcfilename, dstfile))
-            shutil.copyfile(srcfilename, dstfile)
+            logger.debug("Linking %s -> %s" % (srcfilename, dstfile))
+            try:
+                digest = self.blobs().materialize(srcfilename, dstfile)
+            except blobstore.CrossDeviceError as e:
+                logger.warning("Copying %s: %s" % (srcfilename, e))
+                shutil.copyfile(srcfilename, dstfile)
+                if dstfile not in self.__created_files:
+                    self.__created_files += [dstfile]
+                digest = None
+            previous = self.__blob_files.pop(dstfile, None)
+            if digest:
+                self.__blob_files[dstfile] = digest
+            if previous not in [None, digest]:
+                # The profile was populated before with another file
+                self.blobs().release(previous)
+
+        # Copy the cmdline, it differs between the profiles
+        dstfile = os.path.join(self._isolinux_dir, "cmdline")
+        logger.debug("Copying %s -> %s" % (cmdline_file, dstfile))
+        shutil.copyfile(cmdline_file, dstfile)
+        if dstfile not in self.__created_files:
             self.__created_files += [dstfile]
 
-    def __mkiso(self, additional_kargs):
-        """This is a hack as long as igor doesn't use isos directly
-        http://www.syslinux.org/wiki/index.php/ISOLINUX
+    def __isolinux_cfg(self, host, additional_kargs):
+        """The isolinux.cfg booting host with the kargs of this profile
         """
-        assert self.__host
-
         cmdlinefile = os.path.join(self._isolinux_dir, "cmdline")
 
         with open(cmdlinefile) as cmdline:
@@ -611,23 +1401,130 @@ class LibvirtProfile(main.Profile):
         logger.debug("Read kargs: %s" % kargs)
         logger.debug("Additional kargs: %s" % additional_kargs)
 
-        cookie = self.__host.session.cookie
+        cookie = host.session.cookie
         appendline = " ".join(kargs.split() + additional_kargs.split())
         appendline = appendline.format(igor_cookie=cookie)
 
-        # Create isolinux.cfg
         isolinuxcfgdata = "\n".join(["default {name}",
                                      "label {name}",
                                      "    kernel kernel",
                                      "    initrd initrd",
-                                     "    append {kargs}"])
+                                     "    append {kargs}",
+                                     ""])
+
+        return isolinuxcfgdata.format(name=self.name, kargs=appendline)
 
-        # Write config
+    def __host_volume(self, host, additional_kargs):
+        """Returns the name of the boot volume for host, a copy of the
+        shared volume with the isolinux.cfg for host
+        """
+        connection = host._connection
+        data = self.__isolinux_cfg(host, additional_kargs)
+        shared, (offset, size) = self.__shared_volume(connection)
+        try:
+            if len(data) > size:
+                raise RuntimeError("The isolinux.cfg for %s is larger " %
+                                   host.get_name() + "than %d bytes" % size)
+            volname = "%s-%s.iso" % (shared[:-len(".iso")],
+                                     hashlib.sha1(data).hexdigest()[:8])
+            if self.__host_volumes.get(host.get_name(),
+                                       (None, None))[1] == volname:
+                logger.debug("Reusing boot volume %s" % volname)
+                return volname
+            if volname in connection.volume_list():
+                # Left behind by an earlier attempt
+                connection.delete_volume(volname)
+            if not connection.clone_volume(shared, volname):
+                raise RuntimeError("Copying boot volume %s failed" % shared)
+        finally:
+            self.__shared_done(connection, shared)
+
+        with tempfile.NamedTemporaryFile(dir=self._datadir) as cfg:
+            cfg.write(data.ljust(size, "\n"))
+            cfg.flush()
+            if not connection.upload_volume(volname, cfg.name, offset):
+                connection.delete_volume(volname)
+                raise RuntimeError("Writing isolinux.cfg to %s failed" %
+                                   volname)
+        return volname
+
+    def __shared_volume(self, connection):
+        """Returns the name of the shared boot volume with the kernel,
+        initrd and isolinux of this profile, and the (offset, size) of
+        isolinux.cfg in it. The volume is created if it doesn't exist.
+        __shared_done needs to be called once it was copied.
+        """
+        digest = hashlib.sha1()
+        # The copy of isolinux.bin is changed by mkisofs, the original not
+        digest.update(file_digest(self.__isolinux_bin))
+        for component in ["kernel", "initrd"]:
+            digest.update(file_digest(os.path.join(self._isolinux_dir,
+                                                   component)))
+        digest = digest.hexdigest()
+
+        try:
+            extent = LibvirtProfile.__cfg_extents.get(digest)
+            if extent is None:
+                extent = self.__build_iso()
+                LibvirtProfile.__cfg_extents[digest] = extent
+            # The layout can differ between mkisofs versions, so the offset
+            # is part of the name
+            volname = "%s%s-%d.iso" % (self.volume_prefix, digest[:16],
+                                       extent[0] // ISO_SECTOR_SIZE)
+
+            def build():
+                if not os.path.exists(self._boot_iso) and \
+                        self.__build_iso() != extent:
+                    raise RuntimeError("The layout of %s changed" %
+                                       self._boot_iso)
+                size = os.path.getsize(self._boot_iso) // 1024 ** 2 + 1
+                return DiskImage(self._boot_iso, "%dM" % size, "raw")
+
+            key = (connection.connection_uri, connection.poolname, volname)
+            with LibvirtProfile.__shared_lock:
+                entry = LibvirtProfile.__shared_volumes.pop(key,
+                                                            [connection, 0])
+                entry[1] += 1
+                LibvirtProfile.__shared_volumes[key] = entry
+            try:
+                boot_isos.volume(connection, volname, build)
+            except:
+                self.__shared_done(connection, volname)
+                raise
+        finally:
+            if os.path.exists(self._boot_iso):
+                os.remove(self._boot_iso)
+        return volname, extent
+
+    @classmethod
+    def __shared_done(cls, connection, volname):
+        """Note that a copy of a shared volume was made, unused shared
+        volumes are deleted besides the most recent max_unused_volumes
+        """
+        with cls.__shared_lock:
+            key = (connection.connection_uri, connection.poolname, volname)
+            cls.__shared_volumes[key][1] -= 1
+            unused = [k for k, (c, copies) in cls.__shared_volumes.items()
+                      if not copies]
+            for unused_key in unused[:-cls.max_unused_volumes or None]:
+                unused_connection, copies = \
+                    cls.__shared_volumes.pop(unused_key)
+                logger.debug("Removing unused boot volume %s" %
+                             unused_key[2])
+                unused_connection.delete_volume(unused_key[2])
+
+    def __build_iso(self):
+        """Builds the shared ISO, with a padded isolinux.cfg
+        This is a hack as long as igor doesn't use isos directly
+        http://www.syslinux.org/wiki/index.php/ISOLINUX
+
+        Returns:
+            The (offset, size) of isolinux.cfg in the ISO
+        """
         isolinuxcfg = os.path.join(self._isolinux_dir, "isolinux.cfg")
         with open(isolinuxcfg, "w") as cfg:
-            data = isolinuxcfgdata.format(name=self.name,
-                                          kargs=appendline)
-            cfg.write(data)
+            cfg.write("# Replaced for each host\n".ljust(
+                self.isolinux_cfg_size, "\n"))
 
         cmd = ["mkisofs",
                "-output", self._boot_iso,
@@ -636,13 +1533,17 @@ class LibvirtProfile(main.Profile):
                "-eltorito-catalog", "isolinux/boot.cat",
                "-boot-load-size", "4",
                "-boot-info-table",
+               # It differs between profiles using the same files
+               "-m", "cmdline",
                self._root_dir]
 
         subprocess.check_output(cmd)
 
-        image = DiskImage(self._boot_iso, "256M", "raw")
-        self.__host._connection.create_volume(image, self._volname)
-        return self._volname
+        extent = iso_file_extent(self._boot_iso, "isolinux/isolinux.cfg")
+        if extent is None or extent[1] != self.isolinux_cfg_size:
+            raise RuntimeError("isolinux.cfg not found in %s" %
+                               self._boot_iso)
+        return extent
 
 
 class ProfileOrigin(CommonLibvirtOrigin):
@@ -0,0 +1,245 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+A content-addressed store for large files like kernels and initrds, which
+are often identical between profiles.
+"""
+
+from igor import log
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+logger = log.getLogger(__name__)
+
+BUFSIZE = 64 * 1024
+
+# Guards linking against removing blobs, for all stores of this process
+_lock = threading.Lock()
+
+# (st_dev, st_ino): digest of the blobs added by this process, to recognize
+# links to them without reading them again
+_known_inodes = {}
+
+
+class CrossDeviceError(Exception):
+    pass
+
+
+class BlobStore(object):
+    """Keeps files by the digest of their contents, so identical files are
+    only stored once.
+    Blobs are materialized as hardlinks, all copies share the same blocks on
+    disk. A blob is in use as long as there are other links to it than the
+    one in the store, release() removes a copy and the blob once it is not
+    used anymore. The link count is the reference count, so blobs can only
+    be materialized on the filesystem of the store (CrossDeviceError
+    otherwise).
+
+    >>> store = BlobStore(tempfile.mkdtemp())
+    >>> src = tempfile.NamedTemporaryFile()
+    >>> src.write("initrd")
+    >>> src.flush()
+    >>> dstdir = tempfile.mkdtemp()
+    >>> a, b = os.path.join(dstdir, "a"), os.path.join(dstdir, "b")
+    >>> digest = store.materialize(src.name, a)
+    >>> store.materialize(src.name, b) == digest
+    True
+    >>> open(b).read(), os.stat(a).st_nlink
+    ('initrd', 3)
+    >>> store.release(digest, a)
+    >>> store.stats()["blobs"]
+    1
+    >>> store.release(digest, b)
+    >>> store.stats()["blobs"]
+    0
+    """
+    path = None
+
+    def __init__(self, path):
+        """
+        Args:
+            path: The directory of the store, it is created when the first
+                  blob is added
+        """
+        self.path = path
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def add(self, filename, dst=None):
+        """Add the contents of a file to the store, if they are not yet.
+        A blob which is not materialized can be removed by release() at any
+        time, pass dst to materialize it right away.
+
+        Returns:
+            The digest of the blob
+        """
+        digest = self._known_blob(filename)
+        if digest:
+            logger.debug("%s is blob %s" % (filename, digest))
+        else:
+            hasher = hashlib.sha1()
+            with open(filename, "rb") as src:
+                for data in iter(lambda: src.read(BUFSIZE), ""):
+                    hasher.update(data)
+            digest = hasher.hexdigest()
+
+        with _lock:
+            if os.path.exists(self.blob_path(digest)):
+                logger.debug("Blob %s of %s exists" % (digest, filename))
+                if dst:
+                    self._link(digest, dst)
+                return digest
+
+        logger.debug("Adding %s as blob %s" % (filename, digest))
+        with open(filename, "rb") as src:
+            return self.add_stream(src, dst)
+
+    def add_stream(self, src, dst=None):
+        """Add the data read from the file object src to the store.
+        The data is written once, while the digest is calculated.
+
+        Args:
+            dst: Materialize the blob at dst, see add()
+        Returns:
+            The digest of the blob
+
+        >>> import io
+        >>> store = BlobStore(tempfile.mkdtemp())
+        >>> digest = store.add_stream(io.BytesIO("kernel"))
+        >>> digest == hashlib.sha1("kernel").hexdigest()
+        True
+        >>> store.add(store.blob_path(digest)) == digest
+        True
+        """
+        if not os.path.isdir(self.path):
+            self._makedirs(self.path)
+        hasher = hashlib.sha1()
+        fd, tmpfilename = tempfile.mkstemp(dir=self.path, prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as tmpfile:
+                for data in iter(lambda: src.read(BUFSIZE), ""):
+                    hasher.update(data)
+                    tmpfile.write(data)
+            digest = hasher.hexdigest()
+            blob = self.blob_path(digest)
+            with _lock:
+                if os.path.exists(blob):
+                    os.remove(tmpfilename)
+                else:
+                    self._makedirs(os.path.dirname(blob))
+                    # Blobs must not be changed, they are shared
+                    os.chmod(tmpfilename, 0o444)
+                    os.rename(tmpfilename, blob)
+                st = os.stat(blob)
+                _known_inodes[(st.st_dev, st.st_ino)] = digest
+                if dst:
+                    self._link(digest, dst)
+        except:
+            if os.path.exists(tmpfilename):
+                os.remove(tmpfilename)
+            raise
+        return digest
+
+    def _known_blob(self, filename):
+        """Returns the digest if filename is a link to a blob which was
+        added by this process, None otherwise
+        """
+        st = os.stat(filename)
+        digest = _known_inodes.get((st.st_dev, st.st_ino))
+        if digest and os.path.exists(self.blob_path(digest)) and \
+                os.path.samefile(filename, self.blob_path(digest)):
+            return digest
+        return None
+
+    def _makedirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def link(self, digest, dst):
+        """Materialize a blob at dst, a file at dst is replaced
+        """
+        with _lock:
+            self._link(digest, dst)
+
+    def _link(self, digest, dst):
+        """Must be called with _lock held, release() could remove the blob
+        otherwise
+        """
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(self.blob_path(digest), dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # A copy would not be counted as a reference to the blob
+            self._remove_unused(digest)
+            raise CrossDeviceError(("%s is not on the filesystem of the " +
+                                    "blob store %s") % (dst, self.path))
+
+    def _remove_unused(self, digest):
+        """Must be called with _lock held
+        """
+        blob = self.blob_path(digest)
+        if os.path.exists(blob) and os.stat(blob).st_nlink == 1:
+            logger.debug("Removing unused blob %s" % digest)
+            os.remove(blob)
+
+    def materialize(self, filename, dst):
+        """Add a file to the store and materialize it at dst
+
+        Returns:
+            The digest of the blob
+        """
+        return self.add(filename, dst)
+
+    def release(self, digest, filename=None):
+        """Remove a materialized blob, and the blob if it is not used
+        anymore
+        """
+        with _lock:
+            if filename and os.path.lexists(filename):
+                os.remove(filename)
+            self._remove_unused(digest)
+
+    def digests(self):
+        """The digests of all blobs in the store
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return [prefix + name
+                for prefix in sorted(os.listdir(self.path))
+                if len(prefix) == 2
+                for name in sorted(os.listdir(os.path.join(self.path,
+                                                           prefix)))]
+
+    def stats(self):
+        sizes = [os.stat(self.blob_path(d)).st_size for d in self.digests()]
+        return {"path": self.path,
+                "blobs": len(sizes),
+                "bytes": sum(sizes)}
@@ -31,6 +31,8 @@ search_paths = [".", "~/.igord", "/etc/igord"]
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 TMP_DIR = "/var/tmp/"
 DATASTORE_DIR = os.path.join(TMP_DIR, "igor-datastore")
+ARCHIVE_CACHE_DIR = os.path.join(TMP_DIR, "igor-archives")
+BLOB_STORE_DIR = os.path.join(TMP_DIR, "igor", "blobs")
 
 
 def locate_config_file(fn="igord.cfg"):
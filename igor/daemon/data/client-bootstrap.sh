@@ -10,6 +10,7 @@
 SESSION=${igor_cookie}
 CURRENT_STEP=${igor_current_step}
 TESTSUITE=${igor_testsuite}
+ARCHIVE_CODEC=${igor_archive_codec}
 TMPDIR=$(mktemp -d /tmp/oat.XXXXXX)
 LOGFILE=${TMPDIR}/testsuite.log
 
@@ -81,8 +82,15 @@ testcase_x_succeeded_last_time() {
   cd $TMPDIR
 
   debug "Fetching testsuite '$TESTSUITE' for session '$SESSION'"
-  api_call "jobs/$SESSION/testsuite" > testcases.tar.bz2
-  tar imxf testcases.tar.bz2
+  api_call "jobs/$SESSION/testsuite?codec=$ARCHIVE_CODEC" > testcases.tar
+  case "$ARCHIVE_CODEC" in
+    gz)  TAR_COMPRESSION="--gzip" ;;
+    bz2) TAR_COMPRESSION="--bzip2" ;;
+    xz)  TAR_COMPRESSION="--xz" ;;
+    zst) TAR_COMPRESSION="--use-compress-program=zstd" ;;
+    *)   TAR_COMPRESSION="" ;;
+  esac
+  tar imxf testcases.tar $TAR_COMPRESSION
 
   debug "Running testcases"
   cd testcases
@@ -155,7 +155,7 @@ testsuite() # Get the testsuite for the current job
   ARCHIVE=${1:-testsuite.tar.bz2}
   FUNC_USAGE="$0 $FUNCNAME [<DSTARCHIVE=$ARCHIVE>]"
   has_cookie
-  api /jobs/$IGORCOOKIE/testsuite > $ARCHIVE
+  api "/jobs/$IGORCOOKIE/testsuite?codec=bz2" > $ARCHIVE
 }
 
 artifacts() # Get all artifacts for the current job
@@ -0,0 +1,270 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Runs the hooks, which get notified about the progress of jobs.
+"""
+
+from igor import log, utils
+import imp
+import os
+import subprocess
+import threading
+import time
+
+logger = log.getLogger(__name__)
+
+
+class HookTimeout(Exception):
+    pass
+
+
+class ScriptHook(object):
+    """An executable, called with the hook name and the job cookie:
+    <script> post-testcase i2Xyz
+    """
+    filename = None
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __call__(self, hook, cookie, timeout=None):
+        proc = subprocess.Popen([self.filename, hook, cookie],
+                                close_fds=True)
+        killed = threading.Event()
+
+        def kill():
+            killed.set()
+            proc.kill()
+
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        retval = proc.wait()
+        if timer:
+            timer.cancel()
+        if killed.is_set():
+            raise HookTimeout("Killed after %ss" % timeout)
+        if retval != 0:
+            raise Exception("Exited with %s" % retval)
+
+
+class PythonHook(object):
+    """A python module with a hook(hook, cookie) function, it's called
+    within igord. Only modules ending in .hook.py are loaded, other python
+    files are run as scripts.
+    The function is called in a thread of its own. A python hook can't be
+    interrupted, it is abandoned if it runs longer than the timeout.
+
+    >>> import sys
+    >>> PythonHook("exit.hook.py", lambda h, c: sys.exit(1))("pre-job", "i2")
+    Traceback (most recent call last):
+    ...
+    Exception: Exited with 1
+    >>> hang = threading.Event()
+    >>> PythonHook("hang.hook.py", lambda h, c: hang.wait())("pre-job", "i2",
+    ...                                                      timeout=0.1)
+    Traceback (most recent call last):
+    ...
+    HookTimeout: Abandoned after 0.1s
+    >>> hang.set()
+    """
+    suffix = ".hook.py"
+
+    filename = None
+    func = None
+
+    def __init__(self, filename, func):
+        self.filename = filename
+        self.func = func
+
+    def __call__(self, hook, cookie, timeout=None):
+        errors = []
+
+        def call():
+            try:
+                self.func(hook, cookie)
+            except BaseException as e:
+                # Also SystemExit, it must not end igord
+                errors.append(e)
+
+        thread = threading.Thread(target=call, name="hook-%s" %
+                                  os.path.basename(self.filename))
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            raise HookTimeout("Abandoned after %ss" % timeout)
+        if errors:
+            if isinstance(errors[0], SystemExit):
+                raise Exception("Exited with %s" % errors[0].code)
+            raise errors[0]
+
+    @staticmethod
+    def load(filename):
+        """Returns a PythonHook if the module has a hook function, otherwise
+        None
+        """
+        name = "igor_hook_%s" % os.path.basename(filename)[:-3]
+        module = imp.load_source(name, filename)
+        func = getattr(module, "hook", None)
+        return PythonHook(filename, func) if callable(func) else None
+
+
+class HookDispatcher(object):
+    """Calls all hooks in a directory.
+    The hooks are called by a pool of workers, so a slow hook doesn't block
+    the job which triggered it. The hooks of a job are still called in the
+    order they were triggered. Some hooks, like pre-job, are called
+    synchronously, because the job must not proceed before they ran.
+
+    The list of hooks is only read again when the directory changed, python
+    hooks (see PythonHook) are reloaded when their file changed.
+
+    >>> import tempfile
+    >>> hookdir = tempfile.mkdtemp()
+    >>> with open(os.path.join(hookdir, "script.py"), "w") as f:
+    ...     f.write("raise SystemExit('Only run as a script')\\n")
+    >>> with open(os.path.join(hookdir, "log.hook.py"), "w") as f:
+    ...     f.write("calls = []\\n" +
+    ...             "def hook(name, cookie):\\n" +
+    ...             "    calls.append((name, cookie))\\n")
+    >>> dispatcher = HookDispatcher(hookdir)
+    >>> dispatcher.run("post-start", "i2Xyz")
+    >>> dispatcher.join()
+    >>> dispatcher.run("pre-job", "i2Xyz")
+    >>> [h.__class__.__name__ for h in dispatcher.hooks()]
+    ['PythonHook', 'ScriptHook']
+    >>> dispatcher.hooks()[0].func.func_globals["calls"]
+    [('post-start', 'i2Xyz'), ('pre-job', 'i2Xyz')]
+    >>> dispatcher.stats()["hooks"]["log.hook.py"]["calls"]
+    2
+    >>> import shutil
+    >>> shutil.rmtree(hookdir)
+    """
+    allowed_hooks = ["pre-job", "post-job", "post-testcase",
+                     "post-setup", "post-start", "post-annotate",
+                     "post-end"]
+    synchronous_hooks = ["pre-job"]
+
+    path = None
+    timeout = None
+
+    _pool = None
+    _cache = None
+    _stats = None
+    _stats_lock = None
+
+    def __init__(self, path, workers=4, timeout=60):
+        """
+        Args:
+            path: The directory containing the hooks
+            workers: Number of threads calling the hooks
+            timeout: Seconds after which a hook script gets killed
+        """
+        self.path = path
+        self.timeout = timeout
+        self._pool = utils.WorkerPool(workers, name="hooks")
+        self._cache = utils.StatCache()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def hooks(self):
+        """Returns the hooks in the directory
+        """
+        if not self.path or not os.path.isdir(self.path):
+            return []
+        filenames = self._cache.lookup(self.path)
+        if filenames is None:
+            filenames = [os.path.join(self.path, fn)
+                         for fn in sorted(os.listdir(self.path))
+                         if not (fn.startswith(".") or
+                                 fn.startswith("__init__.") or
+                                 fn.endswith((".pyc", ".pyo")))]
+            self._cache.store(self.path, filenames, [self.path])
+        return [self._hook(fn) for fn in filenames]
+
+    def _hook(self, filename):
+        if not filename.endswith(PythonHook.suffix):
+            return ScriptHook(filename)
+        hook = self._cache.lookup(filename)
+        if hook is None:
+            try:
+                hook = PythonHook.load(filename)
+            except Exception as e:
+                logger.debug(("Can't load hook %s, running it as a " +
+                              "script: %s") % (filename, e))
+            hook = self._cache.store(filename, hook or ScriptHook(filename),
+                                     [filename])
+        return hook
+
+    def run(self, hook, cookie):
+        """Run all hooks for the given hook name
+        """
+        if hook not in self.allowed_hooks:
+            logger.warning("Unknown hook: %s" % hook)
+            return
+        hooks = self.hooks()
+        if hook in self.synchronous_hooks:
+            self._call(hooks, hook, cookie)
+        elif hooks:
+            self._pool.submit(cookie, self._call, hooks, hook, cookie)
+
+    def join(self):
+        """Wait for all pending hooks
+        """
+        self._pool.join()
+
+    def _call(self, hooks, hook, cookie):
+        for h in hooks:
+            logger.debug("Running hook %s %s %s" % (h.filename, hook,
+                                                    cookie))
+            started_at = time.time()
+            error = None
+            try:
+                h(hook, cookie, self.timeout)
+            except Exception as e:
+                error = e
+                logger.warning("Hook %s failed for %s %s: %s" %
+                               (h.filename, hook, cookie, e))
+            self._record(h, time.time() - started_at, error)
+
+    def _record(self, h, latency, error):
+        name = os.path.basename(h.filename)
+        with self._stats_lock:
+            stats = self._stats.setdefault(name, {"calls": 0,
+                                                  "failures": 0,
+                                                  "timeouts": 0,
+                                                  "total_latency": 0,
+                                                  "max_latency": 0})
+            stats["calls"] += 1
+            stats["failures"] += 1 if error else 0
+            stats["timeouts"] += 1 if isinstance(error, HookTimeout) else 0
+            stats["total_latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+
+    def stats(self):
+        with self._stats_lock:
+            hooks = dict((name, dict(s, mean_latency=s["total_latency"] /
+                                     s["calls"]))
+                         for name, s in self._stats.items())
+        return {"hooks": hooks,
+                "pending": self._pool.pending(),
+                "dropped": self._pool.dropped}
@@ -0,0 +1,129 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Notifies clients about the progress of jobs and plans.
+"""
+
+from igor import log
+import collections
+import threading
+import time
+
+logger = log.getLogger(__name__)
+
+
+class EventLog(object):
+    """Keeps the most recent events in a ring buffer.
+    Each event has an increasing id, clients pass the id of the last event
+    they've seen to get the following ones, so they can resume after a
+    connection was lost.
+
+    >>> log = EventLog(max_events=3)
+    >>> log.publish("job.state", job="a", state="running")["id"]
+    1
+    >>> _ = log.publish("job.state", job="b", state="running")
+    >>> events, last_id, missed = log.since(0)
+    >>> [(e["id"], e["job"]) for e in events], last_id, missed
+    ([(1, 'a'), (2, 'b')], 2, False)
+    >>> events, last_id, missed = log.since(0, predicate=lambda e:
+    ...                                     e["job"] == "b")
+    >>> [e["id"] for e in events], last_id
+    ([2], 2)
+
+    Events which were already dropped can not be replayed:
+
+    >>> for n in range(3):
+    ...     _ = log.publish("job.state", job="c", state="passed")
+    >>> events, last_id, missed = log.since(1)
+    >>> [e["id"] for e in events], last_id, missed
+    ([], 5, True)
+
+    Without new events the call returns after the timeout:
+
+    >>> log.since(5, timeout=0.1)
+    ([], 5, False)
+    """
+    max_events = 1000
+
+    _events = None
+    _condition = None
+    _last_id = 0
+
+    def __init__(self, max_events=None):
+        self._events = collections.deque(maxlen=max_events or
+                                         self.max_events)
+        self._condition = threading.Condition()
+
+    def publish(self, kind, **data):
+        """Add an event and wake up all waiting clients
+
+        Args:
+            kind: The type of the event, e.g. job.state
+            data: The (JSON-able) payload of the event
+        Returns:
+            The event
+        """
+        with self._condition:
+            self._last_id += 1
+            event = dict(data, id=self._last_id, type=kind,
+                         created_at=time.time())
+            self._events.append(event)
+            self._condition.notify_all()
+        logger.debug("Event %s" % event)
+        return event
+
+    def last_id(self):
+        with self._condition:
+            return self._last_id
+
+    def since(self, last_id=None, timeout=0, predicate=None):
+        """Returns the events following the event last_id, waits up to
+        timeout seconds if there are none yet.
+
+        Args:
+            last_id: The id of the last event seen, None to only get the
+                     events published from now on
+            timeout: Seconds to wait for a (matching) event
+            predicate: Only return the events this function accepts
+        Returns:
+            A tuple (events, last_id, missed), last_id is to be passed to
+            the next call. missed is True if events got lost, because they
+            were dropped or igord was restarted, then the client needs to
+            fetch the full status again.
+        """
+        deadline = time.time() + (timeout or 0)
+        with self._condition:
+            if last_id is None:
+                last_id = self._last_id
+
+            while True:
+                oldest_id = self._events[0]["id"] if self._events else 1
+                if last_id > self._last_id or last_id + 1 < oldest_id:
+                    return [], self._last_id, True
+                events = [e for e in self._events if e["id"] > last_id]
+                if events:
+                    last_id = events[-1]["id"]
+                if predicate:
+                    events = [e for e in events if predicate(e)]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events, last_id, False
+                self._condition.wait(remaining)
@@ -18,7 +18,12 @@
 # Author: Fabian Deutsch <fabiand@fedoraproject.org>
 #
 
+from wsgiref import simple_server
+import Queue
+import bottle
 import json
+import threading
+import yaml
 
 import igor.daemon.main
 import igor.daemon.job
@@ -31,15 +36,118 @@ class IgordJSONEncoder(json.encoder.JSONEncoder):
         super(IgordJSONEncoder, self).__init__(*args, **kwargs)
 
     def _default(self, obj):
-        if isinstance(obj, igor.daemon.job.Job) or \
-           isinstance(obj, igor.daemon.main.Testsuite) or \
-           isinstance(obj, igor.daemon.main.Testset) or \
-           isinstance(obj, igor.daemon.main.Testcase) or \
-           isinstance(obj, igor.daemon.main.Profile) or \
-           isinstance(obj, igor.daemon.main.Origin) or \
-           isinstance(obj, igor.daemon.main.Host) or \
-           isinstance(obj, igor.daemon.main.Testplan):
-            return obj.__to_dict__()
-        elif isinstance(obj, igor.utils.State):
-            return str(obj)
+        if is_igor_object(obj):
+            return to_serializable(obj)
         return json.encoder.JSONEncoder.default(self, obj)
+
+
+def is_igor_object(obj):
+    return isinstance(obj, igor.daemon.job.Job) or \
+        isinstance(obj, igor.daemon.main.Testsuite) or \
+        isinstance(obj, igor.daemon.main.Testset) or \
+        isinstance(obj, igor.daemon.main.Testcase) or \
+        isinstance(obj, igor.daemon.main.Profile) or \
+        isinstance(obj, igor.daemon.main.Origin) or \
+        isinstance(obj, igor.daemon.main.Host) or \
+        isinstance(obj, igor.daemon.main.Testplan) or \
+        isinstance(obj, igor.utils.State)
+
+
+def to_serializable(obj):
+    if isinstance(obj, igor.utils.State):
+        return str(obj)
+    return obj.__to_dict__()
+
+
+_plain_types = (basestring, int, long, float, bool, type(None))
+
+
+def simplify(obj):
+    """Converts obj into a structure of dicts, lists and plain values, like
+    a round-trip through IgordJSONEncoder and json.loads - but without
+    creating the JSON string.
+
+    >>> simplify({"state": igor.utils.State("open"), 1: ("a", None)})
+    {'1': ['a', None], 'state': 'open'}
+    """
+    if isinstance(obj, _plain_types):
+        return obj
+    if isinstance(obj, dict):
+        return dict((k if isinstance(k, basestring) else str(k), simplify(v))
+                    for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [simplify(v) for v in obj]
+    if is_igor_object(obj):
+        return simplify(to_serializable(obj))
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+# libyaml's emitter is much faster, if available
+_yaml_dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def to_yaml(obj):
+    """Dump obj as YAML, a list is dumped as a stream of documents
+
+    >>> print(to_yaml({"state": igor.utils.State("open")}).strip())
+    state: open
+    """
+    obj = simplify(obj)
+    return yaml.dump_all(obj if type(obj) is list else [obj],
+                         Dumper=_yaml_dumper, default_flow_style=False)
+
+
+class PooledWSGIServer(simple_server.WSGIServer):
+    """Like wsgiref's server, but the requests are handled by a fixed
+    number of threads, so long-polling clients don't block everyone else.
+    The threads are kept, so thread-local caches are reused across
+    requests, further requests wait until a thread is free.
+    """
+    workers = 16
+
+    _requests = None
+
+    def serve_forever(self, poll_interval=0.5):
+        self._requests = Queue.Queue()
+        for n in range(self.workers):
+            worker = threading.Thread(target=self._work,
+                                      name="http-%d" % n)
+            worker.daemon = True
+            worker.start()
+        simple_server.WSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            request, client_address = self._requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class QuietWSGIRequestHandler(simple_server.WSGIRequestHandler):
+    def log_request(*args, **kwargs):
+        pass
+
+
+class PooledWSGIRefServer(bottle.ServerAdapter):
+    """Runs the app in a PooledWSGIServer, the number of threads is
+    passed as the workers option
+    """
+    def run(self, app):
+        class Server(PooledWSGIServer):
+            workers = self.options.get("workers") or \
+                PooledWSGIServer.workers
+
+        handler = simple_server.WSGIRequestHandler
+        if self.quiet:
+            handler = QuietWSGIRequestHandler
+
+        server = simple_server.make_server(self.host, self.port, app,
+                                           Server, handler)
+        server.serve_forever()
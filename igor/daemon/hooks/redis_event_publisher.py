@@ -8,12 +8,18 @@ import igor.common as common
 import redis
 
 
+def hook(hookname, cookie):
+    """Called by igord, when this file is placed in the hooks path
+    """
+    r = redis.Redis()
+    r.publish(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME,
+              "<event type='%s' session='%s' />" % (hookname, cookie))
+
+
 if __name__ == "__main__":
     if len(sys.argv) < 3:
         raise RuntimeError("Hookname or cookie missing: %s" % sys.argv)
 
     hookname, cookie = sys.argv[1:3]
 
-    r = redis.Redis()
-    r.publish(common.REDIS_EVENTS_PUBSUB_CHANNEL_NAME,
-              "<event type='%s' session='%s' />" % (hookname, cookie))
+    hook(hookname, cookie)
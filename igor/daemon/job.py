@@ -19,8 +19,12 @@
 # -*- coding: utf-8 -*-
 
 from igor import log, utils
+import dispatcher
+import events
 import main
 import os
+import pipeline
+import scheduler
 import threading
 import time
 import yaml
@@ -37,11 +41,10 @@ s_failed = utils.State("failed")
 s_timedout = utils.State("timedout")
 s_passed = utils.State("passed")
 endstates = [s_aborted, s_failed, s_timedout, s_passed]
+states = dict((str(s), s) for s in [s_open, s_preparing, s_prepared,
+                                    s_running] + endstates)
 
-
-_high_state_change_lock = threading.RLock()
-_state_change_lock = threading.RLock()
-_jobcenter_lock = threading.RLock()
+_version_lock = threading.Lock()
 
 
 class Job(object):
@@ -50,6 +53,11 @@ class Job(object):
     start()
     finish_step(..), [...] | abort()
     end()
+
+    Each job has its own locks, _lock serializes the transitions of the
+    lifecycle, _state_lock guards the state itself. Slow operations on the
+    host (preparing and purging it) happen outside of _lock, so other
+    requests for the job can be served in the meantime.
     """
     job_center = None
     session_path = None
@@ -61,6 +69,7 @@ class Job(object):
     profile = None
     testsuite = None
     additional_kargs = None
+    plan_name = None
 
     current_step = 0
     results = None
@@ -70,12 +79,21 @@ class Job(object):
     _state_history = None
     state_changed = None
     _created_at = None
+    _queued_at = None
+    _started_at = None
+    _priority = 0
+    _version = 0
     _ended = False
     _ended_at = None
+    _cancelled = False
+    _teardown_attempts = 0
 
     _watchdog = None
+    _lock = None
+    _state_lock = None
 
-    def __init__(self, job_center, cookie, jobspec, session_path="/tmp"):
+    def __init__(self, job_center, cookie, jobspec, session_path="/tmp",
+                 session=None):
         """Create a new job to run the testsuite on host prepared with profile
         """
         self.job_center = job_center
@@ -83,7 +101,7 @@ class Job(object):
 
         assert cookie is not None, "Cookie can not be None"
         self.cookie = cookie
-        self.session = main.TestSession(cookie, self.session_path)
+        self.session = session or main.TestSession(cookie, self.session_path)
 
         testsuite, profile, host, additional_kargs = (jobspec.testsuite,
                                                       jobspec.profile,
@@ -103,6 +121,8 @@ class Job(object):
         self.results = []
         self._artifacts = []
 
+        self._lock = threading.RLock()
+        self._state_lock = threading.RLock()
         self._state_history = []
         self.state_changed = threading.Event()
         self.state(s_open)
@@ -125,49 +145,66 @@ class Job(object):
                 logger.debug("%ss of %ss (timeout) passed" % (
                              self.job.runtime(),
                              self.job.allowed_time_up_to_current_testcase()))
-                if self.job.is_timedout():
-                    with _high_state_change_lock:
+                with self.job._lock:
+                    if self.job.state() != s_running:
+                        self.stop()
+                    elif self.job.is_timedout():
                         logger.debug("Watchdog for job %s: timed out." %
                                      self.job.cookie)
                         self.job.state(s_timedout)
-                    self.stop()
+                        self.stop()
 
         watchdog = JobTimeoutWatchdog(self)
         return watchdog
 
-    @utils.synchronized(_high_state_change_lock)
     def setup(self):
         """Prepare a host to get started
         """
-        if self.state() != s_open:
-            raise Exception(("Can not setup job %s: %s") % (self.cookie,
-                                                            self.state()))
-
-        logger.info("Setting up job %s" % self.cookie)
-        self.state(s_preparing)
+        with self._lock:
+            if self.state() != s_open:
+                raise Exception(("Can not setup job %s: %s") %
+                                (self.cookie, self.state()))
+            logger.info("Setting up job %s" % self.cookie)
+            self.state(s_preparing)
+
+        # The preparing state keeps others away while the lock is released
+        stage = self.job_center.pipeline.stage
         logger.debug("Preparing host %s" % self.host.get_name())
-        self.host.prepare()
+        with stage(self, "prepare"):
+            self.host.prepare()
         logger.debug("Assigning profile %s" % self.profile.get_name())
-        self.profile.assign_to(self.host, self.additional_kargs)
-        self.state(s_prepared)
+        with stage(self, "assign"):
+            self.profile.assign_to(self.host, self.additional_kargs)
+
+        with self._lock:
+            if self._cancelled:
+                logger.info("Job %s was aborted while being set up" %
+                            self.cookie)
+                self.state(s_aborted)
+                return
+            self.state(s_prepared)
         self.job_center._run_hook("post-setup", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
     def start(self):
         """Start the actual test
         We expecte the testsuite to be gathered by the host, thus the host
         calling in to fetch it
         """
-        if self.state() != s_prepared:
-            raise Exception(("Can not start job %s: %s") % (self.cookie,
-                                                            self.state()))
-        logger.debug("Starting job %s" % (self.cookie))
-        self.state(s_running)
-        self.host.start()
+        with self._lock:
+            if self.state() != s_prepared:
+                raise Exception(("Can not start job %s: %s") %
+                                (self.cookie, self.state()))
+            logger.debug("Starting job %s" % (self.cookie))
+            self.state(s_running)
+
+        # The teardown runs in the pipeline after the setup, so it can not
+        # interfere with starting the host
+        with self.job_center.pipeline.stage(self, "start"):
+            self.host.start()
         self.watchdog.start()
         self.job_center._run_hook("post-start", self.cookie)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized("_lock")
     def finish_step(self, n, is_success, note=None, is_abort=False,
                     is_skipped=False):
         """Finish one test step
@@ -212,6 +249,12 @@ class Job(object):
                              "runtime": time.time() - last_timestamp,
                              "log": log,
                              "annotations": annotations})
+        # Published before the state changes, so a client has all results
+        # once it sees the end state. The log is left out, it's big
+        self.publish_event("job.step", step=n,
+                           result=dict((k, v) for k, v
+                                       in self.results[-1].items()
+                                       if k not in ["log", "annotations"]))
 
         if is_abort:
             logger.debug("Aborting at step %s (%s)" %
@@ -244,6 +287,7 @@ class Job(object):
         self.job_center._run_hook("post-testcase", self.cookie)
 
         self.current_step += 1
+        self.changed()
         return self.current_step
 
     def annotate(self, note, step="current", is_append=True):
@@ -275,19 +319,30 @@ class Job(object):
             filename = "%s-%s" % (step, filename)
         return list(yaml.load_all(self.get_artifact(filename)))
 
-    def add_artifact_to_current_step(self, name, data):
+    def add_artifact_to_current_step(self, name, data, **kwargs):
         aname = "%s-%s" % (self.current_step, name)
-        self.add_artifact(aname, data)
+        self.add_artifact(aname, data, **kwargs)
         return aname
 
+    def assign_host(self, host):
+        """Replace the host of this job, used to resolve a HostSelector
+        """
+        if host is not self.host:
+            logger.debug("Assigning host %s to job %s" % (host.get_name(),
+                                                          self.cookie))
+            self.host = host
+            self.host.session = self.session
+            self.changed()
+
     def get_artifact_for_current_step(self, name):
         aname = "%s-%s" % (self.current_step, name)
         return self.get_artifact(aname)
 
-    def add_artifact(self, name, data):
+    def add_artifact(self, name, data, **kwargs):
+        self.session.add_artifact(name, data, **kwargs)
         if name not in self._artifacts:
             self._artifacts.append(name)
-        self.session.add_artifact(name, data)
+        self.changed()
 
     def get_artifact(self, name):
         return self.session.get_artifact(name)
@@ -295,9 +350,10 @@ class Job(object):
     def list_artifacts(self):
         return self._artifacts
 
-    def get_artifacts_archive(self):
+    def get_artifacts_archive(self, codec="bz2", level=None):
         logger.debug("Creating artifacts archive for: %s" % self._artifacts)
-        return self.session.get_artifacts_archive(self._artifacts)
+        return self.session.get_artifacts_archive(self._artifacts, codec,
+                                                  level)
 
     def abort(self):
         """Abort the test
@@ -311,25 +367,83 @@ class Job(object):
         self.finish_step(self.current_step, is_success=False, note="aborted",
                          is_abort=True)
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized("_lock")
+    def cancel(self):
+        """Abort the job, unlike abort() this also works if the job was not
+        started yet. A job which is being set up is aborted once the setup
+        is done, so the host is not torn down while it is prepared.
+        """
+        if self.state() == s_running:
+            self.abort()
+        elif self.state() in [s_open, s_prepared]:
+            self.state(s_aborted)
+        elif self.state() == s_preparing:
+            self._cancelled = True
+
+    def was_set_up(self):
+        """If the host of this job was (at least partially) set up
+        """
+        with self._state_lock:
+            return any(s.get("state") == s_preparing
+                       for s in self._state_history)
+
     def end(self):
         """Tear down this test, might clean up the host
         """
-        logger.debug("Tearing down job %s" % self.cookie)
-        if self.state() not in [s_running] + endstates:
-            raise Exception("Job %s can not yet be torn down: %s" %
-                            (self.cookie, self.state()))
-
-        self.host.purge()
-        self.profile.revoke_from(self.host)
-        self._ended = True
-        self._ended_at = time.time()
+        with self._lock:
+            logger.debug("Tearing down job %s" % self.cookie)
+            if self._ended or self.state() not in [s_running] + endstates:
+                raise Exception("Job %s can not be torn down: %s" %
+                                (self.cookie, self.state()))
+
+        if self.was_set_up():
+            stage = self.job_center.pipeline.stage
+            with stage(self, "purge"):
+                self.host.purge()
+            with stage(self, "revoke"):
+                self.profile.revoke_from(self.host)
+
+        with self._lock:
+            self._ended = True
+            self._ended_at = time.time()
+        self.changed()
         self.job_center._run_hook("post-end", self.cookie)
 
+    def record_stage(self, name, started_at, runtime, waited):
+        """Note the time spent in a stage of the setup or teardown, see
+        pipeline.Pipeline
+        """
+        with self._state_lock:
+            self._state_history.append({"created_at": started_at,
+                                        "stage": name,
+                                        "runtime": runtime,
+                                        "waited": waited})
+        self.changed()
+
+    def changed(self):
+        """Note that this job changed, this bumps the version of the job
+        """
+        with _version_lock:
+            self._version += 1
+        self.job_center._journal_job(self)
+
+    def version(self):
+        """A counter which is increased whenever the job changes
+        """
+        return self._version
+
+    def publish_event(self, kind, **data):
+        """Publish an event about this job, see events.EventLog
+        """
+        data["job"] = self.cookie
+        if self.plan_name:
+            data["plan"] = self.plan_name
+        self.job_center.events.publish(kind, **data)
+
     def ended_within(self, span):
         return (time.time() - self._ended_at) < span
 
-    @utils.synchronized(_high_state_change_lock)
+    @utils.synchronized("_lock")
     def clean(self):
         assert self._ended is True
         self.session.remove()
@@ -338,17 +452,27 @@ class Job(object):
         assert self._ended is True
         return time.time() - self._ended_at
 
-    @utils.synchronized(_state_change_lock)
     def state(self, new_state=None):
+        with self._state_lock:
+            if new_state is not None:
+                self._state_history.append({
+                    "created_at": time.time(),
+                    "state": new_state
+                })
+                self._state = new_state
+                self.state_changed.set()
+                self.state_changed.clear()
+            state = self._state
         if new_state is not None:
-            self._state_history.append({
-                "created_at": time.time(),
-                "state": new_state
-            })
-            self._state = new_state
-            self.state_changed.set()
-            self.state_changed.clear()
-        return self._state
+            self.changed()
+            self.publish_event("job.state", state=str(new_state),
+                               is_endstate=new_state in endstates,
+                               current_step=self.current_step,
+                               runtime=self.runtime())
+        if new_state in endstates:
+            # Outside of the lock, the listeners will query the state
+            self.job_center._job_reached_endstate(self)
+        return state
 
     def result(self):
         msg = None
@@ -359,7 +483,9 @@ class Job(object):
             msg = "passed"
 
         elif self.state() == s_aborted:
-            assert any([r["is_abort"] for r in self.results])
+            # Jobs which were aborted before they ran have no results
+            assert not self.results or any([r["is_abort"]
+                                            for r in self.results])
             msg = "aborted"
 
         elif self.state() == s_timedout:
@@ -367,7 +493,7 @@ class Job(object):
             msg = "timedout"
 
         elif self.state() == s_failed:
-            assert not all([r["is_passed"] for r in self.results])
+            # Also if the setup or teardown failed, the results can be fine
             msg = "failed"
 
         elif self.state() == s_running:
@@ -394,7 +520,10 @@ class Job(object):
         runtime = 0
         now = time.time()
         get_first_state_change = lambda q: [s for s in self._state_history
-                                            if s["state"] == q][0]
+                                            if s.get("state") == q][0]
+        if s_running not in [s.get("state") for s in self._state_history]:
+            # Jobs which failed or were aborted before they ran
+            return runtime
         if self.state() == s_running:
             time_started = get_first_state_change(s_running)["created_at"]
             runtime = now - time_started
@@ -480,6 +609,98 @@ class Job(object):
         while not self.reached_endstate():
             self.state_changed.wait()
 
+    def queue_latency(self):
+        """The time this job waited in the queue before it got started.
+        """
+        latency = None
+        if self._queued_at is not None:
+            latency = (self._started_at or time.time()) - self._queued_at
+        return latency
+
+    def __to_snapshot__(self):
+        """The state of this job, to be able to restore it with from_snapshot
+        """
+        host_props = dict((k, v) for k, v in self.host.__dict__.items()
+                          if v is None or type(v) in [str, unicode, int,
+                                                      float, bool])
+        return {"cookie": self.cookie,
+                "session": self.session.dirname,
+                "testsuite": self.testsuite.name,
+                "profile": self.profile.get_name(),
+                "host": {"name": self.host.lookup_name or
+                         self.host.get_name(),
+                         "props": host_props},
+                "additional_kargs": self.additional_kargs,
+                "state": str(self.state()),
+                "state_history": [dict(h, state=str(h["state"]))
+                                  if "state" in h else dict(h)
+                                  for h in list(self._state_history)],
+                "current_step": self.current_step,
+                "results": list(self.results),
+                "artifacts": list(self._artifacts),
+                "created_at": self._created_at,
+                "queued_at": self._queued_at,
+                "started_at": self._started_at,
+                "priority": self._priority,
+                "ended": self._ended,
+                "ended_at": self._ended_at,
+                "summary": self.__to_summary__()}
+
+    def __to_summary__(self):
+        """A compact description of this job, without the testsuite and
+        the logs of the results
+        """
+        state = self.state()
+        return {"id": self.cookie,
+                "profile": self.profile.get_name(),
+                "host": self.host.get_name(),
+                "testsuite": self.testsuite.name,
+                "state": str(state),
+                "is_endstate": state in endstates,
+                "current_step": self.current_step,
+                "testcases": len(self.testcases()),
+                "passed_steps": len([r for r in self.results
+                                     if r["is_passed"]]),
+                "runtime": self.runtime(),
+                "created_at": self._created_at,
+                "queued_at": self._queued_at,
+                "started_at": self._started_at,
+                "ended_at": self._ended_at}
+
+    @staticmethod
+    def from_snapshot(job_center, data, inventory, session_path="/tmp"):
+        """Rebuild a job from a snapshot, the testsuite, profile and host
+        are looked up in the inventory
+        """
+        spec = main.JobSpec()
+        spec.testsuite = inventory.testsuites(data["testsuite"])
+        spec.profile = inventory.profiles(data["profile"])
+        spec.host = inventory.hosts(data["host"]["name"])
+        for k in ["testsuite", "profile", "host"]:
+            if getattr(spec, k) is None:
+                raise Exception("Unknown %s '%s' of job %s" %
+                                (k, data[k], data["cookie"]))
+        utils.update_properties_only(spec.host, data["host"]["props"])
+        spec.additional_kargs = data["additional_kargs"]
+
+        session = main.TestSession(data["cookie"], session_path,
+                                   dirname=data["session"])
+        j = Job(job_center, data["cookie"], spec, session_path, session)
+        j._state = states[data["state"]]
+        j._state_history = [dict(h, state=states[h["state"]])
+                            if "state" in h else h
+                            for h in data["state_history"]]
+        j.current_step = data["current_step"]
+        j.results = data["results"]
+        j._artifacts = data["artifacts"]
+        j._created_at = j.created_at = data["created_at"]
+        j._queued_at = data["queued_at"]
+        j._started_at = data["started_at"]
+        j._priority = data["priority"]
+        j._ended = data["ended"]
+        j._ended_at = data["ended_at"]
+        return j
+
     def __str__(self):
         return ("ID: %s\nState: %s\nStep: %d\nTestsuite:\n%s" %
                 (self.cookie, self.state(), self.current_step, self.testsuite))
@@ -496,38 +717,73 @@ class Job(object):
                 "timeout": self.timeout(),
                 "runtime": self.runtime(),
                 "created_at": self._created_at,
+                "queued_at": self._queued_at,
+                "started_at": self._started_at,
+                "queue_latency": self.queue_latency(),
                 "artifacts": self._artifacts,
+                "stages": [h for h in self._state_history if "stage" in h],
                 "additional_kargs": self.additional_kargs}
 
 
 class JobCenter(object):
     """Manage jobs
+    The jobs and plans are journaled to the store (a store.JobStore), if
+    one is given, and can be restored from it using recover().
+    A failing teardown is retried, up to max_teardown_attempts times.
     """
     session_path = None
     hooks_path = None
+    store = None
+    max_teardown_attempts = 3
 
     jobs = {}
     closed_jobs = []
 
-    _queue_of_pending_jobs = []
+    scheduler = None
+    pipeline = None
+    events = None
+    hooks = None
+    _jobs_ending = None
     _queue_of_ended_jobs = []
-    _pool_of_hosts_in_use = set([])
+    _hosts_in_use = {}
 
     _running_plans = {}
     _plan_results = {}
 
     _cookie_lock = threading.Lock()
+    _lock = None
+    _endstate_condition = threading.Condition()
 
     _worker = None
 
-    def __init__(self, session_path, hooks_path=None):
+    def __init__(self, session_path, hooks_path=None, store=None,
+                 setup_pipeline=None):
+        """
+        Args:
+            session_path: Where the sessions of the jobs are kept
+            hooks_path: The directory with the hooks
+            store: A store.JobStore to journal to
+            setup_pipeline: The pipeline.Pipeline to set up and tear down
+                            jobs with
+        """
         self.session_path = session_path
         self.hooks_path = hooks_path
+        self.store = store
+        self.pipeline = setup_pipeline or pipeline.Pipeline()
         if not os.path.exists(self.session_path):
             os.makedirs(self.session_path)
 
         logger.debug("JobCenter opened in %s" % self.session_path)
 
+        # Only guards the registry of jobs, it's never held while a job
+        # changes its state
+        self._lock = threading.RLock()
+        self._jobs_ending = set()
+
+        self.scheduler = scheduler.Scheduler()
+        self.events = events.EventLog()
+        self.hooks = dispatcher.HookDispatcher(hooks_path)
+
         self._worker = JobCenter.JobWorker(jc=self, cleanup_age=5 * 60)
         self._worker.start()
 
@@ -535,10 +791,106 @@ class JobCenter(object):
         self._worker.stop()
         logger.debug("JobCenter is gone.")
 
-    @utils.synchronized(_jobcenter_lock)
+    def wakeup_worker(self):
+        """Let the worker look for jobs to start or end right away
+        """
+        self._worker.wakeup()
+
+    def _journal_job(self, job):
+        if self.store and job.cookie in self.jobs:
+            self.store.record("job", job.cookie, job.__to_snapshot__)
+
+    def history(self, **filters):
+        """Query the summaries of current and past jobs, see
+        store.JobStore.history
+        """
+        if not self.store:
+            raise Exception("No job store to query the history from")
+        return self.store.history(**filters)
+
+    def _journal_plan(self, worker):
+        if self.store:
+            self.store.record("plan", worker.plan.name,
+                              worker.__to_snapshot__)
+
+    def recover(self, inventory):
+        """Restore the jobs and plans from the store.
+        Running jobs continue, jobs which were being prepared are queued
+        again and jobs which ended but were not torn down, are torn down.
+        """
+        if not self.store:
+            return
+        logger.info("Recovering jobs and plans from %s" % self.store.path)
+
+        self._plan_results.update(self.store.load("plan_result"))
+
+        snapshots = self.store.load("job").values()
+        for data in sorted(snapshots, key=lambda d: d["created_at"]):
+            try:
+                j = Job.from_snapshot(self, data, inventory,
+                                      self.session_path)
+            except Exception as e:
+                logger.warning("Could not recover job %s: %s" %
+                               (data["cookie"], e))
+                self.store.remove("job", data["cookie"])
+                continue
+
+            if j._ended:
+                self.closed_jobs.append(j)
+                self._queue_of_ended_jobs.append(j)
+            elif j.state() in [s_preparing, s_prepared]:
+                logger.info("Job %s was interrupted while being prepared" %
+                            j.cookie)
+                j.state(s_open)
+            elif j.state() == s_running or j.state() in endstates:
+                # The host is in use until the job gets torn down
+                self._hosts_in_use[j.cookie] = j.host
+                if j.state() == s_running:
+                    j.watchdog.start()
+
+            with self._lock:
+                self.jobs[j.cookie] = j
+            self._journal_job(j)
+            if j.state() == s_open and j._queued_at is not None:
+                self.scheduler.enqueue(j, j._priority)
+            logger.info("Recovered job %s: %s" % (j.cookie, j.state()))
+
+        for name, data in self.store.load("plan").items():
+            try:
+                worker = JobCenter.PlanWorker.from_snapshot(self, data,
+                                                            inventory)
+            except Exception as e:
+                logger.warning("Could not recover plan %s: %s" % (name, e))
+                self.store.remove("plan", name)
+                continue
+            self._running_plans[name] = worker
+            worker.start()
+            logger.info("Recovered plan %s" % name)
+
+        self.wakeup_worker()
+
+    def _job_reached_endstate(self, job):
+        with self._endstate_condition:
+            self._endstate_condition.notify_all()
+        # Let the worker unwind this job right away
+        self.wakeup_worker()
+
+    def wait_for_endstates(self, predicate, timeout=30):
+        """Block until predicate() is true, it is checked whenever a job
+        reached an end state (and every timeout seconds)
+        """
+        with self._endstate_condition:
+            while not predicate():
+                self._endstate_condition.wait(timeout)
+
+    @utils.synchronized("_lock")
     def get_jobs(self):
-        return {"all": self.jobs,
-                "closed": self.closed_jobs}
+        return {"all": dict(self.jobs),
+                "closed": list(self.closed_jobs)}
+
+    def _job(self, cookie):
+        with self._lock:
+            return self.jobs[cookie]
 
     def _generate_cookie(self, cookie_req=None):
         cookie = cookie_req
@@ -552,7 +904,7 @@ class JobCenter(object):
                                     (cookie_req, cookie))
         return cookie
 
-    @utils.synchronized(_jobcenter_lock)
+    @utils.synchronized("_lock")
     def submit(self, jobspec, cookie_req=None):
         """Enqueue a jobspec to be run against a specififc build on
         given host
@@ -563,6 +915,7 @@ class JobCenter(object):
         j.created_at = time.time()
 
         self.jobs[cookie] = j
+        j.changed()
 
         logger.debug("Created job %s with cookie %s" % (repr(j), cookie))
 
@@ -570,71 +923,172 @@ class JobCenter(object):
 
         return {"cookie": cookie, "job": j}
 
-    @utils.synchronized(_jobcenter_lock)
-    def start_job(self, cookie):
-        self._queue_of_pending_jobs.append(cookie)
+    def start_job(self, cookie, priority=0):
+        """Queue a job, it is started once a (matching) host is free.
+        Jobs with a higher priority are started first.
+        """
+        job = self._job(cookie)
+        job._queued_at = time.time()
+        job._priority = priority
+        job.changed()
+        self.scheduler.enqueue(job, priority)
+        self.wakeup_worker()
         return "Started job %s. %d in queue" % \
-            (cookie, len(self._queue_of_pending_jobs))
+            (cookie, len(self.scheduler.queued()))
 
-    def _start_job(self, cookie):
-        job = self.jobs[cookie]
-        if job.host in self._pool_of_hosts_in_use:
-            raise Exception("The host is already in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.add(job.host)
+    def hosts_in_use(self):
+        """The names of all hosts used by started jobs
+        """
+        return set(h.get_name() for h in self._hosts_in_use.values())
 
-        logger.info("Job %s is beeing started." % cookie)
-        job.setup()
-        job.start()
-        logger.info("Job %s got started." % cookie)
+    def _start_job(self, cookie, host):
+        """Set up and start a job on host, in the background
+        """
+        job = self.jobs[cookie]
+        with job._lock:
+            if job.reached_endstate():
+                return "Job %s ended before it got started." % cookie
+            if host.get_name() in self.hosts_in_use():
+                raise Exception("The host is already in use: %s" %
+                                job.cookie)
+            job.assign_host(host)
+            self._hosts_in_use[cookie] = host
+            job._started_at = time.time()
+            job.changed()
+
+        logger.info("Job %s is beeing started after %.2fs in the queue." %
+                    (cookie, job.queue_latency()))
+        self.pipeline.submit(job, self._setup_job, job)
+
+        return "Starting job %s (%s)." % (cookie, repr(job))
+
+    def _setup_job(self, job):
+        try:
+            self._run_hook("pre-job", job.cookie)
+            job.setup()
+            if job.reached_endstate():
+                return
+            job.start()
+            logger.info("Job %s got started." % job.cookie)
+        except Exception as e:
+            if job.reached_endstate():
+                # It got aborted in the meantime
+                return
+            logger.exception("Setting up job %s failed: %s" % (job.cookie,
+                                                               e))
+            # Failed, so the host gets purged and freed again
+            job.state(s_failed)
+
+    def _teardown_job(self, job):
+        """Tear down an ended job, in the background
+        """
+        with self._lock:
+            if job.cookie in self._jobs_ending:
+                return
+            self._jobs_ending.add(job.cookie)
+        self.pipeline.submit(job, self._unwind_job, job)
 
-        return "Started job %s (%s)." % (cookie, repr(job))
+    def _unwind_job(self, job):
+        try:
+            self._run_hook("post-job", job.cookie)
+            self._end_job(job.cookie)
+            self._queue_of_ended_jobs.append(job)
+        except Exception as e:
+            logger.exception("Tearing down job %s failed: %s" % (job.cookie,
+                                                                 e))
+            job._teardown_attempts += 1
+            if job._teardown_attempts >= self.max_teardown_attempts:
+                self._abandon_job(job)
+            # Otherwise it's tried again the next time the worker runs
+        finally:
+            with self._lock:
+                self._jobs_ending.discard(job.cookie)
+
+    def _abandon_job(self, job):
+        """Give up tearing down a job, it is marked as failed and its host
+        is released
+        """
+        logger.error("Giving up to tear down job %s after %d attempts" %
+                     (job.cookie, job._teardown_attempts))
+        with job._lock:
+            job._ended = True
+            job._ended_at = time.time()
+        if job.state() != s_failed:
+            job.state(s_failed)
+        self._hosts_in_use.pop(job.cookie, None)
+        self.closed_jobs.append(job)
+        self._queue_of_ended_jobs.append(job)
+        job.changed()
+        self.wakeup_worker()
 
-    @utils.synchronized(_jobcenter_lock)
     def finish_test_step(self, cookie, step, is_success, note=None):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.finish_step(step, is_success, note)
         logger.info("Job %s finished step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
     def skip_step(self, cookie, step, note=None):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.finish_step(step, False, note, is_skipped=True)
         logger.info("Job %s skipped step %s" % (cookie, step))
         return j
 
-    @utils.synchronized(_jobcenter_lock)
     def test_step_result(self, cookie, step):
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         return j.results[step]
 
-    @utils.synchronized(_jobcenter_lock)
     def abort_job(self, cookie):
         logger.debug("Aborting %s" % cookie)
-        j = self.jobs[cookie]
+        j = self._job(cookie)
         j.abort()
         logger.info("Job %s aborted." % (cookie))
         return j
 
+    def cancel_job(self, cookie):
+        """Abort a job in any state, jobs which were not started yet are
+        removed from the queue and end right away
+        """
+        logger.debug("Cancelling %s" % cookie)
+        j = self._job(cookie)
+        self.scheduler.remove(j)
+        j.cancel()
+        if j.reached_endstate() and cookie not in self._hosts_in_use:
+            # It never got a host, so there is nothing to wait for
+            self._teardown_job(j)
+        logger.info("Job %s cancelled." % (cookie))
+        return j
+
     def _end_job(self, cookie):
         job = self.jobs[cookie]
         job.end()
-        if job.host not in self._pool_of_hosts_in_use:
+        if self._hosts_in_use.pop(cookie, None) is None \
+           and job.was_set_up():
             logger.warning("The host was not in use: %s" % job.cookie)
-        self._pool_of_hosts_in_use.discard(job.host)
         self.closed_jobs.append(job)
+        # The host is free now, a queued job might be waiting for it
+        self.wakeup_worker()
         #del self.jobs[job]
         # cant poll the status if we remove the job from jobs
         logger.info("Job %s ended." % cookie)
         return "Ended job %s." % cookie
 
+    def stats(self):
+        stats = {"scheduler": self.scheduler.stats(),
+                 "pipeline": self.pipeline.stats(),
+                 "hosts_in_use": sorted(self.hosts_in_use()),
+                 "hooks": self.hooks.stats()}
+        if self.store:
+            stats["store"] = self.store.stats()
+        return stats
+
     def submit_plan(self, plan):
         if plan.name in self._running_plans:
             raise Exception("Plan with same name already running: %s" %
                             plan.name)
         running_plan = JobCenter.PlanWorker(self, plan)
-        running_plan.start()
         self._running_plans[plan.name] = running_plan
+        self._journal_plan(running_plan)
+        running_plan.start()
         return running_plan
 
     def status_plan(self, name):
@@ -645,6 +1099,11 @@ class JobCenter(object):
             results = self._plan_results[name]
         return results
 
+    def plan_worker(self, name):
+        """Returns the worker of the running plan name, or None
+        """
+        return self._running_plans.get(name, None)
+
     def abort_plan(self, name):
         if name not in self._running_plans:
             #raise Exception("Plan is not running: %s" % name)
@@ -652,21 +1111,14 @@ class JobCenter(object):
         return self._running_plans[name].stop()
 
     def _run_hook(self, hook, cookie):
-        allowed_hooks = ["pre-job", "post-job", "post-testcase",
-                         "post-setup", "post-start", "post-annotate",
-                         "post-end"]
-        cmd_tpl = "{script} {hook} {cookie}"
-        if hook in allowed_hooks and os.path.isdir(self.hooks_path):
-            for scriptfile in os.listdir(self.hooks_path):
-                script = os.path.join(self.hooks_path, scriptfile)
-                cmd = cmd_tpl.format(script=script, hook=hook,
-                                     cookie=cookie)
-                logger.debug("Running hook: %s" % cmd)
-                os.system(cmd)
-        elif hook not in allowed_hooks:
-            logger.warning("Unknown hook: %s" % hook)
+        self.hooks.run(hook, cookie)
 
     class PlanWorker(threading.Thread):
+        """Runs the jobs of a plan.
+        Up to plan.parallel jobs are running at the same time, the jobs are
+        still queued in the JobCenter, which only starts a job once its host
+        is free.
+        """
         jc = None
         plan = None
 
@@ -679,6 +1131,7 @@ class JobCenter(object):
         status = None
 
         _do_end = False
+        _next_layout = 0
 
         def __init__(self, jc, plan):
             threading.Thread.__init__(self)
@@ -692,44 +1145,121 @@ class JobCenter(object):
         def run(self):
             logger.debug("Starting plan %s" % self.plan.name)
             self.status = "running"
+            self._publish_state()
+            parallel = max(1, int(self.plan.parallel or 1))
+
+            for jobspec in self.plan.job_specs(self._wait_for_previous_job,
+                                               self._next_layout):
+                self.jc.wait_for_endstates(lambda: self._do_end or
+                                           len(self.unfinished_jobs()) <
+                                           parallel)
+                if self._do_end:
+                    break
 
-            for jobspec in self.plan.job_specs():
                 resp = self.jc.submit(jobspec)
                 cookie, self.current_job = (resp["cookie"], resp["job"])
-                self.jc.start_job(cookie)
+                self.current_job.plan_name = self.plan.name
+                self.jc.events.publish("plan.job", plan=self.plan.name,
+                                       job=cookie)
+                self.jc.start_job(cookie, self.plan.priority)
                 self.jobs.append(self.current_job)
-                self.current_job.wait()
+                self._next_layout += 1
+                self.jc._journal_plan(self)
 
-                if self._do_end:
-                    logger.debug("Plan stopped: %s" % self.plan.name)
-                    self.passed = False
-                    break
+            self.jc.wait_for_endstates(lambda: self._do_end or
+                                       not self.unfinished_jobs())
 
-            self.passed = all([r.state() == s_passed
-                               for r in self.jobs])
+            if self._do_end:
+                logger.debug("Plan stopped: %s" % self.plan.name)
+                self.passed = False
+            else:
+                self.passed = all([r.state() == s_passed
+                                   for r in self.jobs])
 #            self.jobs.reverse()
             self.status = "stopped"
 
             self.jc._plan_results[self.plan.name] = self.__to_dict__()
             del self.jc._running_plans[self.plan.name]
+            self._publish_state()
+            if self.jc.store:
+                self.jc.store.remove("plan", self.plan.name)
+                self.jc.store.record("plan_result", self.plan.name,
+                                     lambda: self.jc._plan_results[
+                                         self.plan.name])
             logger.debug("Plan ended: %s" % self.plan.name)
 
+        def _wait_for_previous_job(self):
+            previous_job = self.current_job
+            if previous_job:
+                logger.debug("Waiting for job %s to end" %
+                             previous_job.cookie)
+                self.jc.wait_for_endstates(lambda: self._do_end or
+                                           previous_job.reached_endstate())
+
+        def _publish_state(self):
+            self.jc.events.publish("plan.state", plan=self.plan.name,
+                                   status=self.status, passed=self.passed)
+
+        def unfinished_jobs(self):
+            return [j for j in self.jobs if not j.reached_endstate()]
+
         def stop(self):
             logger.debug("Request to stop plan %s" % self.plan.name)
             self._do_end = True
-            if self.current_job:
-                self.jc.abort_job(self.current_job.cookie)
+            for j in self.unfinished_jobs():
+                try:
+                    self.jc.cancel_job(j.cookie)
+                except Exception as e:
+                    logger.debug("Could not cancel job %s: %s" %
+                                 (j.cookie, e.message))
+            with self.jc._endstate_condition:
+                self.jc._endstate_condition.notify_all()
             return self
 
         def runtime(self):
             return time.time() - self.created_at
 
-        def __to_dict__(self):
+        def __to_snapshot__(self):
+            return {"name": self.plan.name,
+                    "id": self.plan.id,
+                    "variables": self.plan.variables,
+                    "created_at": self.created_at,
+                    "jobs": [j.cookie for j in self.jobs],
+                    "next_layout": self._next_layout}
+
+        @staticmethod
+        def from_snapshot(jc, data, inventory):
+            """Rebuild a plan worker, it continues with the next layout
+            """
+            plan = inventory.plans(data["name"])
+            if plan is None:
+                raise Exception("Unknown plan '%s'" % data["name"])
+            plan.inventory = inventory
+            plan.id = data["id"]
+            plan.variables = data["variables"]
+            worker = JobCenter.PlanWorker(jc, plan)
+            worker.created_at = data["created_at"]
+            worker.jobs = [jc.jobs[c] for c in data["jobs"] if c in jc.jobs]
+            for job in worker.jobs:
+                job.plan_name = plan.name
+            worker.current_job = worker.jobs[-1] if worker.jobs else None
+            worker._next_layout = data["next_layout"]
+            return worker
+
+        def __to_dict__(self, job_to_dict=None):
+            """
+            Args:
+                job_to_dict: A function describing a job, defaults to the
+                             full dict of the job
+            """
+            job_to_dict = job_to_dict or (lambda j: j.__to_dict__())
             return {
                 "plan": self.plan.__to_dict__(),
-                "jobs": [r.__to_dict__() for r in self.jobs],
+                "jobs": [job_to_dict(r) for r in self.jobs],
                 "current_job_cookie": self.current_job.cookie
                 if self.current_job else "",
+                "running_job_cookies": [j.cookie for j
+                                        in self.unfinished_jobs()],
                 "passed": self.passed,
                 "runtime": self.runtime(),
                 "created_at": self.created_at,
@@ -737,42 +1267,38 @@ class JobCenter(object):
             }
 
     class JobWorker(utils.PollingWorkerDaemon):
+        """Starts queued and unwinds ended jobs.
+        The worker is woken up when a job is queued or reaches an end
+        state, polling is just a fallback.
+        """
         jc = None
         cleanup_age = None
         max_cleaned_jobs = 10
 
-        def __init__(self, jc, cleanup_age):
+        def __init__(self, jc, cleanup_age, interval=10):
             self.jc = jc
             self.cleanup_age = cleanup_age
-            utils.PollingWorkerDaemon.__init__(self)
+            utils.PollingWorkerDaemon.__init__(self, interval)
 
         def work(self):
-            if len(self.jc._queue_of_pending_jobs) == 0:
-                # No item
-                pass
-            else:
-                # FIXME this doesn't respect the order
-                for cookie in self.jc._queue_of_pending_jobs:
-                    candidate = self.jc.jobs[cookie]
-                    logger.debug("Checking if host is in use: %s" %
-                                 candidate.host)
-                    if candidate.host in self.jc._pool_of_hosts_in_use:
-                        self._debug("Host of candidate %s is still in use" %
-                                    cookie)
-                    else:
-                        self._debug("Starting job %s" % cookie)
-                        self.jc._run_hook("pre-job", cookie)
-                        self.jc._start_job(cookie)
-                        self.jc._queue_of_pending_jobs.remove(cookie)
-
-            # Look for ended jobs
+            # Look for ended jobs first, to free their hosts
             for cookie, j in self.jc.jobs.items():
                 if j.reached_endstate():
                     if not j._ended:
                         self._debug("Unwinding job %s" % cookie)
-                        self.jc._run_hook("post-job", cookie)
-                        self.jc._end_job(j.cookie)
-                        self.jc._queue_of_ended_jobs.append(j)
+                        self.jc._teardown_job(j)
+
+            hosts_in_use = self.jc.hosts_in_use()
+            assignments = self.jc.scheduler.schedule(hosts_in_use)
+            for candidate, host in assignments:
+                cookie = candidate.cookie
+                self._debug("Starting job %s on host %s" % (cookie,
+                                                            host.get_name()))
+                self.jc._start_job(cookie, host)
+            if assignments and self.jc.scheduler.queued():
+                # Hosts get their final name when they are assigned to a
+                # job, so check again if the remaining jobs can be started
+                self.wakeup()
 
             while len(self.jc._queue_of_ended_jobs) > self.max_cleaned_jobs:
                 self._remove_oldest_job()
@@ -790,5 +1316,8 @@ class JobCenter(object):
                 self._debug("Cleaning job %s" % oldest_job.cookie)
                 oldest_job.clean()
                 self.jc._queue_of_ended_jobs.remove(oldest_job)
-                del self.jc.jobs[oldest_job.cookie]
+                with self.jc._lock:
+                    del self.jc.jobs[oldest_job.cookie]
+                if self.jc.store:
+                    self.jc.store.remove("job", oldest_job.cookie)
                 logger.info("Job %s cleaned and removed." % oldest_job.cookie)
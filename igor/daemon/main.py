@@ -22,13 +22,18 @@
 The main module of igor, specifying the model.
 """
 
-from igor import log
-from igor.utils import run, update_properties_only
+from igor import archive, log
+from igor.utils import run, update_properties_only, file_stamp, \
+    copy_to_file
+import errno
+import hashlib
 import io
 import os
 import random
+import re
 import tarfile
 import tempfile
+import threading
 import time
 
 
@@ -52,9 +57,15 @@ class Host(UpdateableObject):
         The associated test session object - set when associated with a Job
     origin : Origin
         The corresponding origin - associated by Origin
+    labels : List of strings
+        Labels describing the class of this host, used by HostSelector
+    lookup_name : string
+        The name this host was looked up with in the inventory
     """
     session = None
     origin = None
+    labels = None
+    lookup_name = None
 
     def prepare(self):
         """Prepare a host until the point where a testsuite can be submitted.
@@ -87,11 +98,87 @@ class Host(UpdateableObject):
         """
         raise Exception("Not implemented.")
 
+    def get_labels(self):
+        """The labels of this host
+        """
+        return list(self.labels or [])
+
     def __to_dict__(self):
         return {"name": self.get_name(),
+                "labels": self.get_labels(),
                 "origin": self.origin}
 
 
+class HostSelector(Host):
+    """A placeholder for any host carrying all of the given labels.
+    The scheduler replaces it with a free matching host from the inventory
+    when the job gets started.
+
+    >>> class LabeledHost(Host):
+    ...     def __init__(self, name, labels):
+    ...         self.name, self.labels = name, labels
+    ...     def get_name(self):
+    ...         return self.name
+    >>> origin = Origin()
+    >>> origin.items = lambda: {"a": LabeledHost("a", ["lab", "x86"]),
+    ...                         "b": LabeledHost("b", ["lab"]),
+    ...                         "c": LabeledHost("c", ["x86", "lab", "big"])}
+    >>> inventory = Inventory(hosts={"fake": origin})
+    >>> s = inventory.hosts("label:x86,lab")
+    >>> s.get_name()
+    'label:x86,lab'
+    >>> [h.get_name() for h in s.candidates()]
+    ['a', 'c']
+
+    The candidates are cached, until one of them is taken:
+
+    >>> origin.items = lambda: {}
+    >>> [h.get_name() for h in s.candidates()]
+    ['a', 'c']
+    >>> s.taken(s.candidates()[0])
+    >>> s.candidates()
+    []
+    """
+    prefix = "label:"
+
+    inventory = None
+
+    def __init__(self, labels, inventory):
+        self.labels = labels
+        self.inventory = inventory
+
+    @staticmethod
+    def is_query(q):
+        return q is not None and q.startswith(HostSelector.prefix)
+
+    @staticmethod
+    def from_query(q, inventory):
+        labels = [l.strip() for l in q[len(HostSelector.prefix):].split(",")]
+        return HostSelector([l for l in labels if l], inventory)
+
+    def matches(self, host):
+        return set(self.get_labels()) <= set(host.get_labels())
+
+    def candidates(self):
+        """All hosts matching the labels, ordered by name
+        """
+        return self.inventory.host_candidates(self)
+
+    def taken(self, host):
+        """Note that host was picked, so the candidates get listed again
+        """
+        self.inventory.forget_candidates()
+
+    def get_name(self):
+        return self.prefix + ",".join(self.get_labels())
+
+    def _unresolved(self, *args, **kwargs):
+        raise Exception("Host selector %s was not resolved to a host" %
+                        self.get_name())
+
+    prepare = start = purge = get_mac_address = _unresolved
+
+
 class Profile(UpdateableObject):
     """A profile is some abstraction of an installation.
     """
@@ -161,6 +248,10 @@ class Inventory(object):
 
     _origins = None
 
+    candidates_max_age = 30
+    _candidates = None
+    _candidates_lock = None
+
     def __init__(self, plans={}, testsuites={}, profiles={}, hosts={}):
         """Each parameter is a list of callbacks to list all items of that
         category.
@@ -187,6 +278,8 @@ class Inventory(object):
         >>> "examplesuite" in i.testsuites()
         True
         """
+        self._candidates = {}
+        self._candidates_lock = threading.Lock()
         self._origins = {
             "plans": {},
             "testsuites": {},
@@ -242,7 +335,39 @@ class Inventory(object):
         return self._lookup("profiles", q)
 
     def hosts(self, q=None):
-        return self._lookup("hosts", q)
+        if HostSelector.is_query(q):
+            return HostSelector.from_query(q, self)
+        host = self._lookup("hosts", q)
+        if q is not None and host is not None:
+            # Remember the name, to be able to look up the host again
+            host.lookup_name = q
+        return host
+
+    def host_candidates(self, selector):
+        """All hosts matching a HostSelector, ordered by name.
+        Listing the hosts queries all origins, so the candidates are
+        reused for candidates_max_age seconds, or until forget_candidates()
+        is called.
+        """
+        key = selector.get_name()
+        now = time.time()
+        with self._candidates_lock:
+            listed_at, hosts = self._candidates.get(key, (0, None))
+            if hosts is None or now - listed_at > self.candidates_max_age:
+                hosts = [h for h in self.hosts().values()
+                         if not isinstance(h, HostSelector) and
+                         selector.matches(h)]
+                hosts = sorted(hosts, key=lambda h: h.get_name())
+                self._candidates[key] = (now, hosts)
+        return list(hosts)
+
+    def forget_candidates(self):
+        """Drop the cached candidates, they are listed again on the next
+        request. Some origins create a new host object on each listing,
+        a picked host must not be handed out again.
+        """
+        with self._candidates_lock:
+            self._candidates.clear()
 
     def check(self):
         logger.debug("Self checking invetory …")
@@ -276,6 +401,7 @@ class JobSpec(UpdateableObject):
     host = None
     profile = None
     additional_kargs = None
+    depends_on_previous = False
 
     def __to_dict__(self):
         return self.__dict__
@@ -297,12 +423,22 @@ class Testplan(object):
 
     inventory : An Inventory
         A pointer to an inventory to lookup the objects
+
+    parallel : int
+        The maximum number of jobs of this plan running at the same time.
+        A layout with depends_on_previous set is started once the job of
+        the previous layout ended.
+
+    priority : int
+        The jobs of plans with a higher priority are started first
     """
     name = None
     description = None
     job_layouts = None
     variables = None
     inventory = None
+    parallel = 1
+    priority = 0
 
     def __init__(self, name, job_layouts, inventory=None):
         self.name = name
@@ -323,18 +459,25 @@ class Testplan(object):
                     timeout += suite.timeout()
         return timeout
 
-    def job_specs(self):
+    def job_specs(self, wait_for_previous=None, first=0):
         """Converts the layout into specs.
         The layout contains the strings, here the strings are queried in the
         inventory and objects are created.
+
+        Args:
+            wait_for_previous: Called before a spec is created for a layout
+                               which depends on the previous one
+            first: The index of the first layout to use
         """
         self.variables["planid"] = self.id
         logger.debug("Replacing vars in spec %s: %s" % (self.name,
                                                         self.variables))
-        for layout in self.job_layouts:
+        for layout in self.job_layouts[first:]:
             """A generator is used (yield), because a followup spec might
             depend on infos from a previous spec (e.g. a host gets created)
             """
+            if layout.get("depends_on_previous") and wait_for_previous:
+                wait_for_previous()
             yield self.spec_from_layout(layout)
 
     def spec_from_layout(self, layout):
@@ -362,6 +505,7 @@ class Testplan(object):
 
             props = {k: item}
             spec.update_props(props)
+        spec.depends_on_previous = bool(layout.get("depends_on_previous"))
         return spec
 
     def _parse_toplevel_field_value(self, key, value):
@@ -403,6 +547,8 @@ class Testplan(object):
         return {"name": self.name,
                 "description": self.description,
                 "job_layouts": self.job_layouts,
+                "parallel": self.parallel,
+                "priority": self.priority,
                 "timeout": self.timeout()
                 }
 
@@ -462,9 +608,10 @@ class Testsuite(object):
                 "description": self.description
                 }
 
-    def get_archive(self, subdir="testcases"):
+    def get_archive(self, subdir="testcases", codec="bz2", level=None):
         """Creates an archive containing all testcases and optional testcase
         connected dirs.
+        The archive is compressed using the named codec (see igor.archive).
         Each testcase is prefixed with the step it has in the testsuite, this
         way there is a global ordering and allows testcases to appear more than
         once.
@@ -496,29 +643,155 @@ class Testsuite(object):
         True
         """
         r = io.BytesIO()
-        logger.debug("Preparing archive for testsuite %s" % self.name)
-        with tarfile.open(fileobj=r, mode="w:bz2") as archive:
-            self.__add_testcases_to_archive(archive, subdir)
-            self.__add_libs_to_archive(archive, os.path.join(subdir, "lib"))
+        self.__write_archive(r, subdir, archive.get_codec(codec), level)
         r.flush()
         return r
 
-    def __add_testcases_to_archive(self, archive, subdir):
-        """Add many testcases to the archive
+    def get_archive_file(self, cache_dir, subdir="testcases", codec="bz2",
+                         level=None):
+        """Returns the filename of an archive like get_archive creates it.
+        The archive is only built if no archive with the same digest
+        (see archive_digest) exists in cache_dir yet. Building it removes
+        the previous archive with the same codec and level, use
+        open_archive_file to read it.
+
+        >>> from igor.daemon.backends import files
+        >>> suites = files.Factory.testsuites_from_path( \
+                                                           "testcases/suites/")
+        >>> suite = suites["examplesuite"]
+        >>> cache_dir = tempfile.mkdtemp()
+        >>> filename = suite.get_archive_file(cache_dir)
+        >>> filename == suite.get_archive_file(cache_dir)
+        True
+        >>> os.listdir(cache_dir) == [os.path.basename(filename)]
+        True
+        >>> suite.get_archive_file(cache_dir, codec="gz").endswith(".tar.gz")
+        True
+
+        Archives with other levels are kept:
+
+        >>> fast = suite.get_archive_file(cache_dir, level=1)
+        >>> fast.endswith(".l1.tar.bz2")
+        True
+        >>> os.path.exists(filename)
+        True
         """
-        stepn = 0
+        codec = archive.get_codec(codec)
+        digest = self.archive_digest(subdir, level)
+        suffix = self.__archive_suffix(codec, level)
+        filename = os.path.join(cache_dir, "%s-%s%s" % (self.name, digest,
+                                                        suffix))
+        if not os.path.exists(filename):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmpfilename = tempfile.mkstemp(dir=cache_dir, prefix=".")
+            with os.fdopen(fd, "wb") as tmpfile:
+                self.__write_archive(tmpfile, subdir, codec, level)
+            os.rename(tmpfilename, filename)
+            self.__remove_stale_archives(cache_dir, filename, suffix)
+        return filename
+
+    def open_archive_file(self, cache_dir, subdir="testcases", codec="bz2",
+                          level=None):
+        """Returns (fileobj, filename) of an archive like get_archive_file
+        creates it. The file is opened right away, so it can still be read
+        if the archive is replaced by a newer one in the meantime.
+
+        >>> from igor.daemon.backends import files
+        >>> suites = files.Factory.testsuites_from_path("testcases/suites/")
+        >>> suite = suites["examplesuite"]
+        >>> cache_dir = tempfile.mkdtemp()
+        >>> fileobj, filename = suite.open_archive_file(cache_dir)
+        >>> os.remove(filename)
+        >>> len(fileobj.read()) > 0
+        True
+        >>> fileobj.close()
+        """
+        while True:
+            filename = self.get_archive_file(cache_dir, subdir, codec, level)
+            try:
+                return open(filename, "rb"), filename
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                logger.debug("Archive %s was replaced, retrying" % filename)
+
+    def archive_digest(self, subdir="testcases", level=None):
+        """A digest over the names and stamps of all files which end up in
+        the archive (testcases, testcase dirs, deps and libs).
+        The digest changes as soon as one of this files changes.
+        """
+        digest = hashlib.sha1()
+        digest.update("%s %s\n" % (subdir, level))
+
+        def add_path(arcname, path):
+            for root, dirs, filenames in os.walk(path):
+                dirs.sort()
+                for fn in sorted(filenames):
+                    filename = os.path.join(root, fn)
+                    name = os.path.join(arcname,
+                                        os.path.relpath(filename, path))
+                    digest.update("%s %s\n" % (name, file_stamp(filename)))
+            digest.update("%s %s\n" % (arcname, file_stamp(path)))
+
+        for arcname, testcase in self.__archived_testcases(subdir):
+            add_path(arcname, testcase.filename)
+            add_path(arcname + ".d", testcase.filename + ".d")
+            digest.update("%s.deps %s\n" % (arcname, testcase.dependencies))
+        for libname, libpath in sorted(self.libs().items()):
+            add_path(os.path.join(subdir, "lib", libname), libpath)
+        return digest.hexdigest()
+
+    def __archive_suffix(self, codec, level):
+        """The suffix of the archive files, it differs for each codec and
+        level, so archives of other levels are not seen as stale
+        """
+        if level is None:
+            return codec.suffix
+        return ".l%d%s" % (level, codec.suffix)
+
+    def __remove_stale_archives(self, cache_dir, current_filename, suffix):
+        """Remove previous archives of this suite with the same suffix
+        """
+        pat = re.compile("^%s-[0-9a-f]{40}%s$" % (re.escape(self.name),
+                                                  re.escape(suffix)))
+        for fn in os.listdir(cache_dir):
+            filename = os.path.join(cache_dir, fn)
+            if pat.match(fn) and filename != current_filename:
+                logger.debug("Removing stale archive %s" % filename)
+                os.remove(filename)
+
+    def __write_archive(self, fileobj, subdir, codec, level):
+        logger.debug("Preparing %s archive for testsuite %s" %
+                     (codec, self.name))
+        with archive.open_for_writing(fileobj, codec, level) as tarball:
+            self.__add_testcases_to_archive(tarball, subdir)
+            self.__add_libs_to_archive(tarball, os.path.join(subdir, "lib"))
+
+    def __archived_testcases(self, subdir):
+        """Returns a list of (arcname, testcase) of all testcases which end
+        up in the archive
+        """
+        testcases = []
         for testcase in self.testcases():
-            logger.debug("Adding testcase #%s: %s" % (stepn,
-                                                      testcase.name))
             if testcase.filename is None:
                 logger.warning("Empty testcase: %s" % testcase.name)
                 continue
 
             arcname = os.path.join(subdir, "%d-%s" %
-                                   (stepn,
-                                   os.path.basename(testcase.filename)))
+                                   (len(testcases),
+                                    os.path.basename(testcase.filename)))
+            testcases.append((arcname, testcase))
+        return testcases
+
+    def __add_testcases_to_archive(self, archive, subdir):
+        """Add many testcases to the archive
+        """
+        for stepn, (arcname, testcase) in \
+                enumerate(self.__archived_testcases(subdir)):
+            logger.debug("Adding testcase #%s: %s" % (stepn,
+                                                      testcase.name))
             self.__add_testcase_to_archive(archive, arcname, testcase)
-            stepn += 1
 
     def __add_testcase_to_archive(self, archive, arcname, testcase):
         """Add a single testcase to the archive
@@ -694,11 +967,22 @@ class TestSession(UpdateableObject):
 
     do_cleanup = False
 
-    def __init__(self, cookie, session_path, cleanup=True):
+    def __init__(self, cookie, session_path, cleanup=True, dirname=None):
+        """
+        Args:
+            dirname: Reuse the dir of an existing session
+        """
         assert session_path is not None, "session path can not be None"
 
         self.do_cleanup = cleanup
         self.cookie = cookie
+        if dirname and os.path.isdir(dirname):
+            self.dirname = dirname
+            logger.info("Reopening session %s in %s" % (self.cookie,
+                                                        self.dirname))
+            if not os.path.isdir(self.__artifacts_path()):
+                os.mkdir(self.__artifacts_path())
+            return
         self.dirname = tempfile.mkdtemp(suffix="-" + self.cookie,
                                         dir=session_path)
         os.mkdir(self.__artifacts_path())
@@ -736,14 +1020,23 @@ class TestSession(UpdateableObject):
         assert self.dirname is not None
         return os.path.join(self.dirname, "artifacts", name)
 
-    def add_artifact(self, name, data):
+    def add_artifact(self, name, data, max_size=None, checksum=None):
         """Adds an artifact
+        data can be a string or a file object, file objects are streamed
+        into the artifact, see utils.copy_to_file for max_size and checksum.
+
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.add_artifact("streamed", io.BytesIO("foo"))
+        >>> s.get_artifact("streamed")
+        'foo'
         """
         assert("/" not in name and "\\" not in name)
         afilename = self.__artifacts_path(name)
-        # fixme collsisions
-        with open(afilename, "wb") as afile:
-            afile.write(data)
+        if not hasattr(data, "read"):
+            data = io.BytesIO(data)
+        # The tmpfile lives in the session dir, to keep it out of the listing
+        copy_to_file(data, afilename, max_size=max_size, checksum=checksum,
+                     tmpdir=self.dirname)
 
     def get_artifact(self, name):
         """Returns the data/content of an artifact
@@ -775,20 +1068,29 @@ class TestSession(UpdateableObject):
                    for fn in fns]
         return fns
 
-    def get_artifacts_archive(self, selection=None):
-        """Return all artifacts as an .tar.bz2
+    def get_artifacts_archive(self, selection=None, codec="bz2", level=None):
+        """Return all artifacts as a tarball compressed with codec.
+        The tarball is returned as a generator, yielding the chunks of the
+        tarball while the artifacts are read.
+
+        >>> s = TestSession("cookie", "/tmp/")
+        >>> s.add_artifact("test", "foo")
+        >>> tarball = io.BytesIO("".join(s.get_artifacts_archive()))
+        >>> tarfile.open(fileobj=tarball).extractfile("test").read()
+        'foo'
         """
         selection = selection or self.artifacts()
-        container = io.BytesIO()
         logger.debug("Preparing artifacts archive for session %s" %
                      self.cookie)
-        with tarfile.open(fileobj=container, mode="w:bz2") as archive:
-            for artifact in selection:
-                if artifact not in self.artifacts():
-                    logger.debug("Artifact not here: %s" % artifact)
-                logger.debug("Adding artifact %s" % artifact)
-                archive.add(self.__artifacts_path(artifact), artifact)
-        return container
+        members = []
+        available = self.artifacts()
+        for artifact in selection:
+            if artifact not in available:
+                logger.debug("Artifact not here: %s" % artifact)
+                continue
+            logger.debug("Adding artifact %s" % artifact)
+            members.append((artifact, self.__artifacts_path(artifact)))
+        return archive.iter_tarball(members, archive.get_codec(codec), level)
 
     def __enter__(self):
         logger.debug("With session '%s'" % self.cookie)
@@ -18,7 +18,9 @@
 #
 # -*- coding: utf-8 -*-
 
+import hashlib
 import os
+import pipes
 from igor import log
 from igor.daemon import main
 from igor.utils import run
@@ -26,6 +28,24 @@ from igor.utils import run
 logger = log.getLogger(__name__)
 
 
+def size_to_bytes(size):
+    """Convert a size with a K, M or G suffix into bytes, like truncate does
+
+    >>> size_to_bytes("8G")
+    8589934592
+    >>> size_to_bytes("1m")
+    1048576
+    >>> size_to_bytes("512")
+    512
+    """
+    size = str(size).strip()
+    units = {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+    unit = units.get(size[-1:].lower())
+    if unit:
+        return int(size[:-1]) * unit
+    return int(size)
+
+
 class DiskImage(main.UpdateableObject):
     filename = None
     size = None
@@ -55,6 +75,9 @@ class Layout(DiskImage):
     label = None
     partitions = None
 
+    # parted calls the mbr label msdos
+    parted_labels = {"gpt": "gpt", "mbr": "msdos"}
+
     def __init__(self, size, partitions, label="gpt", filename=None):
         super(Layout, self).__init__(filename, size or 4, "raw")
         if label not in ["gpt", "mbr"]:
@@ -71,33 +94,60 @@ class Layout(DiskImage):
         self.__partition()
         return self.filename
 
+    def digest(self):
+        """A digest of the layout, images with the same digest have the
+        same contents after create()
+
+        >>> a = Layout("8G", [Partition("pri", "1M", "1G")])
+        >>> b = Layout("8G", [Partition("pri", "1M", "1G")])
+        >>> a.digest() == b.digest()
+        True
+        >>> a.digest() == Layout("8G", [Partition("pri", "1M", "2G")]).digest()
+        False
+        >>> a.digest() == Layout("4G", [Partition("pri", "1M", "1G")]).digest()
+        False
+        """
+        spec = [self.size, self.label]
+        spec += [p.__to_parted__() for p in self.partitions if p]
+        return hashlib.sha1("\n".join(map(str, spec))).hexdigest()
+
     def remove(self):
         logger.debug("Removing VM image '%s'" % self.filename)
         os.remove(self.filename)
 
     def __truncate(self):
-        run("truncate --size=%s '%s'" % (self.size, self.filename))
-
-    def __partition(self):
-        for_parted = []
-
-        # Create label
-        if self.label not in ['gpt', 'mbr', 'loop']:
+        # A sparse file, like truncate --size
+        with open(self.filename, "ab") as image:
+            image.truncate(size_to_bytes(self.size))
+
+    def parted_command(self):
+        """The parted call creating the label and all partitions at once
+
+        >>> l = Layout("8G", [Partition("pri", "1M", "1G"),
+        ...                   Partition("pri", "1G", "2G", "ext4")],
+        ...            label="mbr", filename="/tmp/my image")
+        >>> l.parted_command()
+        "parted -s '/tmp/my image' mklabel msdos mkpart pri 1M 1G \
+mkpart pri ext4 1G 2G"
+        """
+        if self.label not in self.parted_labels:
             raise Exception("No valid label given.")
-        for_parted.append("mklabel %s" % self.label)
+        args = ["parted", "-s", self.filename,
+                "mklabel", self.parted_labels[self.label]]
 
-        # Create all partitions
-        if self.partitions is None or len(self.partitions) is 0:
+        if not any(self.partitions or []):
             logger.debug("No partitions given")
-        else:
-            for p in self.partitions:
-                for_parted.append(p.__to_parted__())
+        for p in self.partitions or []:
+            if p:
+                args += p.__to_parted__().split()
 
-        # Quit parted
-        for_parted.append("quit")
+        return " ".join(pipes.quote(arg) for arg in args)
 
-        for parted_cmd in for_parted:
-            run("parted '%s' '%s'" % (self.filename, parted_cmd))
+    def __partition(self):
+        retval, output = run(self.parted_command(), with_retval=True)
+        if retval != 0:
+            raise Exception("Partitioning '%s' failed: %s" % (self.filename,
+                                                              output))
 
 
 class Partition(main.UpdateableObject):
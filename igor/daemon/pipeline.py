@@ -0,0 +1,140 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Sets up and tears down jobs in the background.
+"""
+
+from igor import log, utils
+import contextlib
+import threading
+import time
+
+logger = log.getLogger(__name__)
+
+
+class Pipeline(object):
+    """Runs the setup and teardown of jobs on a bounded pool of workers.
+    The setup and teardown consist of stages (like preparing the host),
+    the number of jobs in a stage at the same time can be limited, to not
+    have too many disk images compressed or uploaded at once.
+    The steps of a single job are run in the order they were submitted.
+
+    >>> class J(object):
+    ...     cookie = "i2Xyz"
+    ...     stages = []
+    ...     def record_stage(self, name, started_at, runtime, waited):
+    ...         self.stages.append(name)
+    >>> p = Pipeline(workers=2, stage_limits={"prepare": 1})
+    >>> def setup(job):
+    ...     with p.stage(job, "prepare"):
+    ...         pass
+    >>> p.submit(J(), setup, J())
+    True
+    >>> p.join()
+    >>> J.stages
+    ['prepare']
+    >>> p.stats()["stages"]["prepare"]["limit"]
+    1
+    """
+    default_stage_limits = {"prepare": 2,
+                            "assign": 2}
+
+    _pool = None
+    _limits = None
+    _semaphores = None
+    _stats = None
+    _stats_lock = None
+
+    def __init__(self, workers=8, stage_limits=None):
+        """
+        Args:
+            workers: The number of jobs set up or torn down at once
+            stage_limits: A dict stage:n, at most n jobs are in the stage
+                          at once, other stages are only bounded by workers
+        """
+        # Nothing is dropped, a job would never get started or torn down
+        self._pool = utils.WorkerPool(workers, max_pending=0,
+                                      name="pipeline")
+        self._limits = dict(self.default_stage_limits)
+        self._limits.update(stage_limits or {})
+        self._semaphores = dict((stage, threading.BoundedSemaphore(n))
+                                for stage, n in self._limits.items() if n)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def submit(self, job, func, *args):
+        """Call func(*args) in the background
+        """
+        return self._pool.submit(job.cookie, func, *args)
+
+    def join(self):
+        self._pool.join()
+
+    @contextlib.contextmanager
+    def stage(self, job, name):
+        """Runs the body as stage name of job, the time spent in the stage
+        and waiting for it is recorded with the job (job.record_stage)
+        """
+        semaphore = self._semaphores.get(name)
+        stats = self._stage_stats(name)
+        queued_at = time.time()
+        with self._stats_lock:
+            stats["waiting"] += 1
+        if semaphore:
+            semaphore.acquire()
+        started_at = time.time()
+        with self._stats_lock:
+            stats["waiting"] -= 1
+            stats["active"] += 1
+        try:
+            yield
+        finally:
+            if semaphore:
+                semaphore.release()
+            runtime = time.time() - started_at
+            with self._stats_lock:
+                stats["active"] -= 1
+                stats["runs"] += 1
+                stats["total_runtime"] += runtime
+            logger.debug("Job %s: stage %s took %.2fs (waited %.2fs)" %
+                         (job.cookie, name, runtime,
+                          started_at - queued_at))
+            job.record_stage(name, started_at, runtime,
+                             started_at - queued_at)
+
+    def _stage_stats(self, name):
+        with self._stats_lock:
+            if name not in self._stats:
+                self._stats[name] = {"limit": self._limits.get(name),
+                                     "waiting": 0,
+                                     "active": 0,
+                                     "runs": 0,
+                                     "total_runtime": 0}
+            return self._stats[name]
+
+    def stats(self):
+        with self._stats_lock:
+            stages = dict((name, dict(s)) for name, s in self._stats.items())
+        for name, limit in self._limits.items():
+            stages.setdefault(name, {"limit": limit})
+        return {"stages": stages,
+                "pending": self._pool.pending(),
+                "dropped": self._pool.dropped}
@@ -0,0 +1,162 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+Decides which of the queued jobs are started next, and on which hosts.
+"""
+
+from igor import log
+import collections
+import heapq
+import itertools
+import main
+import threading
+import time
+
+logger = log.getLogger(__name__)
+
+
+class Scheduler(object):
+    """Keeps the queue of pending jobs.
+    Jobs are ordered by priority (higher first) and the time they were
+    queued. A job which can't be started, because no matching host is free,
+    doesn't block the jobs behind it.
+    The priority of a job rises by one for each aging_interval seconds it
+    waited, so jobs with a low priority are not starved by a steady flow
+    of jobs with a higher one.
+
+    >>> class H(object):
+    ...     def __init__(self, name):
+    ...         self.name = name
+    ...     def get_name(self):
+    ...         return self.name
+    >>> class J(object):
+    ...     def __init__(self, cookie, host):
+    ...         self.cookie, self.host = cookie, host
+    >>> s = Scheduler()
+    >>> s.enqueue(J("a", H("h1")))
+    >>> s.enqueue(J("b", H("h1")))
+    >>> s.enqueue(J("c", H("h2")), priority=5)
+    >>> s.enqueue(J("d", H("h3")))
+    >>> [(j.cookie, h.get_name()) for j, h in s.schedule(set(["h3"]))]
+    [('c', 'h2'), ('a', 'h1')]
+    >>> s.queued()
+    ['b', 'd']
+    >>> s.stats()["queue_depth"]
+    2
+
+    A low priority job which waited long enough overtakes new jobs with a
+    higher priority:
+
+    >>> s = Scheduler()
+    >>> s.aging_interval = 0.1
+    >>> s.enqueue(J("low", H("h1")))
+    >>> time.sleep(0.35)
+    >>> for n in range(3):
+    ...     s.enqueue(J("high%d" % n, H("h1")), priority=3)
+    >>> [j.cookie for j, h in s.schedule(set())]
+    ['low']
+    """
+    max_wait_samples = 100
+    aging_interval = 60
+
+    _queue = None
+    _counter = None
+    _lock = None
+    _wait_times = None
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wait_times = collections.deque(maxlen=self.max_wait_samples)
+
+    def enqueue(self, job, priority=0):
+        with self._lock:
+            heapq.heappush(self._queue, (-int(priority), next(self._counter),
+                                         time.time(), job))
+
+    def remove(self, job):
+        """Remove a job from the queue, if it is queued
+        """
+        with self._lock:
+            self._queue = [e for e in self._queue if e[3] is not job]
+            heapq.heapify(self._queue)
+
+    def queued(self):
+        """The cookies of all queued jobs, in the order they'd be started
+        """
+        with self._lock:
+            return [e[3].cookie for e in self._ordered()]
+
+    def _ordered(self):
+        """The queue entries by their priority, including the aging
+        """
+        now = time.time()
+        return sorted(self._queue,
+                      key=lambda e: (e[0] - (now - e[2]) /
+                                     self.aging_interval, e[1]))
+
+    def schedule(self, hosts_in_use):
+        """Picks the jobs which can be started now and removes them from
+        the queue.
+
+        Args:
+            hosts_in_use: A set with the names of the busy hosts
+        Returns:
+            A list of (job, host) tuples, the job shall be run on host
+        """
+        hosts_in_use = set(hosts_in_use)
+        assignments = []
+        with self._lock:
+            for entry in self._ordered():
+                job = entry[3]
+                host = self._pick_host(job, hosts_in_use)
+                if host is None:
+                    logger.debug("No free host for job %s" % job.cookie)
+                    continue
+                hosts_in_use.add(host.get_name())
+                assignments.append((job, host))
+                self._queue.remove(entry)
+                self._wait_times.append(time.time() - entry[2])
+            heapq.heapify(self._queue)
+        return assignments
+
+    def _pick_host(self, job, hosts_in_use):
+        if not isinstance(job.host, main.HostSelector):
+            if job.host.get_name() not in hosts_in_use:
+                return job.host
+            return None
+        for host in job.host.candidates():
+            if host.get_name() not in hosts_in_use:
+                job.host.taken(host)
+                return host
+        return None
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            waiting = [now - e[2] for e in self._queue]
+            waited = list(self._wait_times)
+        return {"queue_depth": len(waiting),
+                "longest_wait": max(waiting) if waiting else 0,
+                "recent_wait_mean": (sum(waited) / len(waited)
+                                     if waited else 0),
+                "recent_wait_max": max(waited) if waited else 0}
@@ -0,0 +1,350 @@
+#
+# Copyright (C) 2013  Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; either version 2.1 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Author: Fabian Deutsch <fabiand@fedoraproject.org>
+#
+# -*- coding: utf-8 -*-
+
+"""
+A persistent store for the state of jobs and plans, so igord can pick up
+where it left after a restart.
+"""
+
+from igor import log, utils
+from igor.daemon.hacks import IgordJSONEncoder
+import json
+import os
+import sqlite3
+import threading
+import time
+
+logger = log.getLogger(__name__)
+
+
+class JobStore(object):
+    """Keeps snapshots of jobs and plans in an append-only SQLite journal.
+
+    Changes are only noted by record() and written in batches by a worker,
+    so several changes of an item within one interval end up in one row.
+    The journal is compacted to the latest snapshot of each item once it
+    grew too large, this bounds the time needed to load it.
+
+    The summaries of job snapshots are additionally kept in an indexed
+    history table, which is not compacted, see history().
+
+    >>> store = JobStore(":memory:", interval=None)
+    >>> store.record("job", "a", lambda: {"state": "open"})
+    >>> store.record("job", "a", lambda: {"state": "running"})
+    >>> store.record("job", "b", lambda: {"state": "open"})
+    >>> store.flush()
+    2
+    >>> sorted(store.load("job").items())
+    [(u'a', {u'state': u'running'}), (u'b', {u'state': u'open'})]
+    >>> store.remove("job", "a")
+    >>> store.flush()
+    1
+    >>> store.load("job").keys()
+    [u'b']
+    >>> store.compact()
+    >>> store.rows()
+    1
+
+    Missing parent directories of the database are created:
+
+    >>> import tempfile, shutil
+    >>> tmpdir = tempfile.mkdtemp()
+    >>> store = JobStore(os.path.join(tmpdir, "session", "jobs.db"),
+    ...                  interval=None)
+    >>> os.path.exists(os.path.join(tmpdir, "session", "jobs.db"))
+    True
+    >>> shutil.rmtree(tmpdir)
+    """
+    path = None
+    compact_min_rows = 1000
+    history_max_rows = 10000
+
+    _db = None
+    _lock = None
+    _pending = None
+    _pending_lock = None
+    _flush_lock = None
+    _worker = None
+
+    def __init__(self, path, interval=1):
+        """
+        Args:
+            path: The SQLite database file, or :memory:
+            interval: Seconds between two flushes, None to flush manually
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+        logger.info("Opening job store %s" % path)
+        dirname = os.path.dirname(path)
+        if path != ":memory:" and dirname and not os.path.exists(dirname):
+            logger.debug("Creating job store directory %s" % dirname)
+            os.makedirs(dirname)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            # WAL allows readers while the worker is writing
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS journal (" +
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                         "kind TEXT NOT NULL, " +
+                         "key TEXT NOT NULL, " +
+                         "created_at REAL NOT NULL, " +
+                         "data TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS journal_item " +
+                         "ON journal (kind, key, id)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS history (" +
+                         "seq INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                         "cookie TEXT UNIQUE NOT NULL, " +
+                         "state TEXT, " +
+                         "host TEXT, " +
+                         "testsuite TEXT, " +
+                         "created_at REAL, " +
+                         "summary TEXT)")
+        for column in ["state", "host", "testsuite", "created_at"]:
+            self._db.execute(("CREATE INDEX IF NOT EXISTS history_%s " +
+                              "ON history (%s, seq)") % (column, column))
+        self._db.commit()
+
+        if interval:
+            self._worker = JobStore.FlushWorker(self, interval)
+            self._worker.start()
+
+    def record(self, kind, key, snapshot):
+        """Note that an item changed.
+
+        Args:
+            kind: The kind of item, e.g. job or plan
+            key: The unique name of the item
+            snapshot: A callable returning the JSON-able state of the item,
+                      it is called when the change gets written
+        """
+        with self._pending_lock:
+            self._pending[(kind, key)] = snapshot
+
+    def remove(self, kind, key):
+        """Note that an item is gone
+        """
+        with self._pending_lock:
+            self._pending[(kind, key)] = None
+
+    def flush(self):
+        """Write all pending changes in one transaction.
+        Flushes are serialized, so an older snapshot can not be written
+        after a newer one. Items which could not be snapshotted stay
+        pending.
+
+        >>> store = JobStore(":memory:", interval=None)
+        >>> state = {"n": None}
+        >>> def snapshot():
+        ...     return {"n": 1 / state["n"]}
+        >>> store.record("job", "a", snapshot)
+        >>> store.flush()
+        0
+        >>> state["n"] = 1
+        >>> store.flush()
+        1
+        >>> store.load("job")
+        {u'a': {u'n': 1}}
+
+        Returns:
+            The number of written rows
+        """
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        now = time.time()
+        rows = []
+        summaries = []
+        for (kind, key), snapshot in pending.items():
+            data = None
+            if snapshot is not None:
+                try:
+                    obj = snapshot()
+                    data = json.dumps(obj, cls=IgordJSONEncoder)
+                except Exception as e:
+                    logger.warning("Could not snapshot %s %s: %s" %
+                                   (kind, key, e))
+                    with self._pending_lock:
+                        # Retried with the next flush, unless it changed
+                        self._pending.setdefault((kind, key), snapshot)
+                    continue
+                if kind == "job" and "summary" in obj:
+                    summaries.append(obj["summary"])
+            rows.append((kind, key, now, data))
+
+        with self._lock:
+            with self._db:
+                self._db.executemany("INSERT INTO journal " +
+                                     "(kind, key, created_at, data) " +
+                                     "VALUES (?, ?, ?, ?)", rows)
+                # Sorted, to assign the history seqs in submission order
+                for summary in sorted(summaries,
+                                      key=lambda s: (s["created_at"],
+                                                     s["id"])):
+                    self._update_history(summary)
+        logger.debug("Flushed %d changes to the job store" % len(rows))
+
+        if self.rows() > max(self.compact_min_rows, 2 * self.items()):
+            self.compact()
+
+        return len(rows)
+
+    def _update_history(self, summary):
+        values = (summary["state"], summary["host"], summary["testsuite"],
+                  summary["created_at"],
+                  json.dumps(summary, cls=IgordJSONEncoder), summary["id"])
+        cursor = self._db.execute("UPDATE history SET state = ?, " +
+                                  "host = ?, testsuite = ?, " +
+                                  "created_at = ?, summary = ? " +
+                                  "WHERE cookie = ?", values)
+        if cursor.rowcount == 0:
+            self._db.execute("INSERT INTO history (state, host, " +
+                             "testsuite, created_at, summary, cookie) " +
+                             "VALUES (?, ?, ?, ?, ?, ?)", values)
+
+    def history(self, state=None, host=None, testsuite=None, since=None,
+                limit=50, cursor=None):
+        """Returns the summaries of jobs, the most recently submitted first.
+
+        Args:
+            state, host, testsuite: Only jobs with this value
+            since: Only jobs created at or after this timestamp
+            limit: The maximum number of jobs to return
+            cursor: The cursor returned by a previous call, to continue
+        Returns:
+            A tuple (summaries, cursor), cursor is None if there are no more
+            jobs
+
+        >>> store = JobStore(":memory:", interval=None)
+        >>> for n in range(5):
+        ...     summary = {"id": "j%d" % n, "state": "passed",
+        ...                "host": "h%d" % (n % 2), "testsuite": "ts",
+        ...                "created_at": n}
+        ...     store.record("job", "j%d" % n, lambda s=summary: {
+        ...                  "summary": s})
+        >>> store.flush()
+        5
+        >>> jobs, cursor = store.history(host="h0", limit=2)
+        >>> [j["id"] for j in jobs]
+        [u'j4', u'j2']
+        >>> jobs, cursor = store.history(host="h0", limit=2, cursor=cursor)
+        >>> [j["id"] for j in jobs], cursor
+        ([u'j0'], None)
+        >>> [j["id"] for j in store.history(since=3)[0]]
+        [u'j4', u'j3']
+        """
+        self.flush()
+        clauses, args = [], []
+        for column, value in [("state", state), ("host", host),
+                              ("testsuite", testsuite)]:
+            if value is not None:
+                clauses.append("%s = ?" % column)
+                args.append(value)
+        if since is not None:
+            clauses.append("created_at >= ?")
+            args.append(since)
+        if cursor is not None:
+            clauses.append("seq < ?")
+            args.append(cursor)
+        sql = "SELECT seq, summary FROM history"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY seq DESC LIMIT ?"
+        args.append(limit + 1)
+
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [json.loads(s) for _, s in rows[:limit]], next_cursor
+
+    def load(self, kind):
+        """Returns a dict key:snapshot with the latest snapshot of all
+        items of a kind
+        """
+        with self._lock:
+            cursor = self._db.execute("SELECT key, data FROM journal " +
+                                      "WHERE id IN (SELECT MAX(id) " +
+                                      "FROM journal WHERE kind = ? " +
+                                      "GROUP BY key)", (kind,))
+            return dict((key, json.loads(data))
+                        for key, data in cursor.fetchall()
+                        if data is not None)
+
+    def compact(self):
+        """Drop everything but the latest snapshot of each item
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM journal WHERE id NOT IN " +
+                                 "(SELECT MAX(id) FROM journal " +
+                                 "GROUP BY kind, key)")
+                self._db.execute("DELETE FROM journal WHERE data IS NULL")
+                self._db.execute("DELETE FROM history WHERE seq <= " +
+                                 "(SELECT MAX(seq) FROM history) - ?",
+                                 (self.history_max_rows,))
+        logger.debug("Compacted the job store to %d rows" % self.rows())
+
+    def rows(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM journal"
+                                    ).fetchone()[0]
+
+    def items(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM (SELECT DISTINCT " +
+                                    "kind, key FROM journal)").fetchone()[0]
+
+    def close(self):
+        if self._worker:
+            self._worker.stop()
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+    def stats(self):
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"path": self.path,
+                "rows": self.rows(),
+                "items": self.items(),
+                "pending": pending}
+
+    class FlushWorker(utils.PollingWorkerDaemon):
+        store = None
+
+        def __init__(self, store, interval):
+            self.store = store
+            utils.PollingWorkerDaemon.__init__(self, interval)
+
+        def work(self):
+            try:
+                self.store.flush()
+            except Exception as e:
+                logger.warning("Flushing the job store failed: %s" % e)
@@ -18,8 +18,10 @@
 #
 # -*- coding: utf-8 -*-
 
+import copy
 import os
 import simplejson as json
+import threading
 from lxml import etree
 import utils
 
@@ -34,6 +36,9 @@ TRANSFORM_MAP = {
                                        "testplan-report.junit.xsl"),
 }
 
+# The namespaces declared by the junit stylesheets, they end up in the report
+JUNIT_NSMAP = {"fn": "http://www.w3.org/2005/xpath-functions"}
+
 
 def job_status_to_report_json(txt):
     """Apply the plaintext report transformation to a json obj (str)
@@ -66,6 +71,53 @@ def testplan_status_to_junit_report(d):
     return _map_transform(d, "testplan-junit-xml", "testplan")
 
 
+def job_status_to_junit_fragment(d):
+    """Transform a job status dict to the testsuite element, which
+    represents the job in the junit report of a testplan
+    """
+    return job_status_to_junit(d).getroot()
+
+
+def testplan_fragments_to_junit_report(name, fragments):
+    """Stitch the junit report of a testplan together from the fragments of
+    its jobs (see job_status_to_junit_fragment)
+    The result is the same as testplan_status_to_junit_report, which counts
+    the tests, failures and skipped tests of all jobs in each testsuite.
+
+    >>> def job(n, passed):
+    ...     testcases = [{"name": "tc%d" % i} for i in range(n)]
+    ...     results = [{"is_passed": passed, "is_skipped": False}] * n
+    ...     return {"id": "j%d" % n, "host": "h", "is_endstate": True,
+    ...             "testsuite": {"name": "s",
+    ...                           "testsets": [{"name": "set",
+    ...                                         "testcases": testcases}]},
+    ...             "results": results}
+    >>> jobs = [job(2, True), job(3, False)]
+    >>> fragments = [job_status_to_junit_fragment(j) for j in jobs]
+    >>> stitched = testplan_fragments_to_junit_report("p", fragments)
+    >>> transformed = testplan_status_to_junit_report({"plan": {"name": "p"},
+    ...                                                "jobs": jobs})
+    >>> to_xml_str(stitched) == to_xml_str(transformed)
+    True
+    >>> [(e.get("tests"), e.get("failures")) for e in stitched]
+    [('5', '3'), ('5', '3')]
+    """
+    totals = {}
+    for attribute in ["tests", "failures", "skipped"]:
+        totals[attribute] = str(sum(int(f.get(attribute) or 0)
+                                    for f in fragments))
+
+    root = etree.Element("testsuites", nsmap=JUNIT_NSMAP)
+    root.set("name", name)
+    for fragment in fragments:
+        # Copied, the fragments are kept for the next report
+        fragment = copy.deepcopy(fragment)
+        for attribute, total in totals.items():
+            fragment.set(attribute, total)
+        root.append(fragment)
+    return root
+
+
 def _map_transform(d, t, rootname="status"):
     assert t in TRANSFORM_MAP, "Unknown transformation: %s" % t
     return transform_dict(TRANSFORM_MAP[t], d, rootname)
@@ -81,11 +133,37 @@ def transform_dict(stylefile, d, rootname):
 def transform_xml(stylefile, xml):
     """Transform an XML Object into another XML objcet using a stylesheet
     """
-    transform = etree.XSLT(etree.parse(stylefile))
+    transform = compiled_stylesheet(stylefile)
     report = transform(xml)
     return report
 
 
+_stylesheets = threading.local()
+
+
+def compiled_stylesheet(stylefile):
+    """Returns the compiled XSLT of stylefile.
+    Compiling a stylesheet takes much longer than applying it, so the
+    compiled stylesheets are kept and only recompiled when the file changed.
+    An XSLT object must not be shared between threads, so each thread keeps
+    its own copies - igord handles requests in a fixed set of threads, which
+    reuse their copies.
+
+    >>> a = compiled_stylesheet(TRANSFORM_MAP["job-rst"])
+    >>> a is compiled_stylesheet(TRANSFORM_MAP["job-rst"])
+    True
+    >>> a is compiled_stylesheet(TRANSFORM_MAP["job-junit"])
+    False
+    """
+    cache = getattr(_stylesheets, "cache", None)
+    if cache is None:
+        cache = _stylesheets.cache = {}
+    mtime = os.stat(stylefile).st_mtime
+    if stylefile not in cache or cache[stylefile][0] != mtime:
+        cache[stylefile] = (mtime, etree.XSLT(etree.parse(stylefile)))
+    return cache[stylefile][1]
+
+
 def to_xml_str(etree_obj):
     """Convert a Tree into a str
     """
@@ -20,11 +20,15 @@
 
 from igor import log
 from lxml import etree
+import Queue
+import collections
+import hashlib
 import os
 import re
 import shlex
 import tempfile
 import threading
+import time
 import urllib
 import yaml
 
@@ -174,20 +178,316 @@ def scanf(pat, txt):
 
 
 def synchronized(lock):
-    """ Synchronization decorator. """
+    """ Synchronization decorator.
+    lock can also be the name of an attribute holding the lock, to use a
+    lock per instance for methods.
+
+    >>> class Counter(object):
+    ...     def __init__(self):
+    ...         self.lock = threading.Lock()
+    ...         self.value = 0
+    ...     @synchronized("lock")
+    ...     def inc(self):
+    ...         assert self.lock.locked()
+    ...         self.value += 1
+    >>> c = Counter()
+    >>> c.inc()
+    >>> c.value, c.lock.locked()
+    (1, False)
+    """
     def wrap(f):
         def newFunction(*args, **kw):
-#            logger.debug("Acq %s, %s" % (f, lock))
-            lock.acquire()
+            _lock = getattr(args[0], lock) if isinstance(lock, str) else lock
+#            logger.debug("Acq %s, %s" % (f, _lock))
+            _lock.acquire()
             try:
                 return f(*args, **kw)
             finally:
-#                logger.debug("Rel %s, %s" % (f, lock))
-                lock.release()
+#                logger.debug("Rel %s, %s" % (f, _lock))
+                _lock.release()
         return newFunction
     return wrap
 
 
+def file_stamp(filename):
+    """Returns a tuple identifying the current state of a file.
+    The tuple changes when the file is modified, replaced or removed.
+
+    >>> file_stamp("/does/not/exist") is None
+    True
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> file_stamp(f.name) == file_stamp(f.name)
+    True
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class StatCache(object):
+    """Caches objects derived from files.
+    An entry stays valid as long as none of the files it was derived from
+    changed (path, mtime, size, inode).
+
+    >>> f = tempfile.NamedTemporaryFile()
+    >>> cache = StatCache()
+    >>> cache.lookup("key") is None
+    True
+    >>> cache.store("key", "parsed", [f.name])
+    'parsed'
+    >>> cache.lookup("key")
+    'parsed'
+    >>> f.write("changed")
+    >>> f.flush()
+    >>> cache.lookup("key") is None
+    True
+    >>> sorted(cache.stats().items())
+    [('entries', 0), ('hits', 1), ('misses', 2)]
+    """
+    hits = 0
+    misses = 0
+
+    _entries = None
+    _lock = None
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Returns the cached object or None if the entry is missing or stale
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stamps, obj = entry
+                if all(file_stamp(fn) == stamp
+                       for fn, stamp in stamps.items()):
+                    self.hits += 1
+                    return obj
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def store(self, key, obj, filenames):
+        """Store obj which was derived from filenames
+        """
+        stamps = dict((fn, file_stamp(fn)) for fn in filenames)
+        with self._lock:
+            self._entries[key] = (stamps, obj)
+        return obj
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len(self._entries)}
+
+
+class ExpiringCache(object):
+    """Caches objects for a limited time, or until they are invalidated.
+    Used for state which can change behind our back, but which we don't
+    want to query again and again.
+
+    >>> cache = ExpiringCache(ttl=60)
+    >>> cache.get("key", lambda: "queried")
+    'queried'
+    >>> cache.get("key", lambda: "again")
+    'queried'
+    >>> cache.invalidate("key")
+    >>> cache.get("key", lambda: "again")
+    'again'
+    >>> cache.get("failed", lambda: None) is None
+    True
+    >>> sorted(cache.stats().items())
+    [('entries', 1), ('hits', 1), ('misses', 3)]
+    """
+    ttl = None
+    hits = 0
+    misses = 0
+
+    _entries = None
+    _lock = None
+    _generation = 0
+
+    def __init__(self, ttl=10):
+        """
+        Args:
+            ttl: Seconds after which an entry expires
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, query):
+        """Returns the cached object, or the result of query() which gets
+        cached unless it is None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        obj = query()
+
+        with self._lock:
+            # Don't store what was queried before an invalidation
+            if obj is not None and generation == self._generation:
+                self._entries[key] = (time.time() + self.ttl, obj)
+        return obj
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            now = time.time()
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "entries": len([e for e in self._entries.values()
+                                    if e[0] > now])}
+
+
+class SizeLimitExceeded(Exception):
+    pass
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class LimitedReader(object):
+    """A file-like object reading at most size bytes from fileobj.
+    Used to read a request body from a stream which doesn't signal EOF.
+
+    >>> import io
+    >>> reader = LimitedReader(io.BytesIO("foobar"), 3)
+    >>> reader.read(2), reader.read(), reader.read()
+    ('fo', 'o', '')
+    """
+    _fileobj = None
+    remaining = None
+
+    def __init__(self, fileobj, size):
+        self._fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if size <= 0:
+            return ""
+        data = self._fileobj.read(size)
+        self.remaining -= len(data)
+        return data
+
+
+class HashingReader(object):
+    """A file-like object calculating the digest of the data read from
+    fileobj
+
+    >>> import hashlib, io
+    >>> reader = HashingReader(io.BytesIO("foobar"), "sha256")
+    >>> reader.read(3), reader.read()
+    ('foo', 'bar')
+    >>> reader.hexdigest() == hashlib.sha256("foobar").hexdigest()
+    True
+    """
+    _fileobj = None
+    _hasher = None
+
+    def __init__(self, fileobj, algorithm):
+        self._fileobj = fileobj
+        self._hasher = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hasher.hexdigest()
+
+
+def copy_to_file(src, filename, max_size=None, checksum=None, tmpdir=None,
+                 bufsize=64 * 1024):
+    """Copy the contents of the file object src into filename.
+    The data is streamed in chunks of bufsize into a temporary file, which
+    is renamed to filename once all data was written. So readers never see
+    a partially written file and the memory usage is bounded.
+
+    Args:
+        src: The file object to read from
+        filename: The destination file
+        max_size: Raise SizeLimitExceeded if src provides more bytes
+        checksum: An optional (algorithm, hexdigest) tuple, raises
+                  ChecksumMismatch if the data doesn't match
+        tmpdir: Where to put the temporary file, must be on the same
+                filesystem as filename. Defaults to the dir of filename
+    Returns:
+        The number of bytes written
+
+    >>> import hashlib, io
+    >>> dst = tempfile.NamedTemporaryFile()
+    >>> copy_to_file(io.BytesIO("foo"), dst.name, bufsize=2)
+    3
+    >>> open(dst.name).read()
+    'foo'
+    >>> copy_to_file(io.BytesIO("foobar"), dst.name, max_size=3)
+    Traceback (most recent call last):
+    ...
+    SizeLimitExceeded: Exceeded the maximum size of 3 bytes
+    >>> digest = hashlib.sha256("bar").hexdigest()
+    >>> copy_to_file(io.BytesIO("bar"), dst.name, checksum=("sha256", digest))
+    3
+    >>> copy_to_file(io.BytesIO("baz"), dst.name, checksum=("sha256", digest))
+    ... # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ChecksumMismatch: sha256 mismatch, expected ..., got ...
+    >>> open(dst.name).read()
+    'bar'
+    """
+    hasher = hashlib.new(checksum[0]) if checksum else None
+    tmpdir = tmpdir or os.path.dirname(os.path.abspath(filename))
+    fd, tmpfilename = tempfile.mkstemp(prefix=".upload-", dir=tmpdir)
+    os.fchmod(fd, 0o644)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as dst:
+            while True:
+                data = src.read(bufsize)
+                if not data:
+                    break
+                size += len(data)
+                if max_size is not None and size > max_size:
+                    raise SizeLimitExceeded("Exceeded the maximum size of " +
+                                            "%d bytes" % max_size)
+                if hasher:
+                    hasher.update(data)
+                dst.write(data)
+        if hasher and hasher.hexdigest() != checksum[1].lower():
+            raise ChecksumMismatch("%s mismatch, expected %s, got %s" %
+                                   (checksum[0], checksum[1],
+                                    hasher.hexdigest()))
+        os.rename(tmpfilename, filename)
+    except:
+        os.unlink(tmpfilename)
+        raise
+    return size
+
+
 def xor(a, b):
     return bool(a) ^ bool(b)
 
@@ -202,12 +502,32 @@ def parse_bool(s):
 
 
 class PollingWorkerDaemon(threading.Thread):
+    """Calls work() every interval seconds, or earlier if wakeup() is called
+
+    >>> class Worker(PollingWorkerDaemon):
+    ...     calls = 0
+    ...     worked = threading.Event()
+    ...     def work(self):
+    ...         self.calls += 1
+    ...         self.worked.set()
+    ...         if self.calls == 2:
+    ...             self.stop()
+    >>> w = Worker(interval=60)
+    >>> w.start()
+    >>> _ = w.worked.wait(5)
+    >>> w.wakeup()
+    >>> w.join(5)
+    >>> w.calls
+    2
+    """
     interval = None
     _stop_event = None
+    _wakeup_event = None
 
     def __init__(self, interval=10):
         self.interval = interval
         self._stop_event = threading.Event()
+        self._wakeup_event = threading.Event()
         threading.Thread.__init__(self)
         self.daemon = True
 
@@ -218,16 +538,25 @@ class PollingWorkerDaemon(threading.Thread):
         self._debug("Starting")
         keep_running = True
         while keep_running:
+            # Cleared before working, so a wakeup during work() is not lost
+            self._wakeup_event.clear()
             self.work()
             if self.is_stopped():
                 self._debug("Stopping")
                 keep_running = False
-            self._stop_event.wait(self.interval)
+            else:
+                self._wakeup_event.wait(self.interval)
         self._debug("Ending")
 
+    def wakeup(self):
+        """Run work() now instead of waiting for the interval to pass
+        """
+        self._wakeup_event.set()
+
     def stop(self):
         self._debug("Requesting worker stop")
         self._stop_event.set()
+        self._wakeup_event.set()
 
     def is_stopped(self):
         return self._stop_event.is_set()
@@ -238,6 +567,130 @@ class PollingWorkerDaemon(threading.Thread):
         raise Exception("Not implemented")
 
 
+class WorkerPool(object):
+    """A fixed number of threads calling the submitted functions.
+    Functions submitted with the same key are called in the order they
+    were submitted, one after another. All threads share one queue of
+    keys, so a slow function only delays the functions with the same key.
+    At most max_pending functions are queued (0 for no limit), further
+    ones are dropped.
+
+    >>> pool = WorkerPool(size=2, name="doctest")
+    >>> calls = []
+    >>> for n in range(5):
+    ...     pool.submit("key", calls.append, n)
+    True
+    True
+    True
+    True
+    True
+    >>> pool.join()
+    >>> calls
+    [0, 1, 2, 3, 4]
+    >>> pool.pending()
+    0
+
+    A blocked key does not delay other keys:
+
+    >>> blocker = threading.Event()
+    >>> pool.submit("slow", blocker.wait)
+    True
+    >>> pool.submit("slow", calls.append, "after slow")
+    True
+    >>> for n in range(4):
+    ...     pool.submit(n, calls.append, n)
+    True
+    True
+    True
+    True
+    >>> time.sleep(0.2)
+    >>> calls[5:]
+    [0, 1, 2, 3]
+    >>> blocker.set()
+    >>> pool.join()
+    >>> calls[-1]
+    'after slow'
+    """
+    name = None
+    dropped = 0
+    max_pending = 0
+
+    _keys = None
+    _calls = None
+    _unfinished = 0
+    _lock = None
+
+    def __init__(self, size=4, max_pending=1000, name="pool"):
+        self.name = name
+        self.max_pending = max_pending
+        # A key is in the queue (or being worked on) at most once, that
+        # keeps the calls of a key in order
+        self._keys = Queue.Queue()
+        self._calls = {}
+        self._lock = threading.Condition()
+        for n in range(size):
+            worker = threading.Thread(target=self._work,
+                                      name="%s-%d" % (name, n))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in one of the threads
+
+        Returns:
+            False if the function was dropped, because too many functions
+            are pending
+        """
+        with self._lock:
+            if self.max_pending and self._pending() >= self.max_pending:
+                self.dropped += 1
+                logger.warning("[%s] Too many pending calls, dropping %s%s" %
+                               (self.name, func, args))
+                return False
+            self._unfinished += 1
+            if key in self._calls:
+                self._calls[key].append((func, args, kwargs))
+            else:
+                self._calls[key] = collections.deque([(func, args, kwargs)])
+                self._keys.put(key)
+        return True
+
+    def pending(self):
+        with self._lock:
+            return self._pending()
+
+    def _pending(self):
+        return sum(len(calls) for calls in self._calls.values())
+
+    def join(self):
+        """Wait until all submitted functions were called
+        """
+        with self._lock:
+            while self._unfinished:
+                self._lock.wait()
+
+    def _work(self):
+        while True:
+            key = self._keys.get()
+            with self._lock:
+                func, args, kwargs = self._calls[key].popleft()
+            try:
+                func(*args, **kwargs)
+            except:
+                logger.exception("[%s] Call of %s%s failed" %
+                                 (self.name, func, args))
+            finally:
+                with self._lock:
+                    if self._calls[key]:
+                        # Behind the other keys, to not starve them
+                        self._keys.put(key)
+                    else:
+                        del self._calls[key]
+                    self._unfinished -= 1
+                    if not self._unfinished:
+                        self._lock.notify_all()
+
+
 class State(object):
     name = None
     map = None
@@ -303,6 +756,44 @@ def obj2xml(root, obj, as_string=False):
     return root
 
 
+def write_xml(fileobj, root, obj):
+    """Like obj2xml, but the XML is written incrementally to fileobj,
+    without building a tree first.
+
+    >>> import io
+    >>> data = {"b": {"one": 1}, "c": [10, 20]}
+    >>> buf = io.BytesIO()
+    >>> write_xml(buf, "root", data)
+    >>> etree.tostring(etree.fromstring(buf.getvalue())) == \
+            etree.tostring(obj2xml("root", data))
+    True
+    """
+    with etree.xmlfile(fileobj) as xf:
+        _write_xml_element(xf, root, obj)
+
+
+def _write_xml_element(xf, tag, obj):
+    with xf.element(tag):
+        _write_xml_content(xf, tag, obj)
+
+
+def _write_xml_content(xf, tag, obj):
+    if type(obj) == list:
+        for v in obj:
+            _write_xml_element(xf, tag, v)
+    elif type(obj) == dict:
+        for k, v in obj.items():
+            if type(v) == list:
+                # Lists are flattened into repeated elements
+                _write_xml_content(xf, k, v)
+            else:
+                _write_xml_element(xf, k, v)
+    elif type(obj) == unicode:
+        xf.write(obj)
+    else:
+        xf.write(unicode(str(obj), errors='ignore'))
+
+
 class Factory(object):
     """A factory to build testing objects from different structures.
     The current default structure is a file/-system based approach.